@@ -16,6 +16,7 @@ if parent_dir not in sys.path:
 import streamlit_scripts.file_op as fo
 import streamlit_scripts.chang_model as cm
 import streamlit_scripts.calculate_K as calk
+import streamlit_scripts.result_table as rt
 import predict
 
 import streamlit as st
@@ -68,12 +69,125 @@ def display_columns(method):
               "Poisson ratio", "Grüneisen parameter", "Acoustic Debye Temperature (K)", "Kappa_cal (W m-1 K-1)"]
     return ls
 
+def display_declaration():
+    # Declaration
+    declaration = """<p style='font-size: 22px;'>We strive to have clear documentation and examples to help everyone with using our calculator. 
+        We will happily fix issues in the documentation and examples should you find any, 
+        however, we will not be able to offer extensive user support and training, except for our collaborators.</p>"""
+    st.markdown(declaration, unsafe_allow_html=True)
+
+def read_params_csv(params_file):
+    """
+    Read the bulk parameter table. Like id_prop.csv the columns are positional:
+    structure id, Bulk modulus (GPa), Shear modulus (GPa), an optional
+    Grüneisen parameter (leave empty to use the default) and, for the
+    uncertainty mode, the optional standard deviations of the three.
+    """
+    params_df = pd.read_csv(params_file)
+    if params_df.shape[1] < 3:
+        raise ValueError("The CSV needs at least 3 columns: ID, Bulk modulus (GPa), Shear modulus (GPa)")
+    columns = ["ID", "Bulk modulus (GPa)", "Shear modulus (GPa)", "Grüneisen parameter",
+               "Bulk modulus std (GPa)", "Shear modulus std (GPa)", "Grüneisen parameter std"]
+    params_df = params_df.iloc[:, :len(columns)]
+    params_df.columns = columns[:params_df.shape[1]]
+    # Match the ids against CIF file names without extension
+    params_df["ID"] = params_df["ID"].astype(str).str.strip().str.replace(r"\.cif$", "", case=False, regex=True)
+    return params_df.set_index("ID")
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def cached_mc_kappa(df, n_samples, distribution):
+    return calk.mc_kappa(df, n_samples=n_samples, distribution=distribution)
+
+def bulk_app(root_dir_path):
+    """Calculate KappaP and PINK kappa for all uploaded CIFs from one parameter CSV"""
+    st.write("---")
+    st.subheader("Bulk Parameters Input")
+    st.write("Upload a CSV with the columns: ID (CIF file name), Bulk modulus (GPa), "
+             "Shear modulus (GPa) and an optional Grüneisen parameter. For the uncertainty mode "
+             "add the standard deviations of the Bulk modulus, Shear modulus and Grüneisen parameter.")
+    params_file = st.file_uploader("Parameter table", ['csv', 'CSV'], key="bulk_params_csv")
+    if params_file is None:
+        return
+
+    try:
+        params_df = read_params_csv(params_file)
+    except Exception as e:
+        st.error(f"Error reading parameter table: {str(e)}")
+        return
+
+    all_cry_df = fo.get_dir_crystalline_data(root_dir_path)
+    if all_cry_df.empty:
+        st.error("Failed to extract crystal data from CIF files.")
+        return
+
+    missing_cif = params_df.index.difference(all_cry_df.index)
+    if len(missing_cif):
+        st.warning(f"No uploaded CIF found for {len(missing_cif)} IDs: {', '.join(missing_cif[:20])}")
+    missing_params = all_cry_df.index.difference(params_df.index)
+    if len(missing_params):
+        st.warning(f"No parameters found for {len(missing_params)} CIF files: {', '.join(missing_params[:20])}")
+
+    whole_info_df = all_cry_df.join(params_df[~params_df.index.duplicated()], how="inner")
+    if whole_info_df.empty:
+        st.error("None of the IDs in the table match the uploaded CIF files.")
+        return
+
+    # Editing a cell only recalculates that row
+    gamma = "Grüneisen parameter"
+    if gamma not in whole_info_df.columns:
+        whole_info_df[gamma] = np.nan
+    param_columns = ["Bulk modulus (GPa)", "Shear modulus (GPa)", gamma]
+    st.write("The parameters can be edited in the table, the results update immediately.")
+    edited_df = st.data_editor(whole_info_df[param_columns], key="bulk_params_editor")
+    whole_info_df[param_columns] = edited_df[param_columns]
+
+    cache = st.session_state.setdefault("bulk_kappa_cache", {})
+    final_df = calk.update_custom_table(whole_info_df, cache)
+    n_invalid = (final_df["Status"] != "OK").sum()
+    if n_invalid:
+        st.warning(f"{n_invalid} of {len(final_df)} rows have invalid parameters, see the Status column.")
+
+    st.write("---")
+    st.subheader("Results")
+    ls = display_columns("KappaP") + ["Kappa_cal (W m-1 K-1)", "Status"]
+    rt.display_table(final_df.loc[:, ls], key="bulk_results", file_name="CustomKappa_results")
+
+    # Percentiles of kappa from the standard deviations in the table
+    if st.toggle("Uncertainty (Monte Carlo)", key="bulk_mc"):
+        col1, col2 = st.columns(2)
+        with col1:
+            n_samples = st.number_input("Samples per material", min_value=100, max_value=100000,
+                                        value=10000, step=1000, key="bulk_mc_samples")
+        with col2:
+            distribution = st.selectbox("Distribution of B, G and γ", ["normal", "lognormal"],
+                                        key="bulk_mc_distribution")
+        with st.spinner("Sampling..."):
+            mc_df = cached_mc_kappa(whole_info_df[final_df["Status"] == "OK"], int(n_samples), distribution)
+        st.write("5th, 50th and 95th percentiles of the lattice thermal conductivity:")
+        rt.display_table(mc_df, key="bulk_mc", file_name="CustomKappa_uncertainty")
+
 def app():
     st.title("Custom Kappa Calculator")
     sour_path = os.path.abspath('.')
     root_dir_path = st.session_state.root_dir_path
     model_path = os.path.join(sour_path, "model")
 
+    # Select input mode
+    mode = st.radio(
+        "Select input mode:",
+        ["Interactive (up to 5 files)", "Bulk (CSV table)"],
+        horizontal=True
+    )
+
+    if mode == "Bulk (CSV table)":
+        if st.session_state.uploaded_files:
+            bulk_app(root_dir_path)
+            fo.del_cif_file(root_dir_path)
+        else:
+            st.info('Please upload CIF files in the sidebar first.')
+        display_declaration()
+        return
+
     # Select calculation method
     method = st.radio(
         "Select calculation method:",
@@ -85,30 +199,32 @@ def app():
         # Limit number of files
         cif_files = glob.glob(os.path.join(root_dir_path, '*.cif'))
         if len(cif_files) > 5:
-            st.error("Maximum 5 files allowed. Please upload fewer files.")
+            st.error("Maximum 5 files allowed in interactive mode. Please upload fewer files or use the bulk mode.")
             return
 
         # Create parameter input interface
         st.write("---")
         st.subheader("Custom Parameters Input")
         
-        # Store parameters for each file in a dictionary
+        # Crystal data and parameters of each file, keyed by the name without extension
+        crystal_data = {}
         file_params = {}
+        gamma_slots = {}
         
         for cif_file in cif_files:
             file_name = os.path.basename(cif_file)
+            base_name = os.path.splitext(file_name)[0]
             st.write(f"**Parameters for {file_name}:**")
             col1, col2, col3 = st.columns(3)
             
-            # Get current file density
+            # Crystal data is cached by file content, so reruns do not re-read the structure
             try:
-                structure_df = fo.get_crystalline_data(Structure.from_file(os.path.join(root_dir_path, file_name)))
-                density = structure_df.get("Density (g cm-3)")
-                if density is None or not isinstance(density, (int, float)):
-                    density = 3.0  # Default density value
+                with open(cif_file) as f:
+                    crystal_data[base_name] = fo.get_cif_crystalline_data(f.read())
             except Exception as e:
-                print(f"Error reading density for {file_name}: {e}")
-                density = 3.0
+                print(f"Error reading crystal data for {file_name}: {e}")
+                st.warning(f"Could not read the crystal data of {file_name}")
+                continue
             
             with col1:
                 bulk = st.number_input(
@@ -125,48 +241,6 @@ def app():
                     placeholder="Enter value..."
                 )
             
-            # Calculate default Grüneisen parameter value
-            default_gruneisen = None
-            if bulk is not None and shear is not None and density is not None:
-                try:
-                    # Convert units: GPa -> Pa (×10⁹)
-                    bulk_pa = bulk * 1e9
-                    shear_pa = shear * 1e9
-                    # Density units: g/cm³ -> kg/m³ (×1000)
-                    density_si = density * 1000
-                    
-                    # Calculate longitudinal and transverse wave velocities (m/s)
-                    Vl = ((bulk_pa + 4 * shear_pa / 3) / density_si) ** 0.5
-                    Vt = (shear_pa / density_si) ** 0.5
-                    
-                    # Check if denominator is zero
-                    if Vt == 0:
-                        st.warning(f"Warning for {file_name}: Cannot calculate Grüneisen parameter - Sound velocity of the transverse wave is zero")
-                        default_gruneisen = None
-                    else:
-                        # Calculate Poisson ratio and Grüneisen parameter
-                        a = Vl / Vt
-                        poisson = (pow(a, 2) - 2) / (2 * pow(a, 2) - 2)
-                        
-                        # Check if Poisson ratio would cause division by zero
-                        if abs(2 - 3 * poisson) < 1e-10:
-                            st.warning(f"Warning for {file_name}: Cannot calculate Grüneisen parameter - Invalid Poisson ratio")
-                            default_gruneisen = None
-                        else:
-                            default_gruneisen = 3 * (1 + poisson) / (2 * (2 - 3 * poisson))
-                            
-                            # Validate calculation result
-                            if not (0 < default_gruneisen < 10):  # Grüneisen parameter typically between 0 and 10
-                                st.warning(f"Warning for {file_name}: Calculated Grüneisen parameter ({default_gruneisen:.4f}) is out of reasonable range (0-10)")
-                                default_gruneisen = None
-                
-                except ZeroDivisionError:
-                    st.warning(f"Warning for {file_name}: Cannot calculate Grüneisen parameter - Division by zero error")
-                    default_gruneisen = None
-                except Exception as e:
-                    st.warning(f"Warning for {file_name}: Error calculating Grüneisen parameter - {str(e)}")
-                    default_gruneisen = None
-            
             with col3:
                 # Detect if Bulk or Shear modulus changed
                 current_bulk_shear = f"{bulk}_{shear}"
@@ -189,157 +263,89 @@ def app():
                     placeholder="Enter value or leave empty for default"
                 )
                 
-                # Handle user input
-                try:
-                    if user_input.strip():  # If user entered a value
+                # Handle user input, NaN means use the default value
+                gruneisen = np.nan
+                if user_input.strip():
+                    try:
                         gruneisen = float(user_input)
                         st.session_state[f"user_grun_{file_name}"] = user_input
-                    else:  # If input is empty, use default value
-                        gruneisen = default_gruneisen
-                        if f"user_grun_{file_name}" in st.session_state:
-                            del st.session_state[f"user_grun_{file_name}"]
-                except ValueError:
-                    st.error("Please enter a valid number")
-                    gruneisen = None
+                    except ValueError:
+                        st.error("Please enter a valid number")
+                        del crystal_data[base_name]
+                        continue
+                elif f"user_grun_{file_name}" in st.session_state:
+                    del st.session_state[f"user_grun_{file_name}"]
                 
-                # Display current value
-                if gruneisen is not None:
-                    st.write(f"Current value: {gruneisen:.4f}")
-                    if user_input.strip():
-                        st.write("(User defined)")
-                    else:
-                        st.write("(Default calculated)")
+                # Filled in once the table is calculated
+                gamma_slots[base_name] = st.empty()
             
-            params = {}
-            if bulk is not None:
-                params['Bulk modulus (GPa)'] = bulk
-            if shear is not None:
-                params['Shear modulus (GPa)'] = shear
-            if gruneisen is not None:
-                params['Grüneisen parameter'] = gruneisen
-            
-            if params:
-                file_params[file_name] = params
-                file_params[file_name] = params
+            file_params[base_name] = {
+                'Bulk modulus (GPa)': np.nan if bulk is None else bulk,
+                'Shear modulus (GPa)': np.nan if shear is None else shear,
+                'Grüneisen parameter': gruneisen
+            }
 
-        # Calculate button
-        calculate = st.button("Calculate")
-        if calculate:
-            # Check if all required parameters are input
-            missing_params = {}
-            invalid_params = {}
-            
-            for file_name, params in file_params.items():
-                missing = []
-                invalid = []
-                
-                # Check if required parameters exist
-                if 'Bulk modulus (GPa)' not in params:
-                    missing.append('Bulk modulus')
-                elif params['Bulk modulus (GPa)'] <= 0:
-                    invalid.append('Bulk modulus must be positive')
-                    
-                if 'Shear modulus (GPa)' not in params:
-                    missing.append('Shear modulus')
-                elif params['Shear modulus (GPa)'] <= 0:
-                    invalid.append('Shear modulus must be positive')
-                    
-                if 'Grüneisen parameter' not in params:
-                    missing.append('Grüneisen parameter')
-                elif params['Grüneisen parameter'] <= 0:
-                    invalid.append('Grüneisen parameter must be positive')
-                    
-                if missing:
-                    missing_params[file_name] = missing
-                if invalid:
-                    invalid_params[file_name] = invalid
-                
-            # Display error messages
-            if missing_params or invalid_params:
-                st.error("Please correct the following errors:")
-                
-                if missing_params:
-                    st.write("Missing parameters:")
-                    for file_name, params in missing_params.items():
-                        st.write(f"- {file_name}: {', '.join(params)}")
-                
-                if invalid_params:
-                    st.write("Invalid parameters:")
-                    for file_name, errors in invalid_params.items():
-                        st.write(f"- {file_name}: {', '.join(errors)}")
-                
-                return
-            
-            try:
-                # Data processing
-                all_cry_df = fo.get_dir_crystalline_data(root_dir_path)
-                whole_info_df = pd.DataFrame(index=all_cry_df.index, columns=["Number of Atoms", "Density (g cm-3)", "Volume (Å3)", 
-                          "the total atomic mass (amu)", "Bulk modulus (GPa)", 
-                          "Shear modulus (GPa)", "Grüneisen parameter"])
-                
-                # Copy basic properties
-                for col in ["Number of Atoms", "Density (g cm-3)", "Volume (Å3)", "the total atomic mass (amu)"]:
-                    if col in all_cry_df.columns:
-                        whole_info_df[col] = all_cry_df[col]
+        if not file_params:
+            return
 
-                # Apply user-defined parameters
-                for file_name, params in file_params.items():
-                    base_name = os.path.splitext(file_name)[0]  # 去掉扩展名
-                    if base_name in whole_info_df.index:
-                        for param, value in params.items():
-                            whole_info_df.loc[base_name, param] = value
+        # Only the rows whose inputs changed since the last rerun are recalculated
+        whole_info_df = pd.DataFrame.from_dict(crystal_data, orient="index").join(
+            pd.DataFrame.from_dict(file_params, orient="index"))
+        cache = st.session_state.setdefault("custom_kappa_cache", {})
+        try:
+            final_df = calk.update_custom_table(whole_info_df, cache)
+        except Exception as e:
+            st.error(f"An error occurred during calculation: {str(e)}")
+            return
 
-                # Get user input Grüneisen parameters
-                custom_gamma = whole_info_df["Grüneisen parameter"]
-                Debye_df = calk.cal_Debye_T(whole_info_df)
+        # Display current Grüneisen parameter or the validation messages
+        for base_name, slot in gamma_slots.items():
+            row = final_df.loc[base_name]
+            params = file_params[base_name]
+            with slot.container():
+                if row["Status"] == "OK":
+                    st.write(f"Current value: {row['Grüneisen parameter']:.4f}")
+                    if np.isnan(params['Grüneisen parameter']):
+                        st.write("(Default calculated)")
+                    else:
+                        st.write("(User defined)")
+                elif not (np.isnan(params['Bulk modulus (GPa)']) or np.isnan(params['Shear modulus (GPa)'])):
+                    st.warning(row["Status"])
 
-                if method == "KappaP":
-                    # Use user input Grüneisen parameters
-                    gamma_df = calk.cal_gamma(Debye_df, custom_gamma)
-                    A_df = calk.cal_A(gamma_df, 1, custom_gamma)
-                    final_df = calk.cal_K_Slack(A_df)
-                    display_func = display_results_kappap
-                else:  # AI4Kappa
-                    gamma_df = calk.cal_gamma(Debye_df, custom_gamma)
-                    final_df = calk.by_MTP(gamma_df)
-                    display_func = display_results_ai4kappa
+        valid_df = final_df[final_df["Status"] == "OK"]
+        if valid_df.empty:
+            st.info("Enter the Bulk and Shear modulus to calculate the lattice thermal conductivity.")
+        else:
+            display_func = display_results_kappap if method == "KappaP" else display_results_ai4kappa
 
-                # Display results
-                st.write("---")
-                st.subheader("Results")
-                
-                # Display merged dataframe
-                st.write("Combined Results:")
-                st.dataframe(final_df.loc[:, display_columns(method)])
-                
-                # Display crystal structure info for each file
-                st.write("---")
-                st.subheader("Crystal Structure Information")
-                
-                for file_name in file_params.keys():
-                    base_name = os.path.splitext(file_name)[0]  # 去掉扩展名
-                    with st.expander(f"Structure details for {file_name}"):
-                        cry_content = fo.get_crystalline_content(os.path.join(root_dir_path, file_name))
-                        st.write(cry_content, unsafe_allow_html=True)
-                        
-                        try:
-                            # 使用不带扩展名的文件名访问数据
-                            file_results = final_df.loc[[base_name]]
-                            template = display_func(file_results)
-                            st.markdown(template, unsafe_allow_html=True)
-                        except Exception as e:
-                            st.error(f"Error displaying results for {file_name}: {str(e)}")
-                        
-            except Exception as e:
-                st.error(f"An error occurred during calculation: {str(e)}")
-                return
+            # Display results
+            st.write("---")
+            st.subheader("Results")
+            
+            # Display merged dataframe
+            st.write("Combined Results:")
+            st.dataframe(valid_df.loc[:, display_columns(method)])
+            
+            # Display crystal structure info for each file
+            st.write("---")
+            st.subheader("Crystal Structure Information")
+            
+            for base_name in valid_df.index:
+                file_name = base_name + ".cif"
+                # Only build the details of the structures the user opens
+                if st.toggle(f"Structure details for {file_name}", key=f"details_{file_name}"):
+                    cry_content = fo.get_crystalline_content(os.path.join(root_dir_path, file_name))
+                    st.write(cry_content, unsafe_allow_html=True)
+                    
+                    try:
+                        file_results = valid_df.loc[[base_name]]
+                        template = display_func(file_results)
+                        st.markdown(template, unsafe_allow_html=True)
+                    except Exception as e:
+                        st.error(f"Error displaying results for {file_name}: {str(e)}")
         fo.del_cif_file(root_dir_path)
         fo.del_temp_file(sour_path)
     else:
         st.info('Please upload CIF files (maximum 5) in the sidebar first.')
 
-    # Declaration
-    declaration = """<p style='font-size: 22px;'>We strive to have clear documentation and examples to help everyone with using our calculator. 
-        We will happily fix issues in the documentation and examples should you find any, 
-        however, we will not be able to offer extensive user support and training, except for our collaborators.</p>"""
-    st.markdown(declaration, unsafe_allow_html=True) 
\ No newline at end of file
+    display_declaration() 
\ No newline at end of file
@@ -19,6 +19,7 @@ if parent_dir not in sys.path:
 import streamlit_scripts.file_op as fo
 import streamlit_scripts.chang_model as cm
 import streamlit_scripts.calculate_K as calk
+import streamlit_scripts.result_table as rt
 import predict  # Should import correctly now
 
 # Import third party libraries
@@ -70,10 +71,16 @@ def app():
         # Check if uploaded CIF files are valid and ensure primitive structures are used
         cif_path_list = glob.glob(os.path.join(root_dir_path, '*.cif'))
         valid_structures = {}
+        # Archive members were parsed and converted by process_archive already
+        spooled_files = st.session_state.get("spooled_files", set())
+        n_spooled = 0
         
         for cif_path in cif_path_list:
+            file_name = os.path.basename(cif_path)
+            if file_name in spooled_files:
+                n_spooled += 1
+                continue
             try:
-                file_name = os.path.basename(cif_path)
                 # First try to get converted primitive structure from session state
                 if hasattr(st.session_state, 'primitive_structures') and file_name in st.session_state.primitive_structures:
                     valid_structures[file_name] = st.session_state.primitive_structures[file_name]
@@ -90,13 +97,25 @@ def app():
                 os.remove(cif_path)
                 st.write(f"Invalid CIF file {file_name} has been deleted.")
 
-        if not valid_structures:
+        if not valid_structures and not n_spooled:
             st.error("No valid CIF files found.")
             return
 
         # Create id_prop.csv
         cif_path_list, cif_name_list = fo.create_id_prop(root_dir_path)
-        
+
+        # Optionally triage a screening set by composition before the models
+        if len(cif_name_list) > 1 and st.toggle(
+                "Only predict the structures likely to have κ below 0.3 W/(m·K) (composition prefilter)",
+                key="kappap_prefilter"):
+            recall = st.slider("Fraction of the low-κ structures to keep", min_value=0.8, max_value=0.99,
+                               value=0.95, step=0.01, key="kappap_prefilter_recall")
+            cif_name_list, rejected = cm.prefilter_id_prop(root_dir_path, recall)
+            st.caption(f"{len(rejected)} of {len(rejected) + len(cif_name_list)} structures skipped by the prefilter")
+            if not cif_name_list:
+                st.warning("No structure passed the prefilter, raise the fraction to keep.")
+                return
+
         if len(cif_name_list) > 0:
             # Get crystal info for first file
             first_cif_name = cif_name_list[0]
@@ -105,29 +124,9 @@ def app():
             # Get crystal info using get_crystalline_content
             cry_content = fo.get_crystalline_content(first_cif_path)
             
-            results_csv_path = os.path.join(sour_path, "test_results.csv")
-            
-            # Get model paths and names
-            model_path_list, model_name_list = cm.get_model_path(model_path)
-            
-            # Predict using first model
-            try:
-                cm.copy_model(model_path_list[0], sour_path)
-                predict.main(root_dir_path)
-                pre_df = cm.get_pre_dataframe(results_csv_path, model_name_list[0])
-            finally:
-                cm.clean_model(sour_path)
-                
-            # Predict using remaining models and merge results
-            for model_path, model_name in zip(model_path_list[1:], model_name_list[1:]):
-                try:
-                    cm.copy_model(model_path, sour_path)
-                    predict.main(root_dir_path)
-                    pre_df1 = cm.get_pre_dataframe(results_csv_path, model_name)
-                    pre_df = pd.merge(pre_df, pre_df1, left_index=True, right_index=True)
-                finally:
-                    cm.clean_model(sour_path)
-                    
+            # Predict with every model, reusing the predictions cached by any session
+            pre_df, cache_stats = cm.predict_models(root_dir_path, model_path, sour_path)
+
             try:
                 st.write("---")
                 # Get crystal data
@@ -161,7 +160,8 @@ def app():
                     return
                 
                 # Display results
-                st.dataframe(final_df)
+                rt.display_table(final_df, key="kappap_results", file_name="KappaP_results")
+                st.caption(cm.cache_summary(cache_stats))
                 st.write("---")
                 
                 # Display filename
@@ -16,6 +16,7 @@ if parent_dir not in sys.path:
 import streamlit_scripts.file_op as fo
 import streamlit_scripts.chang_model as cm
 import streamlit_scripts.calculate_K as calk
+import streamlit_scripts.result_table as rt
 import predict  # Should import correctly now
 
 import streamlit as st
@@ -55,23 +56,8 @@ def app():
         if len(glob.glob(os.path.join(root_dir_path, '*.cif'))):
             first_cif_path = cif_path_list[0]
             cry_content = fo.get_crystalline_content(first_cif_path)
-            results_csv_path = os.path.join(sour_path, "test_results.csv")
-            model_path_list, model_name_list = cm.get_model_path(model_path)
-            try:
-                cm.copy_model(model_path_list[0], sour_path)
-                predict.main(root_dir_path)
-                pre_df = cm.get_pre_dataframe(results_csv_path, model_name_list[0])
-            finally:
-                cm.clean_model(sour_path)  # Clean model files
-
-            for model_path, model_name in zip(model_path_list[1:], model_name_list[1:]):
-                try:
-                    cm.copy_model(model_path, sour_path)
-                    predict.main(root_dir_path)
-                    pre_df1 = cm.get_pre_dataframe(results_csv_path, model_name)
-                    pre_df = pd.merge(pre_df, pre_df1, left_index=True, right_index=True)
-                finally:
-                    cm.clean_model(sour_path)  # Clean model files
+            # Predict with every model, reusing the predictions cached by any session
+            pre_df, cache_stats = cm.predict_models(root_dir_path, model_path, sour_path)
 
             try:
                 st.write("---")
@@ -99,7 +85,8 @@ def app():
                     st.error("No data was generated. Please check your input files.")
                     return
                     
-                st.dataframe(final_df)
+                rt.display_table(final_df, key="pink_results", file_name="PINK_results")
+                st.caption(cm.cache_summary(cache_stats))
                 st.write("---")
                 
                 # Safely get index with default value
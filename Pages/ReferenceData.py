@@ -0,0 +1,61 @@
+#!/user/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024 Zhibin Gao's Group. All rights reserved.
+# Author: Zhibin Gao
+# Email: zhibin.gao@xjtu.edu.cn
+import os
+import sys
+import time
+
+# Add parent directory to system path
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+if parent_dir not in sys.path:
+    sys.path.append(parent_dir)
+
+import streamlit_scripts.reference_data as refd
+import streamlit_scripts.result_table as rt
+
+import streamlit as st
+
+KAPPA = "Kappa_Slack (W m-1 K-1)"
+BANDGAP = "Bandgap"
+
+def range_input(ref, column, key):
+    """Slider over the values of a numeric column, None bounds when the full range is kept"""
+    _, values = ref.sorted_columns[column]
+    low, high = float(values[0]), float(values[-1])
+    selected = st.slider(column, min_value=low, max_value=high, value=(low, high), key=key)
+    return (None if selected[0] <= low else selected[0], None if selected[1] >= high else selected[1])
+
+def app():
+    st.title("Reference Low-Kappa Dataset")
+    st.write("Explore the filtered low lattice thermal conductivity dataset of the KappaP paper. "
+             "All conditions are combined, leave a filter empty to ignore it.")
+    ref = refd.load_reference_data()
+
+    col1, col2 = st.columns(2)
+    with col1:
+        include_elements = st.multiselect("Contains all of", ref.elements, key="ref_include")
+        chemsys = st.text_input("Chemical system", key="ref_chemsys", placeholder="e.g. Pb-Te")
+        crystal_systems = st.multiselect("Crystal system", ref.crystal_systems, key="ref_crystal_systems")
+    with col2:
+        exclude_elements = st.multiselect("Contains none of", ref.elements, key="ref_exclude")
+        subsystems = st.toggle("Include subsystems (e.g. Pb, Te and Pb-Te for Pb-Te)", key="ref_subsystems")
+        spacegroups = st.multiselect("Space group number", sorted(ref.by_spacegroup), key="ref_spacegroups")
+
+    ranges = {KAPPA: range_input(ref, KAPPA, "ref_kappa"),
+              BANDGAP: range_input(ref, BANDGAP, "ref_bandgap")}
+    # Any other numeric column can be bounded as well
+    other_columns = [column for column in ref.numeric_columns if column not in ranges]
+    extra_column = st.selectbox("Additional range on", ["None"] + other_columns, key="ref_extra")
+    if extra_column != "None":
+        ranges[extra_column] = range_input(ref, extra_column, f"ref_range_{extra_column}")
+
+    start = time.perf_counter()
+    rows = ref.query(include_elements, exclude_elements, chemsys, subsystems,
+                     spacegroups, crystal_systems, ranges)
+    elapsed = time.perf_counter() - start
+    st.write(f"{len(rows)} of {ref.n_rows} materials match ({elapsed * 1e3:.2f} ms)")
+    st.write("---")
+    rt.display_table(ref.frame(rows), key="reference_results", file_name="reference_low_kappa")
@@ -33,7 +33,9 @@ def app():
             This application provides three advanced methods for calculating lattice thermal conductivity:
             - **KappaP**: Based on the Slack model
             - **PINK**: Based on an interpretable formula published in [Materials Today Physics](https://doi.org/10.1016/j.mtphys.2024.101549)
-            - **Custom Calculator**: Allows you to input your own elastic parameters and calculate thermal conductivity using both models (up to 5 files)
+            - **Custom Calculator**: Allows you to input your own elastic parameters and calculate thermal conductivity using both models (up to 5 files, or any number through a CSV table)
+
+            The **Reference Data** page searches the low lattice thermal conductivity dataset of KappaP by elements, chemical system, symmetry and property ranges.
             """
         )
 
@@ -46,11 +48,12 @@ def app():
         1. **File Upload**
            - Upload your CIF files using the sidebar
            - Files must be in valid CIF format
+           - Many files can be uploaded at once as a zip or tar archive
         
         2. **Choose Method**
            - KappaP: Traditional Slack model approach
            - MTP: Materials Today Physics model
-           - Custom Calculator: Combine both methods with your parameters (maximum 5 files)
+           - Custom Calculator: Combine both methods with your parameters (maximum 5 files, or a CSV table in bulk mode)
         
         3. **Get Results**
            - Comprehensive output including:
@@ -113,8 +116,13 @@ def app():
                 - Shear modulus
                 - Grüneisen parameter (optional)
             - Compare results between KappaP and PINK methods
-            - Process multiple structures (up to 5 files)
-            - Explore parameter sensitivity
+            - Process multiple structures (up to 5 files interactively)
+            - Bulk mode: upload one CSV of ID, Bulk modulus, Shear modulus and optional
+              Grüneisen parameter to process hundreds of structures at once
+            - Uncertainty: add standard deviations to the CSV to get Monte Carlo
+              percentiles of both thermal conductivities
+            - Explore parameter sensitivity: results update as you edit a parameter,
+              recalculating only the structures whose parameters changed
             
             Perfect for researchers who:
             - Have their own measured/calculated parameters
@@ -6,7 +6,7 @@
 import os
 import streamlit as st
 from multipage import MultiPage
-from Pages import KappaP, PINK, home, CustomKappa
+from Pages import KappaP, PINK, home, CustomKappa, ReferenceData
 import streamlit_scripts.file_op as fo
 
 st.set_page_config(page_title="Lattice Thermal Conductivity APP", page_icon=":evergreen_tree:", layout="wide")
@@ -22,17 +22,23 @@ if 'root_dir_path' not in st.session_state:
 fo.clean_root_dir(st.session_state.root_dir_path)
 
 # File upload section
-uploaded_files = st.sidebar.file_uploader("Please upload your CIF files", ['cif', 'CIF'], accept_multiple_files=True)
+uploaded_files = st.sidebar.file_uploader("Please upload your CIF files or zip/tar archives of CIF files",
+                                          fo.UPLOAD_TYPES, accept_multiple_files=True)
 if uploaded_files:
     st.session_state.uploaded_files = uploaded_files
     # Process uploaded files
-    fo.process_and_save_uploaded_files(uploaded_files, st.session_state.root_dir_path)
+    primitive_structures = fo.process_and_save_uploaded_files(uploaded_files, st.session_state.root_dir_path)
     
     # Display uploaded file information in the top right of the main area
     with st.sidebar.expander("Uploaded Files", expanded=True):
-        # Display filenames in list format
+        # Display filenames in list format, ✗ if the structure could not be converted
         for i, file in enumerate(uploaded_files, 1):
-            st.write(f"{i}. {file.name} ✓")
+            if file.name in st.session_state.archive_results:
+                n_converted, errors = st.session_state.archive_results[file.name]
+                st.write(f"{i}. {file.name}: {n_converted} structures" + (f", {len(errors)} ✗" if errors else ""))
+                continue
+            mark = "✓" if os.path.splitext(file.name)[0] in primitive_structures else "✗"
+            st.write(f"{i}. {file.name} {mark}")
     
     # Display upload success message in main area
     col1, col2 = st.columns([3, 1])
@@ -46,6 +52,7 @@ app.add_page('Home', home.app)
 app.add_page("KappaP", KappaP.app)
 app.add_page("PINK", PINK.app)
 app.add_page("Custom Kappa", CustomKappa.app)
+app.add_page("Reference Data", ReferenceData.app)
 
 # Run application
 if __name__ == '__main__':
@@ -0,0 +1,213 @@
+from __future__ import print_function, division
+
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+
+import numpy as np
+from pymatgen.core.structure import Structure
+
+from .utils import file_digest
+
+
+def structure_hash(structure, decimals=4):
+    """
+    Hash of a structure that does not depend on the order of the sites or on
+    the periodic image the fractional coordinates are written in.
+
+    The lattice and coordinates are rounded to decimals, so structures that
+    differ by less than that share a hash. Rounding can also put equal
+    structures on both sides of a rounding boundary, which only costs a
+    cache miss.
+    """
+    lattice = np.round(structure.lattice.matrix, decimals) + 0.
+    # wrap after rounding so that 0.99999 and 0. are the same coordinate
+    frac_coords = np.round(np.round(structure.frac_coords, decimals) % 1.,
+                           decimals) % 1. + 0.
+    sites = sorted((site.species_string, tuple(coords)) for site, coords
+                   in zip(structure, frac_coords.tolist()))
+    digest = hashlib.sha256(lattice.tobytes())
+    digest.update(json.dumps(sites).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class PredictionCache(object):
+    """
+    Persistent store of predictions in a SQLite file, keyed by the
+    structure hash and the model key.
+
+    The model key covers the checkpoint, atom_init.json and graph settings
+    by their content, so a changed checkpoint never serves old predictions;
+    prune_checkpoints removes the predictions of the checkpoints that are
+    gone, whatever graph settings they were made with. The
+    structure hash of every CIF is stored by the SHA-1 of its file, so a
+    repeated file is not parsed again. The numbers of hits and misses are
+    kept in the file as well (see stats).
+
+    Every call opens its own connection, so one cache file can be shared by
+    threads and processes.
+
+    Parameters
+    ----------
+
+    db_path: str
+        The SQLite file, created with its directory if missing
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        if not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS predictions ('
+                         'model_key TEXT, structure_hash TEXT, '
+                         'prediction REAL, '
+                         'PRIMARY KEY (model_key, structure_hash)) '
+                         'WITHOUT ROWID')
+            conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                         'file_sha1 TEXT PRIMARY KEY, structure_hash TEXT) '
+                         'WITHOUT ROWID')
+            conn.execute('CREATE TABLE IF NOT EXISTS stats ('
+                         'name TEXT PRIMARY KEY, value INTEGER)')
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # one transaction per connection, closed afterwards
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def model_key(checkpoint_path, atom_init_file, max_num_nbr=12, radius=8,
+                  dmin=0, step=0.2, nbr_search='radius'):
+        """
+        Key of the predictions of a checkpoint, see CIFData for the rest.
+
+        The neighbor search is part of the key since the backends can keep
+        different neighbors tied in distance at the max_num_nbr cutoff. The
+        other options of predict.py (sparse graph, symmetry reduction,
+        embedding lookup, factorized convolutions) give the same graph in
+        another form. The key starts with the digest of the checkpoint, for
+        prune_checkpoints.
+        """
+        return '{}:{}'.format(file_digest(checkpoint_path), hashlib.sha256(
+            json.dumps({
+                'atom_init': file_digest(atom_init_file),
+                'graph': [max_num_nbr, radius, dmin, step, nbr_search]}
+            ).encode('utf-8')).hexdigest())
+
+    def file_hash(self, cif_path):
+        """
+        Structure hash of a CIF file, or None if it cannot be parsed
+        """
+        with open(cif_path, 'rb') as f:
+            data = f.read()
+        file_sha1 = hashlib.sha1(data).hexdigest()
+        with self._connect() as conn:
+            row = conn.execute('SELECT structure_hash FROM files '
+                               'WHERE file_sha1 = ?', (file_sha1,)).fetchone()
+        if row is not None:
+            return row[0]
+        try:
+            crystal = Structure.from_str(data.decode('utf-8'), fmt='cif')
+        except Exception:
+            return None
+        hash_ = structure_hash(crystal)
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?)',
+                         (file_sha1, hash_))
+        return hash_
+
+    def get(self, model_key, hashes, chunk_size=500):
+        """
+        Cached predictions of the structures, counting the hits and misses.
+
+        Returns
+        -------
+
+        predictions: dict
+          Structure hash to prediction, for the hashes found
+        """
+        hashes = list(set(hash_ for hash_ in hashes if hash_ is not None))
+        predictions = {}
+        with self._connect() as conn:
+            for start in range(0, len(hashes), chunk_size):
+                chunk = hashes[start:start + chunk_size]
+                predictions.update(conn.execute(
+                    'SELECT structure_hash, prediction FROM predictions '
+                    'WHERE model_key = ? AND structure_hash IN ({})'.format(
+                        ','.join('?' * len(chunk))), [model_key] + chunk))
+            for name, value in [('hits', len(predictions)),
+                                ('misses', len(hashes) - len(predictions))]:
+                conn.execute('INSERT INTO stats VALUES (?, ?) ON CONFLICT '
+                             '(name) DO UPDATE SET value = value + ?',
+                             (name, value, value))
+        return predictions
+
+    def put(self, model_key, predictions):
+        """Store (structure hash, prediction) pairs"""
+        with self._connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO predictions '
+                             'VALUES (?, ?, ?)',
+                             [(model_key, hash_, prediction)
+                              for hash_, prediction in predictions
+                              if hash_ is not None])
+
+    def prune(self, model_keys):
+        """Delete the predictions of every model key but model_keys"""
+        model_keys = list(model_keys)
+        with self._connect() as conn:
+            return conn.execute(
+                'DELETE FROM predictions WHERE model_key NOT IN ({})'.format(
+                    ','.join('?' * len(model_keys))), model_keys).rowcount
+
+    def prune_checkpoints(self, checkpoint_paths):
+        """
+        Delete the predictions of every checkpoint but checkpoint_paths, with
+        any atom_init.json and graph settings, and the predictions stored
+        under model keys of an older form
+        """
+        digests = [file_digest(path) + ':' for path in checkpoint_paths]
+        with self._connect() as conn:
+            return conn.execute(
+                'DELETE FROM predictions WHERE substr(model_key, 1, 65) '
+                'NOT IN ({})'.format(','.join('?' * len(digests))),
+                digests).rowcount
+
+    def stats(self):
+        """
+        Returns
+        -------
+
+        stats: dict
+          entries, models, hits, misses and hit_rate (None before the
+          first lookup)
+        """
+        with self._connect() as conn:
+            entries, models = conn.execute(
+                'SELECT COUNT(*), COUNT(DISTINCT model_key) '
+                'FROM predictions').fetchone()
+            counts = dict(conn.execute('SELECT name, value FROM stats'))
+        hits, misses = counts.get('hits', 0), counts.get('misses', 0)
+        return {'entries': entries, 'models': models, 'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / (hits + misses) if hits + misses else None}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Show the statistics of a prediction cache')
+    parser.add_argument('db_path', help='the SQLite file of the cache')
+    args = parser.parse_args()
+    stats = PredictionCache(args.db_path).stats()
+    print('{entries} predictions of {models} models, {hits} hits and '
+          '{misses} misses'.format(**stats))
+    if stats['hit_rate'] is not None:
+        print('hit rate {:.1%}'.format(stats['hit_rate']))
@@ -0,0 +1,411 @@
+from __future__ import print_function, division
+
+import functools
+import re
+import warnings
+
+import numpy as np
+from pymatgen.core.lattice import Lattice
+from pymatgen.core.periodic_table import Element
+from pymatgen.core.structure import Structure
+from scipy.spatial import cKDTree
+
+# comments and the tokens of a CIF line, as pymatgen finds them
+COMMENT_RE = re.compile(r'(\s|^)#.*$', flags=re.MULTILINE)
+TOKEN_RE = re.compile(r"""([^'"\s][\S]*)|'(.*?)'(?!\S)|"(.*?)"(?!\S)""")
+NUMBER_RE = re.compile(r'^([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)'
+                       r'(?:\(\d+\))?$')
+SYMBOL_RE = re.compile(r'^[A-Z][a-z]?\d*$')
+XYZ_ROT_RE = re.compile(r'([+-]?)([\d.]*)/?([\d.]*)([x-z])')
+XYZ_TRANS_RE = re.compile(r'([+-]?)([\d.]+)/?([\d.]*)(?![x-z])')
+
+SYMOP_TAGS = ('_symmetry_equiv_pos_as_xyz', '_symmetry_equiv_pos_as_xyz_',
+              '_space_group_symop_operation_xyz',
+              '_space_group_symop_operation_xyz_')
+CELL_TAGS = ('_cell_length_a', '_cell_length_b', '_cell_length_c',
+             '_cell_angle_alpha', '_cell_angle_beta', '_cell_angle_gamma')
+# tags that ask for more than the fast path understands
+UNSUPPORTED_PREFIXES = ('_atom_site_moment', '_atom_site_fourier',
+                        '_space_group_magn', '_parent_space_group',
+                        '_atom_type_oxidation_number', '_atom_site_cart')
+
+
+class UnsupportedCIF(ValueError):
+    """The CIF needs the full pymatgen parser"""
+
+
+def _tokens(line):
+    if not ('"' in line or "'" in line):
+        return line.split()
+    return [match.group(1) if match.group(1) is not None
+            else match.group(2) if match.group(2) is not None
+            else match.group(3) for match in TOKEN_RE.finditer(line)]
+
+
+def parse_block(text):
+    """
+    Tags and loops of a CIF with a single data block.
+
+    Returns
+    -------
+
+    data: dict
+      Tag to value, a str for single values and a list for loop columns
+    """
+    text = COMMENT_RE.sub('', text).encode('ascii', 'ignore').decode('ascii')
+    lines = []
+    for line in text.splitlines():
+        if line.startswith(';'):
+            raise UnsupportedCIF('multi-line text field')
+        tokens = _tokens(line)
+        if tokens:
+            lines.append(tokens)
+    if not lines or not lines[0][0].startswith('data_'):
+        raise UnsupportedCIF('no data block')
+    data = {}
+    i = 1
+    while i < len(lines):
+        tokens = lines[i]
+        head = tokens[0]
+        i += 1
+        if head.startswith('data_'):
+            raise UnsupportedCIF('more than one data block')
+        if head.startswith('loop_'):
+            headers, values = tokens[1:], []
+            while i < len(lines) and lines[i][0].startswith('_'):
+                headers.extend(lines[i])
+                i += 1
+            while i < len(lines) and not (
+                    lines[i][0].startswith(('_', 'data_', 'loop_'))):
+                values.extend(lines[i])
+                i += 1
+            if not headers or len(values) % len(headers):
+                raise UnsupportedCIF('malformed loop')
+            for j, header in enumerate(headers):
+                data[header] = values[j::len(headers)]
+        elif head.startswith('_'):
+            if len(tokens) == 1:
+                # the value is on the next line
+                if i == len(lines):
+                    raise UnsupportedCIF('no value for {}'.format(head))
+                tokens = [head] + lines[i]
+                i += 1
+            if len(tokens) != 2:
+                raise UnsupportedCIF('malformed item {}'.format(head))
+            data[head] = tokens[1]
+        else:
+            raise UnsupportedCIF('unexpected value {}'.format(head))
+    return data
+
+
+def _float(value):
+    match = NUMBER_RE.match(value)
+    if match is None:
+        raise UnsupportedCIF('not a number: {}'.format(value))
+    return float(match.group(1))
+
+
+@functools.lru_cache(maxsize=None)
+def _element(label):
+    """
+    Atomic number and sort key of an element symbol or a label such as Zn1,
+    read as pymatgen does: the first two letters if they are an element,
+    otherwise the first one
+    """
+    if not SYMBOL_RE.match(label):
+        raise UnsupportedCIF('not a plain element: {}'.format(label))
+    symbol = label[:2].title() if Element.is_valid_symbol(label[:2].title()) \
+        else label[0]
+    try:
+        element = Element(symbol)
+    except ValueError:
+        raise UnsupportedCIF('unknown element: {}'.format(label))
+    electroneg = element.X
+    # pymatgen orders sites by electronegativity and then by symbol, which
+    # is not a total order once an electronegativity is NaN
+    if np.isnan(electroneg):
+        raise UnsupportedCIF('no electronegativity for {}'.format(symbol))
+    return element.Z, (electroneg, symbol)
+
+
+@functools.lru_cache(maxsize=None)
+def _affine(xyz):
+    """
+    Affine matrix of an 'x, y, z' symmetry operation, as
+    SymmOp.from_xyz_str
+    """
+    rot = np.zeros((3, 3))
+    trans = np.zeros(3)
+    for i, token in enumerate(xyz.strip().replace(' ', '').lower()
+                              .split(',')):
+        for match in XYZ_ROT_RE.finditer(token):
+            factor = -1. if match.group(1) == '-' else 1.
+            if match.group(2):
+                factor *= float(match.group(2)) / float(match.group(3)) \
+                    if match.group(3) else float(match.group(2))
+            rot[i, ord(match.group(4)) - 120] = factor
+        for match in XYZ_TRANS_RE.finditer(token):
+            factor = -1 if match.group(1) == '-' else 1
+            trans[i] = factor * (float(match.group(2)) / float(match.group(3))
+                                 if match.group(3) else float(match.group(2)))
+    affine = np.eye(4)
+    affine[:3, :3] = rot
+    affine[:3, 3] = trans
+    return affine
+
+
+def _close_pbc(a, b, atol):
+    """Pairwise match of fractional coordinates a (n, 3) and b (m, 3)"""
+    diff = a[:, None, :] - b[None, :, :]
+    return np.all(np.abs(diff - np.round(diff)) < atol, axis=-1)
+
+
+def _periodic_tree(frac_coords):
+    wrapped = frac_coords % 1.
+    # a tiny negative coordinate wraps to 1.
+    wrapped[wrapped >= 1.] = 0.
+    return cKDTree(wrapped, boxsize=1.)
+
+
+@functools.lru_cache(maxsize=256)
+def _symops(xyz_strings, atol=1e-6):
+    """
+    Affine matrices of the operations, which must form a group modulo
+    lattice translations. A group maps no image of one site onto an image
+    of another one, so the images only have to be deduplicated per site.
+    """
+    affines = np.stack([_affine(xyz) for xyz in xyz_strings])
+    rot, trans = affines[:, :3, :3], affines[:, :3, 3]
+    product_rot = np.einsum('aij,bjk->abik', rot, rot).reshape(-1, 9)
+    product_trans = (np.einsum('aij,bj->abi', rot, trans)
+                     + trans[:, None, :]).reshape(-1, 3)
+    same_rot = np.all(np.abs(product_rot[:, None, :] -
+                             rot.reshape(1, -1, 9)) < atol, axis=-1)
+    same_trans = _close_pbc(product_trans, trans, atol)
+    if not np.all(np.any(same_rot & same_trans, axis=1)):
+        raise UnsupportedCIF('symmetry operations do not form a group')
+    return affines
+
+
+def read_cif(text, site_tolerance=1e-4, frac_tolerance=1e-4):
+    """
+    Read a CIF without pymatgen for the common case: the six cell
+    parameters, the symmetry operations as xyz strings and an
+    _atom_site_fract loop of plain elements with full occupancies.
+
+    The sites are the ones Structure.from_file gives, in the same order:
+    each site of the loop is expanded by the symmetry operations, images
+    within site_tolerance are merged, and the sites are sorted by the
+    electronegativity of their element. Coordinates within frac_tolerance
+    of 1/3 or 2/3 are set to it first, as pymatgen does.
+
+    Raises UnsupportedCIF for anything else, e.g. partial occupancies,
+    oxidation states or magnetic CIFs.
+
+    Returns
+    -------
+
+    lattice_matrix: np.ndarray shape (3, 3)
+    atomic_numbers: np.ndarray shape (n, )
+    frac_coords: np.ndarray shape (n, 3)
+    """
+    data = parse_block(text)
+    for tag in data:
+        if tag.startswith(UNSUPPORTED_PREFIXES):
+            raise UnsupportedCIF('unsupported tag {}'.format(tag))
+    try:
+        params = [_float(data[tag]) for tag in CELL_TAGS]
+        xs = [data['_atom_site_fract_{}'.format(axis)] for axis in 'xyz']
+    except KeyError as error:
+        raise UnsupportedCIF('missing {}'.format(error))
+    if any(isinstance(value, str) for value in xs):
+        raise UnsupportedCIF('atom sites outside a loop')
+    symbols = data.get('_atom_site_type_symbol',
+                       data.get('_atom_site_label'))
+    if symbols is None or isinstance(symbols, str):
+        raise UnsupportedCIF('no atom site symbols')
+    for occupancy in data.get('_atom_site_occupancy', ()):
+        if _float(occupancy) != 1:
+            raise UnsupportedCIF('partial occupancy')
+    xyz_strings = None
+    for tag in SYMOP_TAGS:
+        if data.get(tag):
+            xyz_strings = data[tag]
+            break
+    if xyz_strings is None:
+        # pymatgen would generate the operations from the space group
+        raise UnsupportedCIF('no symmetry operations')
+    if isinstance(xyz_strings, str):
+        xyz_strings = [xyz_strings]
+    affines = _symops(tuple(xyz_strings))
+
+    lattice_matrix = Lattice.from_parameters(*params).matrix
+    # the spacings of the (100), (010) and (001) planes, which pymatgen
+    # requires to be at least 0.01 A
+    if np.max(np.linalg.norm(np.linalg.inv(lattice_matrix), axis=0)) > 100:
+        raise UnsupportedCIF('lattice too thin')
+    elements = [_element(symbol) for symbol in symbols]
+    coords = np.array([[_float(x) for x in column] for column in xs]).T
+    if len(coords) == 0:
+        raise UnsupportedCIF('no atom sites')
+    for ideal in (1 / 3, 2 / 3):
+        coords[np.abs(coords / ideal - 1) <= frac_tolerance] = ideal
+
+    # pymatgen merges a site that any operation maps onto an earlier one
+    # into a disordered site
+    homogeneous = np.hstack([coords, np.ones((len(coords), 1))])
+    images = np.einsum('kij,nj->kni', affines, homogeneous)[..., :3]
+    flat_images = images.reshape(-1, 3)
+    if len(flat_images) * len(coords) <= 1 << 16:
+        image_idx, site = np.nonzero(_close_pbc(flat_images, coords,
+                                                site_tolerance))
+    else:
+        pairs = _periodic_tree(flat_images).sparse_distance_matrix(
+            _periodic_tree(coords), site_tolerance, p=np.inf,
+            output_type='ndarray')
+        image_idx, site = pairs['i'], pairs['j']
+        diff = flat_images[image_idx] - coords[site]
+        exact = np.all(np.abs(diff - np.round(diff)) < site_tolerance, axis=1)
+        image_idx, site = image_idx[exact], site[exact]
+    if np.any(site < image_idx % len(coords)):
+        raise UnsupportedCIF('overlapping sites')
+
+    # the images of a site in operation order, without the ones that an
+    # earlier operation already gave
+    images = np.swapaxes(images - np.floor(images), 0, 1)
+    n_ops = len(affines)
+    keep = np.ones(images.shape[:2], dtype=bool)
+    if n_ops > 1:
+        earlier = np.tri(n_ops, k=-1, dtype=bool)
+        step = max(1, 2 ** 20 // n_ops ** 2)
+        for start in range(0, len(images), step):
+            diff = images[start:start + step, :, None] - \
+                images[start:start + step, None, :]
+            close = np.all(np.abs(diff - np.round(diff)) < site_tolerance,
+                           axis=-1)
+            keep[start:start + step] = ~np.any(close & earlier, axis=-1)
+    numbers = np.array([number for number, _ in elements], dtype=np.int64)
+    sites = sorted(range(len(elements)), key=lambda i: elements[i][1])
+    return (lattice_matrix,
+            np.repeat(numbers[sites], keep[sites].sum(axis=1)),
+            images[sites][keep[sites]])
+
+
+class CrystalArrays(object):
+    """
+    Lattice, atomic numbers and fractional coordinates of a crystal, enough
+    for the cell list neighbor search without building a Structure.
+
+    Parameters
+    ----------
+
+    lattice_matrix: np.ndarray shape (3, 3)
+    atomic_numbers: np.ndarray shape (n, )
+    frac_coords: np.ndarray shape (n, 3)
+    structure: pymatgen.core.structure.Structure or None
+      The structure when it is already built
+    """
+    def __init__(self, lattice_matrix, atomic_numbers, frac_coords,
+                 structure=None):
+        self.lattice = Lattice(lattice_matrix)
+        self.atomic_numbers = atomic_numbers
+        self.frac_coords = frac_coords
+        self.structure = structure
+
+    def __len__(self):
+        return len(self.atomic_numbers)
+
+    def to_structure(self):
+        if self.structure is None:
+            self.structure = Structure(self.lattice, self.atomic_numbers,
+                                       self.frac_coords)
+        return self.structure
+
+
+def load_crystal(cif_path):
+    """
+    Read a CIF file with read_cif, or with Structure.from_file when
+    read_cif does not support it.
+
+    Returns
+    -------
+
+    crystal: CrystalArrays
+    """
+    with open(cif_path) as f:
+        text = f.read()
+    try:
+        return CrystalArrays(*read_cif(text))
+    except UnsupportedCIF:
+        structure = Structure.from_file(cif_path)
+        return CrystalArrays(structure.lattice.matrix,
+                             np.array(structure.atomic_numbers,
+                                      dtype=np.int64),
+                             structure.frac_coords, structure)
+
+
+def check_cif_parity(cif_path, atol=1e-8):
+    """
+    Compare read_cif with Structure.from_file on one file.
+
+    Returns
+    -------
+
+    result: str
+      'fast' if both agree, 'fallback' if read_cif does not support the
+      file, 'MISMATCH' otherwise
+    """
+    with open(cif_path) as f:
+        text = f.read()
+    try:
+        lattice_matrix, atomic_numbers, frac_coords = read_cif(text)
+    except UnsupportedCIF:
+        return 'fallback'
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        try:
+            reference = Structure.from_str(text, fmt='cif')
+        except ValueError:
+            return 'MISMATCH'
+    diff = frac_coords - reference.frac_coords if \
+        len(frac_coords) == len(reference) else None
+    if diff is None or \
+            not np.allclose(lattice_matrix, reference.lattice.matrix,
+                            rtol=0, atol=atol) or \
+            tuple(atomic_numbers) != tuple(reference.atomic_numbers) or \
+            not np.allclose(diff - np.round(diff), 0, atol=atol):
+        return 'MISMATCH'
+    return 'fast'
+
+
+if __name__ == '__main__':
+    import argparse
+    import glob
+    import time
+
+    parser = argparse.ArgumentParser(
+        description='Check read_cif against pymatgen and time both')
+    parser.add_argument('cif_glob', help='CIF files, e.g. "root_dir/*.cif"')
+    args = parser.parse_args()
+    cif_paths = sorted(glob.glob(args.cif_glob))
+    results = {}
+    for cif_path in cif_paths:
+        result = check_cif_parity(cif_path)
+        results.setdefault(result, []).append(cif_path)
+        if result == 'MISMATCH':
+            print('{}: MISMATCH'.format(cif_path))
+    print(', '.join('{} {}'.format(len(paths), result)
+                    for result, paths in sorted(results.items())))
+    # the time of the files read_cif supports, the others take as long as
+    # with pymatgen
+    fast_paths = results.get('fast', [])
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for name, load in [('pymatgen', Structure.from_file),
+                           ('read_cif', load_crystal)]:
+            start = time.perf_counter()
+            for cif_path in fast_paths:
+                load(cif_path)
+            print('{}: {:.2f} ms per file'.format(
+                name, (time.perf_counter() - start) * 1e3 /
+                max(len(fast_paths), 1)))
@@ -9,16 +9,21 @@ import warnings
 
 import numpy as np
 import torch
-from pymatgen.core.structure import Structure
 from torch.utils.data import Dataset, DataLoader
 from torch.utils.data.dataloader import default_collate
 from torch.utils.data.sampler import SubsetRandomSampler
 
+from .cif_reader import load_crystal
+from .neighbors import NBR_SEARCHES
+from .utils import reset_peak_rss, rss
+
 
 def get_train_val_test_loader(dataset, collate_fn=default_collate,
                               batch_size=64, train_ratio=None,
                               val_ratio=0.1, test_ratio=0.1, return_test=False,
-                              num_workers=1, pin_memory=False, **kwargs):
+                              num_workers=1, pin_memory=False,
+                              num_replicas=1, rank=0, persistent_workers=False,
+                              **kwargs):
     """
     Utility function for dividing a dataset to train, val, test datasets.
 
@@ -38,6 +43,13 @@ def get_train_val_test_loader(dataset, collate_fn=default_collate,
       data will be hidden.
     num_workers: int
     pin_memory: bool
+    num_replicas: int
+      Number of data parallel processes. Each process samples an equal,
+      disjoint share of the training data.
+    rank: int
+      Rank of this process among the num_replicas processes
+    persistent_workers: bool
+      Keep the workers alive between epochs
 
     Returns
     -------
@@ -71,7 +83,13 @@ def get_train_val_test_loader(dataset, collate_fn=default_collate,
         valid_size = kwargs['val_size']
     else:
         valid_size = int(val_ratio * total_size)
-    train_sampler = SubsetRandomSampler(indices[:train_size])
+    train_indices = indices[:train_size]
+    if num_replicas > 1:
+        # same number of batches on every rank
+        train_indices = train_indices[rank::num_replicas][
+            :train_size // num_replicas]
+    train_sampler = SubsetRandomSampler(train_indices)
+    persistent_workers = persistent_workers and num_workers > 0
     val_sampler = SubsetRandomSampler(
         indices[-(valid_size + test_size):-test_size])
     if return_test:
@@ -79,11 +97,13 @@ def get_train_val_test_loader(dataset, collate_fn=default_collate,
     train_loader = DataLoader(dataset, batch_size=batch_size,
                               sampler=train_sampler,
                               num_workers=num_workers,
-                              collate_fn=collate_fn, pin_memory=pin_memory)
+                              collate_fn=collate_fn, pin_memory=pin_memory,
+                              persistent_workers=persistent_workers)
     val_loader = DataLoader(dataset, batch_size=batch_size,
                             sampler=val_sampler,
                             num_workers=num_workers,
-                            collate_fn=collate_fn, pin_memory=pin_memory)
+                            collate_fn=collate_fn, pin_memory=pin_memory,
+                            persistent_workers=persistent_workers)
     if return_test:
         test_loader = DataLoader(dataset, batch_size=batch_size,
                                  sampler=test_sampler,
@@ -109,6 +129,7 @@ def collate_pool(dataset_list):
       atom_fea: torch.Tensor shape (n_i, atom_fea_len)
       nbr_fea: torch.Tensor shape (n_i, M, nbr_fea_len)
       nbr_fea_idx: torch.LongTensor shape (n_i, M)
+      multiplicity: torch.Tensor shape (n_i, ), optional
       target: torch.Tensor shape (1, )
       cif_id: str or int
 
@@ -124,17 +145,21 @@ def collate_pool(dataset_list):
       Indices of M neighbors of each atom
     crystal_atom_idx: list of torch.LongTensor of length N0
       Mapping from the crystal idx to atom idx
+    batch_multiplicity: torch.Tensor shape (N, )
+      Only if the data points have multiplicities (CIFData with
+      symmetry_reduce=True)
     target: torch.Tensor shape (N, 1)
       Target value for prediction
     batch_cif_ids: list
     """
     batch_atom_fea, batch_nbr_fea, batch_nbr_fea_idx = [], [], []
     crystal_atom_idx, batch_target = [], []
-    batch_cif_ids = []
+    batch_cif_ids, batch_multiplicity = [], []
     base_idx = 0
-    for i, ((atom_fea, nbr_fea, nbr_fea_idx), target, cif_id)\
+    for i, ((atom_fea, nbr_fea, nbr_fea_idx, *multiplicity), target, cif_id)\
             in enumerate(dataset_list):
         n_i = atom_fea.shape[0]  # number of atoms for this crystal
+        batch_multiplicity += multiplicity
         batch_atom_fea.append(atom_fea)
         batch_nbr_fea.append(nbr_fea)
         batch_nbr_fea_idx.append(nbr_fea_idx+base_idx)
@@ -146,11 +171,88 @@ def collate_pool(dataset_list):
     return (torch.cat(batch_atom_fea, dim=0),
             torch.cat(batch_nbr_fea, dim=0),
             torch.cat(batch_nbr_fea_idx, dim=0),
-            crystal_atom_idx),\
+            crystal_atom_idx) + _cat_multiplicity(batch_multiplicity),\
         torch.stack(batch_target, dim=0),\
         batch_cif_ids
 
 
+def _cat_multiplicity(batch_multiplicity):
+    return (torch.cat(batch_multiplicity, dim=0),) if batch_multiplicity \
+        else ()
+
+
+def collate_sparse_pool(dataset_list):
+    """
+    Collate a list of sparse crystal graphs (CIFData with sparse=True) and
+    return a batch for predicting crystal properties.
+
+    Parameters
+    ----------
+
+    dataset_list: list of tuples for each data point.
+      (atom_fea, nbr_fea, edge_idx, target)
+
+      atom_fea: torch.Tensor shape (n_i, atom_fea_len)
+      nbr_fea: torch.Tensor shape (e_i, nbr_fea_len)
+      edge_idx: torch.LongTensor shape (2, e_i)
+      multiplicity: torch.Tensor shape (n_i, ), optional
+      target: torch.Tensor shape (1, )
+      cif_id: str or int
+
+    Returns
+    -------
+    N = sum(n_i); E = sum(e_i); N0 = sum(i)
+
+    batch_atom_fea: torch.Tensor shape (N, orig_atom_fea_len)
+      Atom features from atom type
+    batch_nbr_fea: torch.Tensor shape (E, nbr_fea_len)
+      Bond features of each edge
+    batch_edge_idx: torch.LongTensor shape (2, E)
+      Center (row 0) and neighbor (row 1) atom indices of each edge
+    crystal_atom_idx: list of torch.LongTensor of length N0
+      Mapping from the crystal idx to atom idx
+    batch_multiplicity: torch.Tensor shape (N, )
+      Only if the data points have multiplicities (CIFData with
+      symmetry_reduce=True)
+    target: torch.Tensor shape (N, 1)
+      Target value for prediction
+    batch_cif_ids: list
+    """
+    batch_atom_fea, batch_nbr_fea, batch_edge_idx = [], [], []
+    crystal_atom_idx, batch_target = [], []
+    batch_cif_ids, batch_multiplicity = [], []
+    base_idx = 0
+    for i, ((atom_fea, nbr_fea, edge_idx, *multiplicity), target, cif_id)\
+            in enumerate(dataset_list):
+        n_i = atom_fea.shape[0]  # number of atoms for this crystal
+        batch_multiplicity += multiplicity
+        batch_atom_fea.append(atom_fea)
+        batch_nbr_fea.append(nbr_fea)
+        batch_edge_idx.append(edge_idx+base_idx)
+        new_idx = torch.LongTensor(np.arange(n_i)+base_idx)
+        crystal_atom_idx.append(new_idx)
+        batch_target.append(target)
+        batch_cif_ids.append(cif_id)
+        base_idx += n_i
+    return (torch.cat(batch_atom_fea, dim=0),
+            torch.cat(batch_nbr_fea, dim=0),
+            torch.cat(batch_edge_idx, dim=1),
+            crystal_atom_idx) + _cat_multiplicity(batch_multiplicity),\
+        torch.stack(batch_target, dim=0),\
+        batch_cif_ids
+
+
+def truncate_neighbors(input, max_num_nbr):
+    """
+    Keep the max_num_nbr nearest neighbors of every atom of a collate_pool
+    batch. The padded neighbors are distance sorted with the padding last,
+    so this is the batch of a dataset built with the smaller max_num_nbr.
+    """
+    atom_fea, nbr_fea, nbr_fea_idx = input[:3]
+    return (atom_fea, nbr_fea[:, :max_num_nbr], nbr_fea_idx[:, :max_num_nbr]) \
+        + tuple(input[3:])
+
+
 class GaussianDistance(object):
     """
     Expands the distance by Gaussian basis.
@@ -192,8 +294,12 @@ class GaussianDistance(object):
           Expanded distance matrix with the last dimension of length
           len(self.filter)
         """
-        return np.exp(-(distances[..., np.newaxis] - self.filter)**2 /
-                      self.var**2)
+        expanded = np.exp(-(distances[..., np.newaxis] - self.filter)**2 /
+                          self.var**2)
+        # values that would be subnormal as float32 make the CPU matrix
+        # products many times slower, they are zero for the model
+        expanded[expanded < np.finfo(np.float32).tiny] = 0.
+        return expanded
 
 
 class AtomInitializer(object):
@@ -210,11 +316,36 @@ class AtomInitializer(object):
         assert atom_type in self.atom_types
         return self._embedding[atom_type]
 
+    def get_atom_feas(self, atom_types):
+        """
+        Features of an array of integer atom types (atomic numbers) in one
+        fancy-index of the contiguous table.
+
+        Returns
+        -------
+
+        atom_fea: np.ndarray shape (n, atom_fea_len)
+        """
+        atom_types = np.asarray(atom_types, dtype=np.int64)
+        assert np.all(atom_types < len(self.known)) and \
+            np.all(self.known[atom_types]), 'unknown atom type'
+        return self.table[atom_types]
+
+    def _build_table(self):
+        """Stack the features into a (max atom type + 1, atom_fea_len) array"""
+        atom_types = sorted(self._embedding)
+        self.table = np.zeros((atom_types[-1] + 1,
+                               len(self._embedding[atom_types[0]])))
+        self.known = np.zeros(atom_types[-1] + 1, dtype=bool)
+        self.table[atom_types] = [self._embedding[key] for key in atom_types]
+        self.known[atom_types] = True
+
     def load_state_dict(self, state_dict):
         self._embedding = state_dict
         self.atom_types = set(self._embedding.keys())
         self._decodedict = {idx: atom_type for atom_type, idx in
                             self._embedding.items()}
+        self._build_table()
 
     def state_dict(self):
         return self._embedding
@@ -247,6 +378,112 @@ class AtomCustomJSONInitializer(AtomInitializer):
         super(AtomCustomJSONInitializer, self).__init__(atom_types)
         for key, value in elem_embedding.items():
             self._embedding[key] = np.array(value, dtype=float)
+        self._build_table()
+
+
+def pad_neighbors(nbr_idx, nbr_dist, max_num_nbr, radius):
+    """
+    Pad the neighbor lists of all atoms to max_num_nbr entries with index 0
+    and distance radius + 1.
+
+    Returns
+    -------
+
+    nbr_fea_idx: np.ndarray shape (n_i, M)
+    nbr_fea: np.ndarray shape (n_i, M)
+      Neighbor distances
+    nbr_count: np.ndarray shape (n_i, )
+      Number of real neighbors of each atom
+    """
+    nbr_fea_idx = np.zeros((len(nbr_idx), max_num_nbr), dtype=np.int64)
+    nbr_fea = np.full((len(nbr_idx), max_num_nbr), radius + 1.)
+    nbr_count = np.zeros(len(nbr_idx), dtype=np.int64)
+    for i, (idx, dist) in enumerate(zip(nbr_idx, nbr_dist)):
+        nbr_fea_idx[i, :len(idx)] = idx[:max_num_nbr]
+        nbr_fea[i, :len(idx)] = dist[:max_num_nbr]
+        nbr_count[i] = min(len(idx), max_num_nbr)
+    return nbr_fea_idx, nbr_fea, nbr_count
+
+
+def equivalent_atoms(atom_fea, nbr_idx, nbr_dist, tolerance=1e-5):
+    """
+    Classes of atoms that get identical features in every ConvLayer.
+
+    The atoms are colored by their features and the colors are refined by
+    the sorted (distance, neighbor color) pairs of every atom until no class
+    splits any more. Atoms of one color then have the same features and the
+    same multiset of neighbor features and distances at every layer, by
+    induction, which covers the atoms of a Wyckoff orbit as well as the
+    choice among equidistant neighbors of the truncated graph. Distances
+    that differ by less than tolerance (in A) are taken as equal, as the
+    coordinates of equivalent atoms are only written to a few decimals.
+
+    Returns
+    -------
+
+    orbit: np.ndarray shape (n_i, )
+      Class of every atom, numbered in the order of their first atom
+    """
+    n = len(nbr_idx)
+    colors = np.unique(np.asarray(atom_fea).reshape(n, -1), axis=0,
+                       return_inverse=True)[1].reshape(-1)
+    degree = np.array([len(idx) for idx in nbr_idx], dtype=np.int64)
+    bounds = np.concatenate([[0], np.cumsum(degree)])
+    center = np.repeat(np.arange(n), degree)
+    nbr = np.concatenate(nbr_idx).astype(np.int64)
+    # number the distances by clusters with gaps below tolerance
+    dist = np.concatenate(nbr_dist)
+    order = np.argsort(dist, kind='stable')
+    dist_label = np.empty(len(dist), dtype=np.int64)
+    dist_label[order] = np.cumsum(
+        np.diff(dist[order], prepend=dist[order[:1]]) > tolerance)
+    n_colors = colors.max() + 1
+    while True:
+        # signature of an atom: its color, degree and sorted pairs
+        order = np.lexsort((colors[nbr], dist_label, center))
+        rank = np.arange(len(center)) - bounds[center[order]]
+        signature = np.full((n, 2 + 2 * max(degree.max(), 1)), -1,
+                            dtype=np.int64)
+        signature[:, 0], signature[:, 1] = colors, degree
+        signature[center[order], 2 + 2 * rank] = dist_label[order]
+        signature[center[order], 3 + 2 * rank] = colors[nbr[order]]
+        colors = np.unique(signature, axis=0,
+                           return_inverse=True)[1].reshape(-1)
+        # the signature holds the old color, so classes only split
+        if colors.max() + 1 == n_colors:
+            break
+        n_colors = colors.max() + 1
+    _, first, colors = np.unique(colors, return_index=True,
+                                 return_inverse=True)
+    # renumber the classes by their first atom
+    return np.argsort(np.argsort(first))[colors.reshape(-1)]
+
+
+def reduce_equivalent_atoms(atom_fea, nbr_idx, nbr_dist, tolerance=1e-5):
+    """
+    Keep the first atom of every class of equivalent_atoms, with the
+    neighbor indices remapped to the kept atoms and the size of each class
+    as its multiplicity.
+
+    The mean of the atom features over the crystal is the mean over the
+    kept atoms weighted by their multiplicity, so an evaluation-mode model
+    given the multiplicities (CrystalGraphConvNet.forward atom_weights)
+    predicts the same as on the full graph with a fraction of the work.
+    Atom 0 is always kept as atom 0, which the padded neighbors point to.
+
+    Returns
+    -------
+
+    atom_fea: np.ndarray shape (r_i, ...)
+    nbr_idx: list of np.ndarray of length r_i
+    nbr_dist: list of np.ndarray of length r_i
+    multiplicity: np.ndarray shape (r_i, )
+    """
+    orbit = equivalent_atoms(atom_fea, nbr_idx, nbr_dist, tolerance)
+    _, kept, multiplicity = np.unique(orbit, return_index=True,
+                                      return_counts=True)
+    return (atom_fea[kept], [orbit[nbr_idx[i]] for i in kept],
+            [nbr_dist[i] for i in kept], multiplicity)
 
 
 class CIFData(Dataset):
@@ -287,20 +524,55 @@ class CIFData(Dataset):
         The step size for constructing GaussianDistance
     random_seed: int
         Random seed for shuffling the dataset
+    sparse: bool
+        Store only the real edges of each atom as an edge list instead of
+        padding every atom to max_num_nbr neighbors. Use collate_sparse_pool
+        to batch the sparse graphs. With max_num_nbr=None all neighbors
+        within radius are kept.
+    atom_numbers: bool
+        Return the atomic numbers instead of the atom features, for a model
+        with a precomputed embedding table
+        (CrystalGraphConvNet.precompute_embedding)
+    nbr_search: str
+        Neighbor search backend, one of NBR_SEARCHES. 'radius' searches all
+        neighbors within radius, 'knn' grows the cutoff per atom only until
+        max_num_nbr neighbors are found and gives the same graph, and
+        'cell_list' is a NumPy cell-list search that scales linearly with
+        the number of atoms for large supercells.
+    symmetry_reduce: bool
+        Keep one atom per class of equivalent atoms (reduce_equivalent_atoms)
+        and return the multiplicities as a fourth graph tensor, for
+        inference only. Symmetry-equivalent atoms share their features at
+        every layer, so high-symmetry cells shrink by the orbit sizes.
 
     Returns
     -------
 
     atom_fea: torch.Tensor shape (n_i, atom_fea_len)
+      or atomic numbers torch.LongTensor shape (n_i, ) if atom_numbers
     nbr_fea: torch.Tensor shape (n_i, M, nbr_fea_len)
+      or shape (e_i, nbr_fea_len) if sparse
     nbr_fea_idx: torch.LongTensor shape (n_i, M)
+      or edge_idx: torch.LongTensor shape (2, e_i) if sparse
+    multiplicity: torch.Tensor shape (n_i, ), only if symmetry_reduce
     target: torch.Tensor shape (1, )
     cif_id: str or int
     """
     def __init__(self, root_dir, max_num_nbr=12, radius=8, dmin=0, step=0.2,
-                 random_seed=123):
+                 random_seed=123, sparse=False, nbr_search='radius',
+                 atom_numbers=False, symmetry_reduce=False):
         self.root_dir = root_dir
+        self.atom_numbers = atom_numbers
+        self.symmetry_reduce = symmetry_reduce
         self.max_num_nbr, self.radius = max_num_nbr, radius
+        self.sparse = sparse
+        assert sparse or max_num_nbr is not None, \
+            'max_num_nbr is required for the padded graph'
+        assert nbr_search in NBR_SEARCHES, \
+            'nbr_search must be one of {}'.format(sorted(NBR_SEARCHES))
+        assert nbr_search == 'radius' or max_num_nbr is not None, \
+            'max_num_nbr is required for the {} search'.format(nbr_search)
+        self.nbr_search = nbr_search
         assert os.path.exists(root_dir), 'root_dir does not exist!'
         id_prop_file = os.path.join(self.root_dir, 'id_prop.csv')
         assert os.path.exists(id_prop_file), 'id_prop.csv does not exist!'
@@ -313,6 +585,7 @@ class CIFData(Dataset):
         atom_init_file = os.path.join(self.root_dir, 'atom_init.json')
         assert os.path.exists(atom_init_file), 'atom_init.json does not exist!'
         self.ari = AtomCustomJSONInitializer(atom_init_file)
+        self.dmin, self.step = dmin, step
         self.gdf = GaussianDistance(dmin=dmin, dmax=self.radius, step=step)
 
     def __len__(self):
@@ -320,33 +593,393 @@ class CIFData(Dataset):
 
     def __getitem__(self, idx):
         cif_id, target = self.id_prop_data[idx]
-        crystal = Structure.from_file(os.path.join(self.root_dir,
-                                                 f'{cif_id}'))
-        atom_fea = np.vstack([self.ari.get_atom_fea(crystal[i].specie.number)
-                             for i in range(len(crystal))])
-        atom_fea = torch.Tensor(atom_fea)
-        all_nbrs = crystal.get_all_neighbors(self.radius, include_index=True)
-        all_nbrs = [sorted(nbrs, key=lambda x: x[1]) for nbrs in all_nbrs]
-        nbr_fea_idx, nbr_fea = [], []
-        for nbr in all_nbrs:
-            if len(nbr) < self.max_num_nbr:
-                warnings.warn('{} not find enough neighbors to build graph. '
-                            'If it happens frequently, consider increase '
-                            'radius.'.format(cif_id))
-                nbr_fea_idx.append(list(map(lambda x: x[2], nbr)) +
-                                 [0] * (self.max_num_nbr - len(nbr)))
-                nbr_fea.append(list(map(lambda x: x[1], nbr)) +
-                             [self.radius + 1.] * (self.max_num_nbr -
-                                                 len(nbr)))
-            else:
-                nbr_fea_idx.append(list(map(lambda x: x[2],
-                                          nbr[:self.max_num_nbr])))
-                nbr_fea.append(list(map(lambda x: x[1],
-                                      nbr[:self.max_num_nbr])))
-        nbr_fea_idx, nbr_fea = np.array(nbr_fea_idx), np.array(nbr_fea)
+        atom_fea, nbr_idx, nbr_dist = self.featurize(idx)
+        if self.symmetry_reduce:
+            atom_fea, nbr_idx, nbr_dist, multiplicity = \
+                reduce_equivalent_atoms(atom_fea, nbr_idx, nbr_dist)
+        if self.atom_numbers:
+            atom_fea = torch.LongTensor(atom_fea)
+        else:
+            atom_fea = torch.Tensor(atom_fea)
+        target = torch.Tensor([float(target)])
+        if self.sparse:
+            graph = self._sparse_graph(atom_fea, nbr_idx, nbr_dist)
+        else:
+            graph = self._dense_graph(cif_id, atom_fea, nbr_idx, nbr_dist)
+        if self.symmetry_reduce:
+            graph += (torch.Tensor(multiplicity),)
+        return graph, target, cif_id
+
+    def featurize(self, idx):
+        """
+        Parse a crystal and search the neighbors of its atoms.
+
+        Returns
+        -------
+
+        atom_fea: np.ndarray shape (n_i, atom_fea_len)
+          or atomic numbers shape (n_i, ) if atom_numbers
+        nbr_idx: list of np.ndarray of length n_i
+          Indices of the neighbors of each atom, sorted by distance
+        nbr_dist: list of np.ndarray of length n_i
+          Distances of the neighbors of each atom
+        """
+        cif_id, _ = self.id_prop_data[idx]
+        crystal = load_crystal(os.path.join(self.root_dir, f'{cif_id}'))
+        atom_fea = crystal.atomic_numbers
+        if not self.atom_numbers:
+            atom_fea = self.ari.get_atom_feas(atom_fea)
+        # the cell list search only needs the arrays
+        if self.nbr_search != 'cell_list':
+            crystal = crystal.to_structure()
+        nbr_idx, nbr_dist = NBR_SEARCHES[self.nbr_search](
+            crystal, self.radius, self.max_num_nbr)
+        return atom_fea, nbr_idx, nbr_dist
+
+    def _dense_graph(self, cif_id, atom_fea, nbr_idx, nbr_dist):
+        """
+        Pad the distance sorted neighbors of each atom to max_num_nbr.
+
+        Returns
+        -------
+
+        atom_fea: torch.Tensor shape (n_i, atom_fea_len)
+        nbr_fea: torch.Tensor shape (n_i, M, nbr_fea_len)
+        nbr_fea_idx: torch.LongTensor shape (n_i, M)
+        """
+        nbr_fea_idx, nbr_fea, nbr_count = pad_neighbors(
+            nbr_idx, nbr_dist, self.max_num_nbr, self.radius)
+        for _ in range(np.sum(nbr_count < self.max_num_nbr)):
+            warnings.warn('{} not find enough neighbors to build graph. '
+                        'If it happens frequently, consider increase '
+                        'radius.'.format(cif_id))
         nbr_fea = self.gdf.expand(nbr_fea)
-        atom_fea = torch.Tensor(atom_fea)
         nbr_fea = torch.Tensor(nbr_fea)
         nbr_fea_idx = torch.LongTensor(nbr_fea_idx)
+        return atom_fea, nbr_fea, nbr_fea_idx
+
+    def _sparse_graph(self, atom_fea, nbr_idx, nbr_dist):
+        """
+        Build the edge list of a crystal from its distance sorted neighbors.
+
+        Returns
+        -------
+
+        atom_fea: torch.Tensor shape (n_i, atom_fea_len)
+        nbr_fea: torch.Tensor shape (e_i, nbr_fea_len)
+        edge_idx: torch.LongTensor shape (2, e_i)
+        """
+        center_idx = np.repeat(np.arange(len(nbr_idx)),
+                               [len(idx) for idx in nbr_idx])
+        nbr_idx = np.concatenate(nbr_idx).astype(np.int64)
+        nbr_dist = np.concatenate(nbr_dist).astype(float)
+        nbr_fea = torch.Tensor(self.gdf.expand(nbr_dist))
+        edge_idx = torch.LongTensor(np.vstack([center_idx, nbr_idx]))
+        return atom_fea, nbr_fea, edge_idx
+
+
+class _FeaturizedView(Dataset):
+    """Expose CIFData.featurize so that it can run in DataLoader workers"""
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        cif_id, target = self.dataset.id_prop_data[idx]
+        atom_fea, nbr_idx, nbr_dist = self.dataset.featurize(idx)
+        nbr_fea_idx, nbr_fea, nbr_count = pad_neighbors(
+            nbr_idx, nbr_dist, self.dataset.max_num_nbr, self.dataset.radius)
+        return atom_fea, nbr_fea_idx, nbr_fea, nbr_count, target, cif_id
+
+
+def _identity(data):
+    return data
+
+
+def _write_shard(out_dir, shard, crystals):
+    offsets = np.cumsum([0] + [len(crystal[0]) for crystal in crystals])
+    arrays = {'atom_fea': np.float32, 'nbr_idx': np.int32,
+              'nbr_dist': np.float32, 'nbr_count': np.int16}
+    for i, (name, dtype) in enumerate(arrays.items()):
+        np.save(os.path.join(out_dir, f'shard_{shard:05d}_{name}.npy'),
+                np.concatenate([crystal[i] for crystal in crystals])
+                .astype(dtype))
+    np.save(os.path.join(out_dir, f'shard_{shard:05d}_offsets.npy'),
+            offsets.astype(np.int64))
+
+
+def pack_dataset(dataset, out_dir, shard_size=10000, num_workers=0):
+    """
+    Featurize a CIFData dataset once and store it as shards that ShardData
+    memory-maps.
+
+    Each shard holds the concatenated atom features, padded neighbor indices
+    and distances, the number of real neighbors of every atom and the atom
+    offset of every crystal as .npy files. shards.json records the graph
+    settings and the id, target and location of every crystal, in the
+    (shuffled) order of the dataset.
+
+    Parameters
+    ----------
+
+    dataset: CIFData
+      The dataset to pack, max_num_nbr must be set
+    out_dir: str
+      Directory the shards are written to
+    shard_size: int
+      Number of crystals per shard
+    num_workers: int
+      Number of DataLoader workers featurizing the crystals
+    """
+    assert dataset.max_num_nbr is not None, \
+        'max_num_nbr is required to pack a dataset'
+    assert not dataset.atom_numbers, 'shards store the atom features'
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    loader = DataLoader(_FeaturizedView(dataset), batch_size=None,
+                        num_workers=num_workers, collate_fn=_identity)
+    index, crystals = [], []
+    for data in loader:
+        atom_fea, nbr_fea_idx, nbr_fea, nbr_count, target, cif_id = data
+        index.append([cif_id, target, len(index) // shard_size,
+                      len(crystals)])
+        crystals.append((atom_fea, nbr_fea_idx, nbr_fea, nbr_count))
+        if len(crystals) == shard_size:
+            _write_shard(out_dir, index[-1][2], crystals)
+            crystals = []
+    if crystals:
+        _write_shard(out_dir, index[-1][2], crystals)
+    meta = {'max_num_nbr': dataset.max_num_nbr, 'radius': dataset.radius,
+            'dmin': dataset.dmin, 'step': dataset.step,
+            'n_shards': (len(index) + shard_size - 1) // shard_size,
+            'index': index}
+    with open(os.path.join(out_dir, 'shards.json'), 'w') as f:
+        json.dump(meta, f)
+    return len(index)
+
+
+class ShardData(Dataset):
+    """
+    Dataset of crystal graphs packed by pack_dataset. The shards are
+    memory-mapped, so crystals are sliced out of the page cache instead of
+    being parsed from CIF files, and it returns the same data as CIFData.
+    The crystals were packed in the shuffled order of the CIFData, which is
+    kept unless a random_seed is given.
+
+    shard_dir
+    ├── shards.json
+    ├── shard_00000_atom_fea.npy
+    ├── shard_00000_nbr_idx.npy
+    ├── shard_00000_nbr_dist.npy
+    ├── shard_00000_nbr_count.npy
+    ├── shard_00000_offsets.npy
+    ├── ...
+
+    Parameters
+    ----------
+
+    shard_dir: str
+        The directory written by pack_dataset
+    random_seed: int or None
+        Random seed for shuffling the dataset again, None keeps the packed
+        order
+    sparse: bool
+        Return edge lists of the real neighbors, see CIFData
+
+    Returns
+    -------
+
+    atom_fea: torch.Tensor shape (n_i, atom_fea_len)
+    nbr_fea: torch.Tensor shape (n_i, M, nbr_fea_len)
+      or shape (e_i, nbr_fea_len) if sparse
+    nbr_fea_idx: torch.LongTensor shape (n_i, M)
+      or edge_idx: torch.LongTensor shape (2, e_i) if sparse
+    target: torch.Tensor shape (1, )
+    cif_id: str or int
+    """
+    def __init__(self, shard_dir, random_seed=None, sparse=False):
+        self.shard_dir = shard_dir
+        self.sparse = sparse
+        meta_file = os.path.join(shard_dir, 'shards.json')
+        assert os.path.exists(meta_file), 'shards.json does not exist!'
+        with open(meta_file) as f:
+            meta = json.load(f)
+        self.max_num_nbr, self.radius = meta['max_num_nbr'], meta['radius']
+        self.n_shards = meta['n_shards']
+        self.id_prop_data = meta['index']
+        if random_seed is not None:
+            random.seed(random_seed)
+            random.shuffle(self.id_prop_data)
+        self.gdf = GaussianDistance(dmin=meta['dmin'], dmax=self.radius,
+                                    step=meta['step'])
+        self._shards = None
+
+    def __getstate__(self):
+        # reopen the memory maps in each DataLoader worker
+        state = self.__dict__.copy()
+        state['_shards'] = None
+        return state
+
+    def _load_shards(self):
+        names = ['atom_fea', 'nbr_idx', 'nbr_dist', 'nbr_count', 'offsets']
+        self._shards = [{name: np.load(os.path.join(
+                            self.shard_dir, f'shard_{shard:05d}_{name}.npy'),
+                            mmap_mode='r') for name in names}
+                        for shard in range(self.n_shards)]
+
+    def __len__(self):
+        return len(self.id_prop_data)
+
+    def __getitem__(self, idx):
+        if self._shards is None:
+            self._load_shards()
+        cif_id, target, shard, pos = self.id_prop_data[idx]
+        arrays = self._shards[shard]
+        start, end = arrays['offsets'][pos], arrays['offsets'][pos + 1]
+        atom_fea = torch.from_numpy(np.array(arrays['atom_fea'][start:end]))
+        nbr_fea_idx = arrays['nbr_idx'][start:end]
+        nbr_fea = arrays['nbr_dist'][start:end]
         target = torch.Tensor([float(target)])
+        if self.sparse:
+            mask = np.arange(self.max_num_nbr) < \
+                arrays['nbr_count'][start:end, np.newaxis]
+            center_idx = np.nonzero(mask)[0]
+            edge_idx = torch.LongTensor(np.vstack([center_idx,
+                                                   nbr_fea_idx[mask]]))
+            nbr_fea = torch.Tensor(self.gdf.expand(nbr_fea[mask]))
+            return (atom_fea, nbr_fea, edge_idx), target, cif_id
+        nbr_fea = torch.Tensor(self.gdf.expand(nbr_fea))
+        nbr_fea_idx = torch.LongTensor(nbr_fea_idx.astype(np.int64))
         return (atom_fea, nbr_fea, nbr_fea_idx), target, cif_id
+
+
+class MemoryBudgetBatches(object):
+    """
+    Inference batches filled up to a memory budget instead of a fixed number
+    of crystals, so that large cells do not exhaust the memory and small
+    ones are batched by the thousand.
+
+    The crystals are featurized one at a time by a DataLoader and added to
+    the batch while the estimated footprint of the batch stays within
+    max_bytes; a crystal above the budget on its own forms a batch of one.
+    The growth of the peak RSS of the process is measured for every batch
+    and when it exceeds the estimate after the first batch, the later
+    estimates are scaled up by the same factor. A batch that fails to
+    allocate can be put back as two halves with retry_smaller.
+
+    Parameters
+    ----------
+
+    dataset: CIFData, ShardData or a Subset of them
+    collate_fn: collate_pool or collate_sparse_pool
+    footprint: callable
+      (n_atoms, n_edges) -> estimated bytes, e.g.
+      CrystalGraphConvNet.memory_footprint
+    max_bytes: int
+      Memory budget of a batch
+    max_batch_size: int or None
+      Largest number of crystals per batch, None for no limit
+    shuffle, num_workers:
+      As for the DataLoader
+
+    Yields
+    ------
+
+    The collate_fn output of every batch, (input, target, batch_cif_ids)
+    """
+    def __init__(self, dataset, collate_fn, footprint, max_bytes,
+                 max_batch_size=None, shuffle=False, num_workers=0):
+        self.loader = DataLoader(dataset, batch_size=None, shuffle=shuffle,
+                                 num_workers=num_workers,
+                                 collate_fn=_identity)
+        self.collate_fn = collate_fn
+        self.footprint = footprint
+        self.max_bytes = max_bytes
+        self.max_batch_size = max_batch_size
+        # factor from the footprint to the measured memory, only grows
+        self.scale = 1.
+        # (number of crystals, estimated bytes, peak RSS growth) per batch
+        self.history = []
+        self._batch, self._failed, self._queue = None, False, []
+
+    def estimate(self, batch):
+        n_atoms, n_edges = 0, 0
+        for (atom_fea, nbr_fea, *_), _, _ in batch:
+            n_atoms += len(atom_fea)
+            n_edges += nbr_fea.shape[0] * (nbr_fea.shape[1]
+                                           if nbr_fea.dim() == 3 else 1)
+        return self.scale * self.footprint(n_atoms, n_edges)
+
+    def _fill(self, crystals, pending):
+        batch = [pending] if pending is not None else []
+        size = self.estimate(batch)
+        for crystal in crystals:
+            crystal_size = self.estimate([crystal])
+            if batch and (size + crystal_size > self.max_bytes or
+                          len(batch) == self.max_batch_size):
+                return batch, crystal
+            batch.append(crystal)
+            size += crystal_size
+        return batch, None
+
+    def __iter__(self):
+        crystals = iter(self.loader)
+        pending = None
+        self._queue = []
+        while True:
+            if self._queue:
+                batch = self._queue.pop(0)
+            else:
+                batch, pending = self._fill(crystals, pending)
+                if not batch:
+                    return
+            self._batch, self._failed = batch, False
+            estimate = self.estimate(batch)
+            reset_peak_rss()
+            base, _ = rss()
+            yield self.collate_fn(batch)
+            if self._failed:
+                continue
+            _, peak = rss()
+            self.history.append((len(batch), estimate, peak - base))
+            # the first batch also allocates the one-off buffers of torch
+            if len(self.history) > 1 and peak - base > estimate:
+                self.scale *= (peak - base) / estimate
+
+    def retry_smaller(self):
+        """
+        Put the current batch back as two halves and halve the later
+        batches too. Returns False for a single crystal, which cannot be
+        split.
+        """
+        self._failed = True
+        if len(self._batch) < 2:
+            return False
+        half = len(self._batch) // 2
+        self._queue[:0] = [self._batch[:half], self._batch[half:]]
+        self.scale *= 2
+        return True
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Pack a CIF dataset into memory-mapped shards')
+    parser.add_argument('root_dir', help='directory with id_prop.csv, '
+                        'atom_init.json and the CIF files')
+    parser.add_argument('out_dir', help='directory to write the shards to')
+    parser.add_argument('--shard-size', default=10000, type=int,
+                        help='crystals per shard (default: 10000)')
+    parser.add_argument('-j', '--workers', default=0, type=int,
+                        help='number of featurizing workers (default: 0)')
+    parser.add_argument('--nbr-search', default='radius',
+                        choices=sorted(NBR_SEARCHES),
+                        help='neighbor search backend (default: radius)')
+    args = parser.parse_args()
+    n = pack_dataset(CIFData(args.root_dir, nbr_search=args.nbr_search),
+                     args.out_dir, shard_size=args.shard_size,
+                     num_workers=args.workers)
+    print(f'Packed {n} crystals into {args.out_dir}')
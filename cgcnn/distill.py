@@ -0,0 +1,264 @@
+from __future__ import print_function, division
+
+import argparse
+import copy
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+
+from .data import CIFData, collate_pool, truncate_neighbors
+from .model import CrystalGraphConvNet
+from .onnx_export import load_model
+
+STUDENT_KEYS = ('atom_fea_len', 'n_conv', 'h_fea_len', 'max_num_nbr')
+
+
+def parse_student(spec):
+    """
+    Size of a student from 'atom_fea_len,n_conv,h_fea_len,max_num_nbr',
+    e.g. '32,2,64,8'.
+    """
+    values = [int(value) for value in spec.split(',')]
+    assert len(values) == len(STUDENT_KEYS), \
+        'a student is {}'.format(','.join(STUDENT_KEYS))
+    return dict(zip(STUDENT_KEYS, values))
+
+
+def featurize(root_dir, max_num_nbr=12, nbr_search='radius'):
+    """
+    Graphs of the CIFs of root_dir, kept in memory since every student is
+    trained on them for many epochs. The targets of id_prop.csv are only
+    used with labeled, unlabeled structures can have any value there.
+
+    Returns
+    -------
+
+    graphs: list of ((atom_fea, nbr_fea, nbr_fea_idx), target, cif_id)
+    """
+    dataset = CIFData(root_dir, max_num_nbr=max_num_nbr,
+                      nbr_search=nbr_search)
+    return [dataset[i] for i in range(len(dataset))]
+
+
+def predict_graphs(model, graphs, max_num_nbr=None, batch_size=256):
+    """
+    Normalized outputs of a regression model on graphs, with the neighbors
+    truncated to max_num_nbr.
+
+    Returns
+    -------
+
+    outputs: torch.Tensor shape (len(graphs), 1)
+    elapsed: float
+      Seconds spent in the model, without the collation
+    """
+    batches = [input for input, _, _ in DataLoader(
+        graphs, batch_size=batch_size, collate_fn=collate_pool)]
+    if max_num_nbr is not None:
+        batches = [truncate_neighbors(input, max_num_nbr)
+                   for input in batches]
+    model.eval()
+    outputs = []
+    start = time.perf_counter()
+    with torch.no_grad():
+        for input in batches:
+            outputs.append(model(*input))
+    return torch.cat(outputs, dim=0), time.perf_counter() - start
+
+
+def distill_student(teacher_args, graphs, teacher_outputs, train_idx,
+                    val_idx, atom_fea_len, n_conv, h_fea_len, max_num_nbr,
+                    epochs=60, batch_size=64, lr=3e-3, seed=0):
+    """
+    Train a CrystalGraphConvNet student on the normalized outputs of the
+    teacher, keeping the epoch with the smallest validation error.
+
+    Parameters
+    ----------
+
+    teacher_args: argparse.Namespace
+      The args of the teacher checkpoint, n_h and the task are kept
+    graphs: list
+      Graphs of featurize, with at least max_num_nbr neighbors
+    teacher_outputs: torch.Tensor shape (len(graphs), 1)
+      Normalized outputs of the teacher on graphs
+    train_idx, val_idx: list of int
+      Graphs to train on and to select the epoch with, the errors to
+      report need graphs outside both
+    atom_fea_len, n_conv, h_fea_len, max_num_nbr: int
+      Size of the student
+
+    Returns
+    -------
+
+    student: CrystalGraphConvNet
+      In evaluation mode
+    best_error: float
+      Normalized MAE to the teacher on val_idx
+    best_epoch: int
+    """
+    assert epochs > 0, 'at least one epoch is needed'
+    torch.manual_seed(seed)
+    soft = [(graphs[i][0], teacher_outputs[i], graphs[i][2])
+            for i in range(len(graphs))]
+    train_loader = DataLoader([soft[i] for i in train_idx],
+                              batch_size=batch_size, shuffle=True,
+                              collate_fn=collate_pool)
+    val_batches = [(truncate_neighbors(input, max_num_nbr), target)
+                   for input, target, _ in DataLoader(
+                       [soft[i] for i in val_idx], batch_size=256,
+                       collate_fn=collate_pool)]
+    orig_atom_fea_len = graphs[0][0][0].shape[-1]
+    nbr_fea_len = graphs[0][0][1].shape[-1]
+    student = CrystalGraphConvNet(orig_atom_fea_len, nbr_fea_len,
+                                  atom_fea_len=atom_fea_len, n_conv=n_conv,
+                                  h_fea_len=h_fea_len, n_h=teacher_args.n_h)
+    optimizer = torch.optim.Adam(student.parameters(), lr)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, epochs)
+    criterion = nn.MSELoss()
+    best_error, best_epoch, best_state = float('inf'), 0, None
+    for epoch in range(epochs):
+        student.train()
+        for input, target, _ in train_loader:
+            output = student(*truncate_neighbors(input, max_num_nbr))
+            loss = criterion(output, target)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+        scheduler.step()
+        student.eval()
+        with torch.no_grad():
+            errors = torch.cat([torch.abs(student(*input) - target)
+                                for input, target in val_batches])
+        error = float(torch.mean(errors))
+        if error < best_error:
+            best_error, best_epoch = error, epoch + 1
+            best_state = copy.deepcopy(student.state_dict())
+    student.load_state_dict(best_state)
+    student.eval()
+    return student, best_error, best_epoch
+
+
+def save_student(path, student, teacher_path, student_size, best_error,
+                 epoch):
+    """
+    Write a student as a checkpoint of train.py, with the normalizer of the
+    teacher, so that it can replace the teacher in model/. max_num_nbr is
+    stored in the args for predict.py.
+    """
+    checkpoint = torch.load(teacher_path,
+                            map_location=lambda storage, loc: storage)
+    args = dict(checkpoint['args'], **student_size)
+    args['distilled_from'] = os.path.basename(teacher_path)
+    torch.save({'epoch': epoch,
+                'state_dict': student.state_dict(),
+                'best_mae_error': best_error,
+                'normalizer': checkpoint['normalizer'],
+                'args': args}, path)
+
+
+if __name__ == '__main__':
+    import glob
+
+    parser = argparse.ArgumentParser(
+        description='Distill the CGCNN checkpoints into smaller students on '
+        'unlabeled structures and report their speed and accuracy')
+    parser.add_argument('model_dir', help='directory with the '
+                        '*-pre-trained.pth.tar teacher checkpoints')
+    parser.add_argument('root_dir', help='structures to distill on, as in '
+                        'CIFData (id_prop.csv, atom_init.json and the CIFs)')
+    parser.add_argument('output_dir', help='the students are written to '
+                        'output_dir/<student>/ under the teacher file names')
+    parser.add_argument('--students', nargs='+',
+                        default=['64,2,128,12', '32,2,64,12', '32,2,64,8',
+                                 '16,1,32,8'],
+                        help='student sizes as atom_fea_len,n_conv,'
+                        'h_fea_len,max_num_nbr')
+    parser.add_argument('--labeled', action='store_true',
+                        help='the targets of id_prop.csv are labels, also '
+                        'report the errors to them')
+    parser.add_argument('--val-ratio', default=0.1, type=float,
+                        help='structures held out to select the epochs '
+                        '(default: 0.1)')
+    parser.add_argument('--test-ratio', default=0.2, type=float,
+                        help='structures held out to report the errors and '
+                        'the speed (default: 0.2)')
+    parser.add_argument('--epochs', default=60, type=int)
+    parser.add_argument('--batch-size', default=64, type=int)
+    parser.add_argument('--lr', default=3e-3, type=float)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    teachers = [(path,) + load_model(path) for path in sorted(glob.glob(
+        os.path.join(args.model_dir, '*-pre-trained.pth.tar')))]
+    students = [(spec, parse_student(spec)) for spec in args.students]
+    # one featurization with enough neighbors for every model
+    graphs = featurize(args.root_dir, max_num_nbr=max(
+        [getattr(model_args, 'max_num_nbr', 12)
+         for _, _, _, model_args in teachers] +
+        [size['max_num_nbr'] for _, size in students]))
+    order = np.random.RandomState(args.seed).permutation(len(graphs))
+    n_test = int(round(args.test_ratio * len(graphs)))
+    n_val = int(round(args.val_ratio * len(graphs)))
+    assert n_test > 0 and n_val > 0, 'too few structures to hold out'
+    test_idx = order[:n_test].tolist()
+    val_idx = order[n_test:n_test + n_val].tolist()
+    train_idx = order[n_test + n_val:].tolist()
+    # the errors are reported on structures that did not select the epoch
+    test_graphs = [graphs[i] for i in test_idx]
+    labels = torch.stack([target for _, target, _ in test_graphs])
+    print('{} structures, {} to train on, {} to select the epoch, {} to '
+          'test'.format(len(graphs), len(train_idx), len(val_idx),
+                        len(test_idx)))
+
+    for teacher_path, teacher, normalizer, teacher_args in teachers:
+        assert teacher_args.task == 'regression', \
+            'only regression checkpoints can be distilled'
+        teacher_max_nbr = getattr(teacher_args, 'max_num_nbr', 12)
+        teacher_outputs, _ = predict_graphs(teacher, graphs, teacher_max_nbr)
+        # the fastest of a few passes, for stable timings
+        teacher_time = min(predict_graphs(teacher, test_graphs,
+                                          teacher_max_nbr)[1]
+                           for _ in range(3))
+        teacher_pred = normalizer.denorm(teacher_outputs[test_idx])
+        print('\n{}'.format(os.path.basename(teacher_path)))
+        header = ('model           params  structures/s  speedup  '
+                  'MAE to teacher')
+        print(header + ('  MAE to labels' if args.labeled else ''))
+        teacher_row = '{:<14}  {:6d}  {:12.0f}  {:7.1f}  {:14.4f}'.format(
+            'teacher', sum(p.numel() for p in teacher.parameters()),
+            len(test_idx) / teacher_time, 1., 0.)
+        if args.labeled:
+            teacher_row += '  {:13.4f}'.format(
+                float(torch.mean(torch.abs(teacher_pred - labels))))
+        print(teacher_row)
+        for spec, size in students:
+            student, _, epoch = distill_student(
+                teacher_args, graphs, teacher_outputs, train_idx, val_idx,
+                epochs=args.epochs, batch_size=args.batch_size, lr=args.lr,
+                seed=args.seed, **size)
+            outputs, _ = predict_graphs(student, test_graphs,
+                                        size['max_num_nbr'])
+            student_time = min(predict_graphs(student, test_graphs,
+                                              size['max_num_nbr'])[1]
+                               for _ in range(3))
+            student_pred = normalizer.denorm(outputs)
+            error = float(torch.mean(torch.abs(student_pred - teacher_pred)))
+            row = '{:<14}  {:6d}  {:12.0f}  {:7.1f}  {:14.4f}'.format(
+                spec, sum(p.numel() for p in student.parameters()),
+                len(test_idx) / student_time, teacher_time / student_time,
+                error)
+            if args.labeled:
+                row += '  {:13.4f}'.format(
+                    float(torch.mean(torch.abs(student_pred - labels))))
+            print(row)
+            student_dir = os.path.join(args.output_dir, spec.replace(',', '-'))
+            if not os.path.exists(student_dir):
+                os.makedirs(student_dir)
+            save_student(os.path.join(student_dir,
+                                      os.path.basename(teacher_path)),
+                         student, teacher_path, size, error, epoch)
@@ -2,6 +2,7 @@ from __future__ import print_function, division
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 class ConvLayer(nn.Module):
@@ -30,6 +31,94 @@ class ConvLayer(nn.Module):
         self.bn1 = nn.BatchNorm1d(2*self.atom_fea_len)
         self.bn2 = nn.BatchNorm1d(self.atom_fea_len)
         self.softplus2 = nn.Softplus()
+        # memory budget of the neighbor tensors in evaluation mode, None
+        # for no limit (see chunk_rows)
+        self.max_chunk_bytes = None
+        # use the factorized fc_full in evaluation mode (see split_weights)
+        self.factorized = False
+        # blocks of split_weights, kept until the parameters can change
+        self._split = None
+
+    def train(self, mode=True):
+        # the parameters change in training mode, derive the blocks again
+        if mode:
+            self._split = None
+        return super(ConvLayer, self).train(mode)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self._split = None
+        super(ConvLayer, self)._load_from_state_dict(*args, **kwargs)
+
+    def _apply(self, *args, **kwargs):
+        # .to(), .double() etc. move the parameters but not the blocks
+        self._split = None
+        return super(ConvLayer, self)._apply(*args, **kwargs)
+
+    def split_weights(self):
+        """
+        Split fc_full into its self, neighbor and edge blocks, with the
+        evaluation-mode bn1 folded in.
+
+        fc_full is linear in the concatenation (self, neighbor, edge), so
+        the self and neighbor blocks can be applied once per atom and the
+        results gathered per edge; only the edge block is applied to every
+        edge. The blocks are derived from the current parameters on every
+        call, the factorized forward uses the copy of factorized_weights.
+
+        Returns
+        -------
+
+        w_self, w_nbr: torch.Tensor shape (2*atom_fea_len, atom_fea_len)
+        w_edge: torch.Tensor shape (2*atom_fea_len, nbr_fea_len)
+        bias: torch.Tensor shape (2*atom_fea_len, )
+        """
+        scale = self.bn1.weight / torch.sqrt(self.bn1.running_var +
+                                             self.bn1.eps)
+        weight = self.fc_full.weight * scale.unsqueeze(1)
+        bias = (self.fc_full.bias - self.bn1.running_mean) * scale + \
+            self.bn1.bias
+        w_self, w_nbr, w_edge = [w.contiguous() for w in weight.split(
+            [self.atom_fea_len, self.atom_fea_len, self.nbr_fea_len], dim=1)]
+        return w_self, w_nbr, w_edge, bias
+
+    def factorized_weights(self):
+        """
+        split_weights, derived once and kept until the layer is switched to
+        training mode, moved or loaded with new parameters.
+        """
+        if self._split is None:
+            with torch.no_grad():
+                self._split = self.split_weights()
+        return self._split
+
+    def chunk_rows(self, n_rows, row_len, dtype):
+        """
+        Number of atoms (or edges) to convolve at a time so that the
+        intermediate tensors stay within max_chunk_bytes.
+
+        In evaluation mode BatchNorm is a fixed per-feature affine map, so
+        convolving the atoms in chunks gives exactly the same result. In
+        training mode the batch statistics need all atoms at once and the
+        whole batch is one chunk.
+
+        Parameters
+        ----------
+
+        n_rows: int
+          Number of atoms (dense) or edges (sparse)
+        row_len: int
+          Number of neighbor entries per row, M for dense and 1 for sparse
+        """
+        if self.training or self.max_chunk_bytes is None:
+            return n_rows
+        return max(1, min(n_rows, self.max_chunk_bytes //
+                          self.row_bytes(row_len, dtype)))
+
+    def row_bytes(self, row_len, dtype):
+        """Bytes of the intermediate neighbor tensors of one row"""
+        # gathered, concatenated, fc_full, bn1, gate and product features
+        return row_len * (10 * self.atom_fea_len + self.nbr_fea_len) * \
+            torch.finfo(dtype).bits // 8
 
     def forward(self, atom_in_fea, nbr_fea, nbr_fea_idx):
         """
@@ -45,8 +134,10 @@ class ConvLayer(nn.Module):
           Atom hidden features before convolution
         nbr_fea: Variable(torch.Tensor) shape (N, M, nbr_fea_len)
           Bond features of each atom's M neighbors
+          or shape (E, nbr_fea_len) for a sparse graph
         nbr_fea_idx: torch.LongTensor shape (N, M)
           Indices of M neighbors of each atom
+          or edge_idx shape (2, E) for a sparse graph
 
         Returns
         -------
@@ -55,25 +146,162 @@ class ConvLayer(nn.Module):
           Atom hidden features after convolution
 
         """
+        if nbr_fea.dim() == 2:
+            return self.sparse_forward(atom_in_fea, nbr_fea, nbr_fea_idx)
         # TODO will there be problems with the index zero padding?
         N, M = nbr_fea_idx.shape
+        if self.factorized and not self.training:
+            # per-atom projections, gathered by gated_sum
+            w_self, w_nbr, w_edge, bias = self.factorized_weights()
+            atom_proj = (F.linear(atom_in_fea, w_self, bias),
+                         F.linear(atom_in_fea, w_nbr), w_edge)
+        else:
+            atom_proj = None
+        chunk = self.chunk_rows(N, M, atom_in_fea.dtype)
+        nbr_sumed = torch.cat([
+            self.gated_sum(atom_in_fea, nbr_fea[start:start+chunk],
+                           nbr_fea_idx[start:start+chunk],
+                           start, atom_proj)
+            for start in range(0, N, chunk)], dim=0)
+        nbr_sumed = self.bn2(nbr_sumed)
+        out = self.softplus2(atom_in_fea + nbr_sumed)
+        return out
+
+    def gated_sum(self, atom_in_fea, nbr_fea, nbr_fea_idx, start=0,
+                  atom_proj=None):
+        """
+        Gated sum over the neighbors of the atoms start to start + n
+
+        n: Number of atoms in the range
+
+        Parameters
+        ----------
+
+        atom_in_fea: Variable(torch.Tensor) shape (N, atom_fea_len)
+          Atom hidden features of the whole batch
+        nbr_fea: Variable(torch.Tensor) shape (n, M, nbr_fea_len)
+        nbr_fea_idx: torch.LongTensor shape (n, M)
+        start: int
+          Index of the first atom of the range
+        atom_proj: tuple or None
+          Self and neighbor projections of all atoms and the edge weight
+          of the factorized fc_full with bn1 folded in, or None to apply
+          fc_full and bn1 to the concatenated features
+
+        Returns
+        -------
+
+        nbr_sumed: nn.Variable shape (n, atom_fea_len)
+        """
+        n, M = nbr_fea_idx.shape
         # convolution
-        atom_nbr_fea = atom_in_fea[nbr_fea_idx, :]
-        total_nbr_fea = torch.cat(
-            [atom_in_fea.unsqueeze(1).expand(N, M, self.atom_fea_len),
-             atom_nbr_fea, nbr_fea], dim=2)
-        total_gated_fea = self.fc_full(total_nbr_fea)
-        total_gated_fea = self.bn1(total_gated_fea.view(
-            -1, self.atom_fea_len*2)).view(N, M, self.atom_fea_len*2)
+        if atom_proj is not None:
+            self_proj, nbr_proj, w_edge = atom_proj
+            # accumulate in place, this path only runs in evaluation mode
+            total_gated_fea = F.linear(nbr_fea, w_edge)
+            total_gated_fea += nbr_proj[nbr_fea_idx, :]
+            total_gated_fea += self_proj[start:start+n].unsqueeze(1)
+        else:
+            atom_nbr_fea = atom_in_fea[nbr_fea_idx, :]
+            total_nbr_fea = torch.cat(
+                [atom_in_fea[start:start+n].unsqueeze(1).expand(
+                    n, M, self.atom_fea_len),
+                 atom_nbr_fea, nbr_fea], dim=2)
+            total_gated_fea = self.fc_full(total_nbr_fea)
+            total_gated_fea = self.bn1(total_gated_fea.view(
+                -1, self.atom_fea_len*2)).view(n, M, self.atom_fea_len*2)
         nbr_filter, nbr_core = total_gated_fea.chunk(2, dim=2)
         nbr_filter = self.sigmoid(nbr_filter)
         nbr_core = self.softplus1(nbr_core)
-        nbr_sumed = torch.sum(nbr_filter * nbr_core, dim=1)
+        return torch.sum(nbr_filter * nbr_core, dim=1)
+
+    def sparse_forward(self, atom_in_fea, nbr_fea, edge_idx):
+        """
+        Forward pass over an edge list, without padded neighbors
+
+        N: Total number of atoms in the batch
+        E: Total number of edges in the batch
+
+        Parameters
+        ----------
+
+        atom_in_fea: Variable(torch.Tensor) shape (N, atom_fea_len)
+          Atom hidden features before convolution
+        nbr_fea: Variable(torch.Tensor) shape (E, nbr_fea_len)
+          Bond features of each edge
+        edge_idx: torch.LongTensor shape (2, E)
+          Center (row 0) and neighbor (row 1) atom indices of each edge
+
+        Returns
+        -------
+
+        atom_out_fea: nn.Variable shape (N, atom_fea_len)
+          Atom hidden features after convolution
+
+        """
+        nbr_sumed = atom_in_fea.new_zeros(atom_in_fea.shape)
+        if self.factorized and not self.training:
+            w_self, w_nbr, w_edge, bias = self.factorized_weights()
+            self_proj = F.linear(atom_in_fea, w_self, bias)
+            nbr_proj = F.linear(atom_in_fea, w_nbr)
+        n_edges = edge_idx.shape[1]
+        chunk = self.chunk_rows(n_edges, 1, atom_in_fea.dtype)
+        for start in range(0, n_edges, chunk):
+            center_idx, nbr_idx = edge_idx[:, start:start+chunk]
+            if self.factorized and not self.training:
+                total_gated_fea = self_proj[center_idx, :] + \
+                    nbr_proj[nbr_idx, :] + \
+                    F.linear(nbr_fea[start:start+chunk], w_edge)
+            else:
+                total_nbr_fea = torch.cat(
+                    [atom_in_fea[center_idx, :], atom_in_fea[nbr_idx, :],
+                     nbr_fea[start:start+chunk]], dim=1)
+                total_gated_fea = self.bn1(self.fc_full(total_nbr_fea))
+            nbr_filter, nbr_core = total_gated_fea.chunk(2, dim=1)
+            nbr_filter = self.sigmoid(nbr_filter)
+            nbr_core = self.softplus1(nbr_core)
+            nbr_sumed = nbr_sumed.index_add(0, center_idx,
+                                            nbr_filter * nbr_core)
         nbr_sumed = self.bn2(nbr_sumed)
         out = self.softplus2(atom_in_fea + nbr_sumed)
         return out
 
 
+class EmbeddingTable(nn.Module):
+    """
+    The atom embedding evaluated once for every element of the atom feature
+    table, so that at inference the first layer is a lookup by atomic number
+    instead of a matrix product per atom.
+    """
+    def __init__(self, embedding, atom_table):
+        """
+        Parameters
+        ----------
+
+        embedding: nn.Linear
+          The trained embedding layer
+        atom_table: np.ndarray shape (Z_max + 1, orig_atom_fea_len)
+          Atom features indexed by atomic number (AtomInitializer.table)
+        """
+        super(EmbeddingTable, self).__init__()
+        self.in_features = embedding.in_features
+        self.out_features = embedding.out_features
+        atom_table = torch.as_tensor(atom_table,
+                                     dtype=embedding.weight.dtype,
+                                     device=embedding.weight.device)
+        with torch.no_grad():
+            self.register_buffer('table', embedding(atom_table))
+
+    def forward(self, atom_numbers):
+        """
+        Parameters
+        ----------
+
+        atom_numbers: torch.LongTensor shape (N, )
+        """
+        return self.table[atom_numbers]
+
+
 class CrystalGraphConvNet(nn.Module):
     """
     Create a crystal graph convolutional neural network for predicting total
@@ -122,7 +350,8 @@ class CrystalGraphConvNet(nn.Module):
             self.logsoftmax = nn.LogSoftmax(dim=1)
             self.dropout = nn.Dropout()
 
-    def forward(self, atom_fea, nbr_fea, nbr_fea_idx, crystal_atom_idx):
+    def forward(self, atom_fea, nbr_fea, nbr_fea_idx, crystal_atom_idx,
+                atom_weights=None):
         """
         Forward pass
 
@@ -135,12 +364,18 @@ class CrystalGraphConvNet(nn.Module):
 
         atom_fea: Variable(torch.Tensor) shape (N, orig_atom_fea_len)
           Atom features from atom type
+          or atomic numbers shape (N, ) after precompute_embedding
         nbr_fea: Variable(torch.Tensor) shape (N, M, nbr_fea_len)
           Bond features of each atom's M neighbors
+          or shape (E, nbr_fea_len) for a sparse graph
         nbr_fea_idx: torch.LongTensor shape (N, M)
           Indices of M neighbors of each atom
+          or edge_idx shape (2, E) for a sparse graph
         crystal_atom_idx: list of torch.LongTensor of length N0
           Mapping from the crystal idx to atom idx
+        atom_weights: torch.Tensor shape (N, ) or None
+          Multiplicity of every atom for the symmetry-reduced graphs of
+          CIFData with symmetry_reduce=True, in evaluation mode
 
         Returns
         -------
@@ -152,7 +387,83 @@ class CrystalGraphConvNet(nn.Module):
         atom_fea = self.embedding(atom_fea)
         for conv_func in self.convs:
             atom_fea = conv_func(atom_fea, nbr_fea, nbr_fea_idx)
-        crys_fea = self.pooling(atom_fea, crystal_atom_idx)
+        crys_fea = self.pooling(atom_fea, crystal_atom_idx, atom_weights)
+        return self.readout(crys_fea)
+
+    def set_max_conv_memory(self, max_bytes):
+        """
+        Bound the memory of the neighbor tensors of every ConvLayer in
+        evaluation mode by convolving the atoms in chunks (see
+        ConvLayer.chunk_rows). None removes the bound.
+        """
+        for conv_func in self.convs:
+            conv_func.max_chunk_bytes = max_bytes
+        return self
+
+    def factorize_convs(self, factorized=True):
+        """
+        Evaluate fc_full of every ConvLayer per atom instead of per edge in
+        evaluation mode (see ConvLayer.split_weights). The results agree
+        with the concatenated layer up to float rounding, as checked by
+        check_factorized_parity. The split weights are derived here once, not
+        on every forward pass.
+        """
+        for conv_func in self.convs:
+            conv_func.factorized = factorized
+            conv_func._split = None
+            if factorized:
+                conv_func.factorized_weights()
+        return self
+
+    def memory_footprint(self, n_atoms, n_edges, dtype=torch.float32):
+        """
+        Estimated peak bytes of an inference pass over a batch, used to fill
+        batches up to a memory budget (cgcnn.data.MemoryBudgetBatches).
+
+        It counts the input tensors, a few atom feature tensors per layer
+        and the intermediate neighbor tensors of one ConvLayer, which
+        dominate and are bounded by set_max_conv_memory.
+
+        Parameters
+        ----------
+
+        n_atoms: int
+          Number of atoms in the batch
+        n_edges: int
+          Number of neighbor entries, N * M for the padded graph
+        """
+        conv = self.convs[0]
+        itemsize = torch.finfo(dtype).bits // 8
+        atom_bytes = n_atoms * itemsize * 4 * conv.atom_fea_len
+        if isinstance(self.embedding, nn.Linear):
+            atom_bytes += n_atoms * itemsize * self.embedding.in_features
+        else:
+            atom_bytes += n_atoms * 8
+        input_bytes = n_edges * (itemsize * conv.nbr_fea_len + 8)
+        conv_bytes = n_edges * conv.row_bytes(1, dtype)
+        if conv.max_chunk_bytes is not None:
+            conv_bytes = min(conv_bytes, conv.max_chunk_bytes)
+        return atom_bytes + input_bytes + conv_bytes
+
+    def precompute_embedding(self, atom_table):
+        """
+        Replace the embedding by an EmbeddingTable for inference. The model
+        then takes the atomic numbers (CIFData with atom_numbers=True) in
+        place of the atom features.
+        """
+        self.embedding = EmbeddingTable(self.embedding, atom_table)
+        return self
+
+    def readout(self, crys_fea):
+        """
+        Map the pooled crystal features to the prediction
+
+        Parameters
+        ----------
+
+        crys_fea: Variable(torch.Tensor) shape (N0, atom_fea_len)
+          Crystal feature vectors of the batch
+        """
         crys_fea = self.conv_to_fc(self.conv_to_fc_softplus(crys_fea))
         crys_fea = self.conv_to_fc_softplus(crys_fea)
         if self.classification:
@@ -165,7 +476,7 @@ class CrystalGraphConvNet(nn.Module):
             out = self.logsoftmax(out)
         return out
 
-    def pooling(self, atom_fea, crystal_atom_idx):
+    def pooling(self, atom_fea, crystal_atom_idx, atom_weights=None):
         """
         Pooling the atom features to crystal features
 
@@ -179,9 +490,68 @@ class CrystalGraphConvNet(nn.Module):
           Atom feature vectors of the batch
         crystal_atom_idx: list of torch.LongTensor of length N0
           Mapping from the crystal idx to atom idx
+        atom_weights: torch.Tensor shape (N, ) or None
+          Weights of a weighted mean, a plain mean if None
         """
         assert sum([len(idx_map) for idx_map in crystal_atom_idx]) ==\
             atom_fea.data.shape[0]
-        summed_fea = [torch.mean(atom_fea[idx_map], dim=0, keepdim=True)
-                      for idx_map in crystal_atom_idx]
+        if atom_weights is None:
+            summed_fea = [torch.mean(atom_fea[idx_map], dim=0, keepdim=True)
+                          for idx_map in crystal_atom_idx]
+        else:
+            atom_weights = atom_weights.to(atom_fea.dtype).unsqueeze(1)
+            summed_fea = [torch.sum(atom_fea[idx_map] * atom_weights[idx_map],
+                                    dim=0, keepdim=True) /
+                          torch.sum(atom_weights[idx_map])
+                          for idx_map in crystal_atom_idx]
         return torch.cat(summed_fea, dim=0)
+
+
+def check_factorized_parity(model, data_loader, atol=1e-5):
+    """
+    Compare the factorized ConvLayers with the concatenated ones on the
+    batches of a DataLoader, in evaluation mode.
+
+    Returns
+    -------
+
+    max_error: float
+      Largest absolute difference of the outputs
+    passed: bool
+    """
+    model.eval()
+    max_error = 0.
+    with torch.no_grad():
+        for input, _, _ in data_loader:
+            expected = model.factorize_convs(False)(*input)
+            output = model.factorize_convs(True)(*input)
+            max_error = max(max_error,
+                            float(torch.max(torch.abs(output - expected))))
+    model.factorize_convs(False)
+    return max_error, max_error <= atol
+
+
+def check_symmetry_parity(model, data_loader, reduced_loader, atol=1e-5):
+    """
+    Compare the symmetry-reduced graphs (CIFData with symmetry_reduce=True)
+    with the full ones, in evaluation mode. Both loaders must give the same
+    crystals in the same order.
+
+    Returns
+    -------
+
+    max_error: float
+      Largest absolute difference of the outputs
+    passed: bool
+    """
+    model.eval()
+    max_error = 0.
+    with torch.no_grad():
+        for (input, _, cif_ids), (reduced_input, _, reduced_ids) in \
+                zip(data_loader, reduced_loader):
+            assert cif_ids == reduced_ids, 'the loaders are not in step'
+            expected = model(*input)
+            output = model(*reduced_input)
+            max_error = max(max_error,
+                            float(torch.max(torch.abs(output - expected))))
+    return max_error, max_error <= atol
@@ -0,0 +1,282 @@
+from __future__ import print_function, division
+
+import numpy as np
+
+
+def radius_neighbors(crystal, radius, max_num_nbr):
+    """
+    Search the neighbors of every atom within a fixed cutoff radius.
+
+    Parameters
+    ----------
+
+    crystal: pymatgen.core.structure.Structure
+    radius: float
+      The cutoff radius for searching neighbors
+    max_num_nbr: int or None
+      Number of nearest neighbors to keep per atom, all if None
+
+    Returns
+    -------
+
+    nbr_idx: list of np.ndarray of length n_i
+      Indices of the neighbors of each atom, sorted by distance, with ties
+      in the order of get_all_neighbors as in the graphs the shipped
+      models were trained on
+    nbr_dist: list of np.ndarray of length n_i
+      Distances of the neighbors of each atom
+    """
+    all_nbrs = crystal.get_all_neighbors(radius, include_index=True)
+    all_nbrs = [sorted(nbrs, key=lambda x: x[1])[:max_num_nbr]
+                for nbrs in all_nbrs]
+    nbr_idx = [np.array([nbr[2] for nbr in nbrs], dtype=np.int64)
+               for nbrs in all_nbrs]
+    nbr_dist = [np.array([nbr[1] for nbr in nbrs], dtype=float)
+                for nbrs in all_nbrs]
+    return nbr_idx, nbr_dist
+
+
+def knn_neighbors(crystal, radius, max_num_nbr, expand=1.5,
+                  numerical_tol=1e-8):
+    """
+    Search the max_num_nbr nearest neighbors of every atom with an adaptive
+    cutoff. The search starts from the radius of a sphere holding about
+    max_num_nbr atoms at the average density and is only expanded (up to
+    radius) for the atoms that have not found enough neighbors yet. As the
+    k nearest neighbors within a smaller cutoff are also the k nearest within
+    radius, the distances are the same as radius_neighbors. Ties are broken
+    by neighbor index instead, so the equidistant neighbors kept at the
+    cutoff can differ (see check_neighbor_parity).
+
+    Parameters
+    ----------
+
+    crystal: pymatgen.core.structure.Structure
+    radius: float
+      The maximum cutoff radius for searching neighbors
+    max_num_nbr: int
+      Number of nearest neighbors to keep per atom
+    expand: float
+      Factor the cutoff is multiplied by after each search
+    numerical_tol: float
+      Distance below which an atom is considered to be its own neighbor
+
+    Returns
+    -------
+
+    nbr_idx: list of np.ndarray of length n_i
+      Indices of the neighbors of each atom, sorted by distance and index
+    nbr_dist: list of np.ndarray of length n_i
+      Distances of the neighbors of each atom
+    """
+    n = len(crystal)
+    nbr_idx, nbr_dist = [None] * n, [None] * n
+    cutoff = (3 * max_num_nbr * crystal.volume / (4 * np.pi * n)) ** (1 / 3)
+    cutoff = min(cutoff, radius)
+    pending = np.arange(n)
+    while len(pending):
+        # the centers are indices into pending, so pymatgen cannot tell an
+        # atom from its own image and the self pairs are dropped here
+        center, points, _, dist = crystal.get_neighbor_list(
+            cutoff, sites=[crystal[i] for i in pending],
+            numerical_tol=-1.)
+        keep = ~((pending[center] == points) & (dist <= numerical_tol))
+        center, points, dist = center[keep], points[keep], dist[keep]
+        order = np.lexsort((points, dist, center))
+        center, points, dist = center[order], points[order], dist[order]
+        bounds = np.searchsorted(center, np.arange(len(pending) + 1))
+        still_pending = []
+        for j, i in enumerate(pending):
+            idx = points[bounds[j]:bounds[j + 1]]
+            d = dist[bounds[j]:bounds[j + 1]]
+            if len(idx) < max_num_nbr and cutoff < radius:
+                still_pending.append(i)
+                continue
+            nbr_idx[i] = idx[:max_num_nbr].astype(np.int64)
+            nbr_dist[i] = d[:max_num_nbr].astype(float)
+        pending = np.array(still_pending, dtype=np.int64)
+        cutoff = min(cutoff * expand, radius)
+    return nbr_idx, nbr_dist
+
+
+def cell_list_neighbor_list(lattice_matrix, frac_coords, radius,
+                            chunk_size=1024, numerical_tol=1e-8):
+    """
+    Vectorized periodic neighbor search with a cell list.
+
+    The periodic images of the atoms that can lie within radius of the unit
+    cell are binned into cubic cells of edge radius, so the neighbors of an
+    atom are found among the 27 bins around it. Atoms are processed in chunks
+    to bound memory, and the cost grows linearly with the number of atoms.
+
+    Parameters
+    ----------
+
+    lattice_matrix: np.ndarray shape (3, 3)
+      Lattice vectors as rows
+    frac_coords: np.ndarray shape (n, 3)
+      Fractional coordinates of the atoms
+    radius: float
+      The cutoff radius for searching neighbors
+    chunk_size: int
+      Number of center atoms searched at once
+    numerical_tol: float
+      Distance below which an atom is considered to be its own neighbor
+
+    Returns
+    -------
+
+    center_idx: np.ndarray shape (E, )
+      Index of the center atom of each pair
+    nbr_idx: np.ndarray shape (E, )
+      Index of the neighbor atom of each pair
+    distances: np.ndarray shape (E, )
+      Distance of each pair
+    """
+    lattice_matrix = np.asarray(lattice_matrix, dtype=float)
+    frac_coords = np.mod(np.asarray(frac_coords, dtype=float), 1.)
+    n = len(frac_coords)
+    # distance between opposite lattice planes along each axis
+    spacing = 1. / np.linalg.norm(np.linalg.inv(lattice_matrix).T, axis=1)
+    margin = radius / spacing
+    reps = np.ceil(margin).astype(int)
+    shifts = np.stack(np.meshgrid(*[np.arange(-r, r + 1) for r in reps],
+                                  indexing='ij'), axis=-1).reshape(-1, 3)
+
+    # keep the images within radius of the unit cell
+    image_frac, image_atom = [], []
+    for shift in shifts:
+        frac = frac_coords + shift
+        keep = np.all((frac >= -margin) & (frac < 1. + margin), axis=1)
+        image_frac.append(frac[keep])
+        image_atom.append(np.nonzero(keep)[0])
+    image_cart = np.concatenate(image_frac) @ lattice_matrix
+    image_atom = np.concatenate(image_atom)
+    center_cart = frac_coords @ lattice_matrix
+
+    # sort the images by bin
+    origin = image_cart.min(axis=0)
+    dims = np.floor((image_cart.max(axis=0) - origin) / radius).astype(
+        np.int64) + 1
+    image_bins = np.floor((image_cart - origin) / radius).astype(np.int64)
+    image_bin_id = np.ravel_multi_index(image_bins.T, dims)
+    order = np.argsort(image_bin_id, kind='stable')
+    image_cart, image_atom = image_cart[order], image_atom[order]
+    image_bin_id = image_bin_id[order]
+
+    offsets = np.stack(np.meshgrid(*[np.arange(-1, 2)] * 3, indexing='ij'),
+                       axis=-1).reshape(-1, 3)
+    all_center, all_nbr, all_dist = [], [], []
+    for start in range(0, n, chunk_size):
+        centers = np.arange(start, min(start + chunk_size, n))
+        center_bins = np.floor((center_cart[centers] - origin) / radius
+                               ).astype(np.int64)
+        nbr_bins = center_bins[:, np.newaxis, :] + offsets  # (c, 27, 3)
+        valid = np.all((nbr_bins >= 0) & (nbr_bins < dims), axis=2)
+        nbr_bin_id = np.ravel_multi_index(
+            np.where(valid[..., np.newaxis], nbr_bins, 0).transpose(2, 0, 1),
+            dims)
+        lo = np.searchsorted(image_bin_id, nbr_bin_id, side='left')
+        hi = np.searchsorted(image_bin_id, nbr_bin_id, side='right')
+        counts = np.where(valid, hi - lo, 0).ravel()
+        # expand the (center, bin) ranges into candidate pairs
+        cand_center = np.repeat(np.repeat(centers, len(offsets)), counts)
+        first = np.repeat(lo.ravel() - np.cumsum(counts) + counts, counts)
+        cand_image = first + np.arange(counts.sum())
+        dist = np.linalg.norm(image_cart[cand_image] -
+                              center_cart[cand_center], axis=1)
+        cand_atom = image_atom[cand_image]
+        keep = (dist <= radius) & ~((cand_atom == cand_center) &
+                                    (dist <= numerical_tol))
+        all_center.append(cand_center[keep])
+        all_nbr.append(cand_atom[keep])
+        all_dist.append(dist[keep])
+    return (np.concatenate(all_center).astype(np.int64),
+            np.concatenate(all_nbr).astype(np.int64),
+            np.concatenate(all_dist))
+
+
+def cell_list_neighbors(crystal, radius, max_num_nbr):
+    """
+    Search the neighbors of every atom within a fixed cutoff radius with
+    cell_list_neighbor_list, working on the lattice matrix and fractional
+    coordinates only.
+
+    Parameters
+    ----------
+
+    crystal: pymatgen.core.structure.Structure
+    radius: float
+      The cutoff radius for searching neighbors
+    max_num_nbr: int or None
+      Number of nearest neighbors to keep per atom, all if None
+
+    Returns
+    -------
+
+    nbr_idx: list of np.ndarray of length n_i
+      Indices of the neighbors of each atom, sorted by distance and index
+    nbr_dist: list of np.ndarray of length n_i
+      Distances of the neighbors of each atom
+    """
+    n = len(crystal)
+    center, points, dist = cell_list_neighbor_list(
+        crystal.lattice.matrix, crystal.frac_coords, radius)
+    order = np.lexsort((points, dist, center))
+    center, points, dist = center[order], points[order], dist[order]
+    bounds = np.searchsorted(center, np.arange(n + 1))
+    if max_num_nbr is not None:
+        rank = np.arange(len(center)) - bounds[center]
+        keep = rank < max_num_nbr
+        center, points, dist = center[keep], points[keep], dist[keep]
+        bounds = np.searchsorted(center, np.arange(n + 1))
+    return (np.split(points, bounds[1:-1]), np.split(dist, bounds[1:-1]))
+
+
+def check_neighbor_parity(crystal, radius=8, max_num_nbr=12,
+                          nbr_search=cell_list_neighbors, atol=1e-6):
+    """
+    Compare a neighbor search backend with Structure.get_all_neighbors.
+
+    The sorted neighbor distances of every atom must agree within atol. The
+    neighbor indices must agree too, except for neighbors tied in distance
+    with the last kept one, where the choice among equidistant atoms is
+    arbitrary.
+
+    Returns
+    -------
+
+    passed: bool
+    """
+    all_nbrs = crystal.get_all_neighbors(radius, include_index=True)
+    nbr_idx, nbr_dist = nbr_search(crystal, radius, max_num_nbr)
+    for nbrs, idx, dist in zip(all_nbrs, nbr_idx, nbr_dist):
+        nbrs = sorted(nbrs, key=lambda x: x[1])[:max_num_nbr]
+        ref_idx = np.array([nbr[2] for nbr in nbrs], dtype=np.int64)
+        ref_dist = np.array([nbr[1] for nbr in nbrs], dtype=float)
+        if len(ref_dist) != len(dist) or \
+                not np.allclose(ref_dist, dist, rtol=0, atol=atol):
+            return False
+        if len(dist) == 0:
+            continue
+        inner = ref_dist < ref_dist[-1] - atol
+        if sorted(ref_idx[inner]) != sorted(idx[dist < dist[-1] - atol]):
+            return False
+    return True
+
+
+NBR_SEARCHES = {'radius': radius_neighbors, 'knn': knn_neighbors,
+                'cell_list': cell_list_neighbors}
+
+
+if __name__ == '__main__':
+    import glob
+    import sys
+
+    from pymatgen.core.structure import Structure
+
+    for cif_path in sorted(glob.glob(sys.argv[1] if len(sys.argv) > 1
+                                     else '*.cif')):
+        crystal = Structure.from_file(cif_path)
+        print('{}: {}'.format(cif_path, 'ok' if check_neighbor_parity(crystal)
+                               else 'MISMATCH'))
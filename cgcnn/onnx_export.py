@@ -0,0 +1,184 @@
+from __future__ import print_function, division
+
+import argparse
+import glob
+import inspect
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from .model import CrystalGraphConvNet
+from .utils import Normalizer, file_digest
+
+
+class PooledCrystalGraphConvNet(nn.Module):
+    """
+    CrystalGraphConvNet with tensor inputs only, so that it can be exported.
+    The list crystal_atom_idx is replaced by the crystal index of every atom
+    and the number of atoms of every crystal.
+    """
+    def __init__(self, model):
+        super(PooledCrystalGraphConvNet, self).__init__()
+        self.model = model
+
+    def forward(self, atom_fea, nbr_fea, nbr_fea_idx, atom_crystal_idx,
+                crystal_atom_num):
+        """
+        Forward pass
+
+        N: Total number of atoms in the batch
+        M: Max number of neighbors
+        N0: Total number of crystals in the batch
+
+        Parameters
+        ----------
+
+        atom_fea: torch.Tensor shape (N, orig_atom_fea_len)
+        nbr_fea: torch.Tensor shape (N, M, nbr_fea_len)
+        nbr_fea_idx: torch.LongTensor shape (N, M)
+        atom_crystal_idx: torch.LongTensor shape (N, )
+          Crystal index of every atom
+        crystal_atom_num: torch.Tensor shape (N0, )
+          Number of atoms of every crystal
+        """
+        atom_fea = self.model.embedding(atom_fea)
+        for conv_func in self.model.convs:
+            atom_fea = conv_func(atom_fea, nbr_fea, nbr_fea_idx)
+        summed_fea = torch.zeros_like(atom_fea[:1]).expand(
+            crystal_atom_num.shape[0], -1).scatter_add(
+            0, atom_crystal_idx.unsqueeze(1).expand_as(atom_fea), atom_fea)
+        crys_fea = summed_fea / crystal_atom_num.unsqueeze(1)
+        return self.model.readout(crys_fea)
+
+
+def load_model(checkpoint_path):
+    """
+    Build a CrystalGraphConvNet in evaluation mode from a checkpoint written
+    by train.py, taking the input sizes from the stored weights.
+
+    Returns
+    -------
+
+    model: CrystalGraphConvNet
+    normalizer: Normalizer
+    model_args: argparse.Namespace
+    """
+    checkpoint = torch.load(checkpoint_path,
+                            map_location=lambda storage, loc: storage)
+    model_args = argparse.Namespace(**checkpoint['args'])
+    state_dict = checkpoint['state_dict']
+    orig_atom_fea_len = state_dict['embedding.weight'].shape[1]
+    nbr_fea_len = state_dict['convs.0.fc_full.weight'].shape[1] - \
+        2 * model_args.atom_fea_len
+    model = CrystalGraphConvNet(orig_atom_fea_len, nbr_fea_len,
+                                atom_fea_len=model_args.atom_fea_len,
+                                n_conv=model_args.n_conv,
+                                h_fea_len=model_args.h_fea_len,
+                                n_h=model_args.n_h,
+                                classification=True if model_args.task ==
+                                'classification' else False)
+    model.load_state_dict(state_dict, strict=False)
+    model.eval()
+    normalizer = Normalizer(torch.zeros(3))
+    normalizer.load_state_dict(checkpoint['normalizer'])
+    return model, normalizer, model_args
+
+
+def export_onnx(checkpoint_path, onnx_path, opset_version=17):
+    """
+    Export the model of a checkpoint to ONNX with dynamic atom, neighbor and
+    crystal dimensions. The normalizer, task and checkpoint SHA-256 are
+    stored in the model metadata for cgcnn.onnx_runtime.
+    """
+    import onnx
+
+    model, normalizer, model_args = load_model(checkpoint_path)
+    orig_atom_fea_len = model.embedding.in_features
+    nbr_fea_len = model.convs[0].nbr_fea_len
+    n_atoms, max_num_nbr = 5, 12
+    dummy_input = (torch.rand(n_atoms, orig_atom_fea_len),
+                   torch.rand(n_atoms, max_num_nbr, nbr_fea_len),
+                   torch.randint(0, n_atoms, (n_atoms, max_num_nbr)),
+                   torch.LongTensor([0, 0, 0, 1, 1]),
+                   torch.Tensor([3., 2.]))
+    export_kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # the TorchScript exporter, as in the torch versions without dynamo
+        export_kwargs['dynamo'] = False
+    with torch.no_grad():
+        torch.onnx.export(
+            PooledCrystalGraphConvNet(model), dummy_input, onnx_path,
+            input_names=['atom_fea', 'nbr_fea', 'nbr_fea_idx',
+                         'atom_crystal_idx', 'crystal_atom_num'],
+            output_names=['output'],
+            dynamic_axes={'atom_fea': {0: 'n_atoms'},
+                          'nbr_fea': {0: 'n_atoms', 1: 'max_num_nbr'},
+                          'nbr_fea_idx': {0: 'n_atoms', 1: 'max_num_nbr'},
+                          'atom_crystal_idx': {0: 'n_atoms'},
+                          'crystal_atom_num': {0: 'n_crystals'},
+                          'output': {0: 'n_crystals'}},
+            opset_version=opset_version, **export_kwargs)
+    onnx_model = onnx.load(onnx_path)
+    metadata = {'task': model_args.task,
+                'normalizer_mean': repr(float(normalizer.mean)),
+                'normalizer_std': repr(float(normalizer.std)),
+                'checkpoint_sha256': file_digest(checkpoint_path)}
+    for key, value in metadata.items():
+        entry = onnx_model.metadata_props.add()
+        entry.key, entry.value = key, value
+    onnx.save(onnx_model, onnx_path)
+    return onnx_path
+
+
+def check_onnx_parity(checkpoint_path, onnx_path, data_loader, atol=1e-4):
+    """
+    Compare the ONNX Runtime outputs with the PyTorch model on the batches of
+    a DataLoader over a dense crystal graph dataset (collate_pool).
+
+    Returns
+    -------
+
+    max_error: float
+      Largest absolute difference of the (normalized) outputs
+    passed: bool
+    """
+    from .onnx_runtime import OnnxCrystalGraphConvNet
+
+    model, _, _ = load_model(checkpoint_path)
+    onnx_model = OnnxCrystalGraphConvNet(onnx_path)
+    max_error = 0.
+    for input, _, _ in data_loader:
+        with torch.no_grad():
+            expected = model(*input).numpy()
+        max_error = max(max_error,
+                        float(np.max(np.abs(onnx_model(*input) - expected))))
+    return max_error, max_error <= atol
+
+
+if __name__ == '__main__':
+    from torch.utils.data import DataLoader
+
+    from .data import CIFData, collate_pool
+
+    parser = argparse.ArgumentParser(
+        description='Export the CGCNN checkpoints to ONNX')
+    parser.add_argument('model_dir', help='directory with the '
+                        '*-pre-trained.pth.tar checkpoints')
+    parser.add_argument('--root-dir', default=None,
+                        help='dataset to check the parity with PyTorch on')
+    args = parser.parse_args()
+    if args.root_dir:
+        loader = DataLoader(CIFData(args.root_dir), batch_size=64,
+                            collate_fn=collate_pool)
+    for checkpoint_path in sorted(glob.glob(
+            os.path.join(args.model_dir, '*-pre-trained.pth.tar'))):
+        onnx_path = checkpoint_path[:-len('.pth.tar')] + '.onnx'
+        export_onnx(checkpoint_path, onnx_path)
+        print('Exported {}'.format(onnx_path))
+        if args.root_dir:
+            max_error, passed = check_onnx_parity(checkpoint_path, onnx_path,
+                                                  loader)
+            print('  parity {} (max abs error {:.2e})'.format(
+                'ok' if passed else 'FAILED', max_error))
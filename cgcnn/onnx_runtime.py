@@ -0,0 +1,66 @@
+from __future__ import print_function, division
+
+import numpy as np
+import onnxruntime as ort
+
+
+class OnnxCrystalGraphConvNet(object):
+    """
+    Run a model exported by cgcnn.onnx_export with the CPU execution provider
+    of ONNX Runtime. Only NumPy and onnxruntime are needed at inference time.
+
+    It is called with the same inputs as CrystalGraphConvNet (torch tensors
+    or NumPy arrays) and returns the normalized output as a NumPy array.
+
+    Parameters
+    ----------
+
+    onnx_path: str
+        The exported .onnx file
+    num_threads: int or None
+        Intra-op threads, ONNX Runtime decides if None
+    """
+    def __init__(self, onnx_path, num_threads=None):
+        options = ort.SessionOptions()
+        options.graph_optimization_level = \
+            ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(
+            onnx_path, options, providers=['CPUExecutionProvider'])
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.task = metadata.get('task', 'regression')
+        self.mean = float(metadata.get('normalizer_mean', 0.))
+        self.std = float(metadata.get('normalizer_std', 1.))
+        self.checkpoint_sha256 = metadata.get('checkpoint_sha256')
+
+    def eval(self):
+        return self
+
+    def __call__(self, atom_fea, nbr_fea, nbr_fea_idx, crystal_atom_idx):
+        atom_crystal_idx = np.empty(len(atom_fea), dtype=np.int64)
+        for i, idx_map in enumerate(crystal_atom_idx):
+            atom_crystal_idx[np.asarray(idx_map)] = i
+        crystal_atom_num = np.array([len(idx_map) for idx_map
+                                     in crystal_atom_idx], dtype=np.float32)
+        output, = self.session.run(None, {
+            'atom_fea': np.asarray(atom_fea, dtype=np.float32),
+            'nbr_fea': np.asarray(nbr_fea, dtype=np.float32),
+            'nbr_fea_idx': np.asarray(nbr_fea_idx, dtype=np.int64),
+            'atom_crystal_idx': atom_crystal_idx,
+            'crystal_atom_num': crystal_atom_num})
+        return output
+
+    def predict(self, atom_fea, nbr_fea, nbr_fea_idx, crystal_atom_idx):
+        """
+        Returns
+        -------
+
+        prediction: np.ndarray shape (N0, )
+          Denormalized property for regression, probability of the positive
+          class for classification
+        """
+        output = self(atom_fea, nbr_fea, nbr_fea_idx, crystal_atom_idx)
+        if self.task == 'classification':
+            return np.exp(output[:, 1])
+        return output[:, 0] * self.std + self.mean
@@ -0,0 +1,281 @@
+from __future__ import print_function, division
+
+import argparse
+import functools
+import os
+import pickle
+import time
+import warnings
+
+import numpy as np
+from pymatgen.core.composition import Composition
+from pymatgen.core.periodic_table import Element
+
+from .cif_reader import UnsupportedCIF, load_crystal, parse_block
+
+REFERENCE_CSV = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'KappaP_Supporting_Information', 'Nature-filtered-low-kappa.csv')
+KAPPA = 'Kappa_Slack (W m-1 K-1)'
+# amu per cubic angstrom to g/cm3
+AMU_A3_TO_G_CM3 = 1.66053906660
+
+ELEMENT_PROPERTIES = ('Z', 'atomic_mass', 'X', 'row', 'group',
+                      'atomic_radius', 'mendeleev_no')
+
+
+@functools.lru_cache(maxsize=None)
+def _element_properties(symbol):
+    element = Element(symbol)
+    values = []
+    for name in ELEMENT_PROPERTIES:
+        value = getattr(element, name)
+        values.append(np.nan if value is None else float(value))
+    return np.array(values)
+
+
+def composition_features(composition, volume):
+    """
+    Features of a crystal from its composition and cell volume only.
+
+    The features are intensive, so a cell, its primitive cell and any
+    supercell give the same vector: the fraction weighted mean, standard
+    deviation, minimum, maximum and range of every element property, the
+    number of elements, the volume and mass per atom and the density.
+
+    Parameters
+    ----------
+
+    composition: pymatgen Composition or str
+      Composition of the cell, e.g. 'Pb4 Te4'
+    volume: float
+      Volume of the same cell in cubic angstroms
+
+    Returns
+    -------
+
+    features: np.ndarray shape (5 * len(ELEMENT_PROPERTIES) + 4, )
+    """
+    if not isinstance(composition, Composition):
+        composition = Composition(composition)
+    amounts = composition.get_el_amt_dict()
+    n_atoms = sum(amounts.values())
+    weights = np.array(list(amounts.values())) / n_atoms
+    properties = np.stack([_element_properties(symbol) for symbol in amounts])
+    mean = weights @ properties
+    std = np.sqrt(weights @ (properties - mean) ** 2)
+    low, high = properties.min(axis=0), properties.max(axis=0)
+    mass = float(weights @ properties[:, ELEMENT_PROPERTIES.index(
+        'atomic_mass')])
+    volume_per_atom = volume / n_atoms
+    return np.concatenate([
+        mean, std, low, high, high - low,
+        [len(amounts), volume_per_atom, mass,
+         mass / volume_per_atom * AMU_A3_TO_G_CM3]])
+
+
+def header_features(cif_path):
+    """
+    Composition features of a CIF from its _chemical_formula_sum and
+    _cell_volume (or cell parameters) tags, without building the structure.
+    CIFs without these tags are read with cgcnn.cif_reader.load_crystal.
+    """
+    with open(cif_path) as f:
+        text = f.read()
+    try:
+        data = parse_block(text)
+        formula = data['_chemical_formula_sum']
+        if '_cell_volume' in data:
+            volume = float(data['_cell_volume'].split('(')[0])
+        else:
+            a, b, c, alpha, beta, gamma = [
+                float(data[tag].split('(')[0]) for tag in (
+                    '_cell_length_a', '_cell_length_b', '_cell_length_c',
+                    '_cell_angle_alpha', '_cell_angle_beta',
+                    '_cell_angle_gamma')]
+            cosines = np.cos(np.radians([alpha, beta, gamma]))
+            volume = a * b * c * np.sqrt(
+                1 - (cosines ** 2).sum() + 2 * cosines.prod())
+        return composition_features(formula, volume)
+    except (UnsupportedCIF, KeyError, ValueError):
+        pass
+    crystal = load_crystal(cif_path)
+    numbers, counts = np.unique(crystal.atomic_numbers, return_counts=True)
+    composition = Composition({Element.from_Z(int(number)): int(count)
+                               for number, count in zip(numbers, counts)})
+    return composition_features(composition, crystal.lattice.volume)
+
+
+class KappaPrefilter(object):
+    """
+    Composition surrogate that triages candidates before the CGCNN models.
+
+    A gradient boosted classifier scores how likely a crystal is to have
+    Kappa_Slack <= cutoff. The out-of-fold scores of the positive training
+    crystals are kept, so threshold(recall) is the score that keeps the
+    requested fraction of them, and candidates scoring below it can skip the
+    structure featurization, the models and calculate_K.
+
+    Parameters
+    ----------
+
+    cutoff: float
+      Kappa_Slack in W/(m K) at or below which a crystal is a positive
+    n_folds: int
+      Folds of the out-of-fold scores used to calibrate the threshold
+    random_state: int
+    """
+    def __init__(self, cutoff=0.3, n_folds=5, random_state=0):
+        self.cutoff = cutoff
+        self.n_folds = n_folds
+        self.random_state = random_state
+        self.classifier = None
+        self.positive_scores = None
+
+    def _new_classifier(self):
+        from sklearn.ensemble import HistGradientBoostingClassifier
+        return HistGradientBoostingClassifier(
+            max_iter=300, learning_rate=0.05, max_leaf_nodes=31,
+            l2_regularization=1., random_state=self.random_state)
+
+    def fit(self, features, kappa):
+        """
+        Parameters
+        ----------
+
+        features: np.ndarray shape (N, n_features)
+          Rows of composition_features
+        kappa: np.ndarray shape (N, )
+          Kappa_Slack in W/(m K)
+        """
+        from sklearn.model_selection import StratifiedKFold, cross_val_predict
+        labels = np.asarray(kappa) <= self.cutoff
+        folds = StratifiedKFold(self.n_folds, shuffle=True,
+                                random_state=self.random_state)
+        scores = cross_val_predict(self._new_classifier(), features, labels,
+                                   cv=folds, method='predict_proba')[:, 1]
+        self.positive_scores = np.sort(scores[labels])
+        self.classifier = self._new_classifier().fit(features, labels)
+        return self
+
+    def score(self, features):
+        """Probability of Kappa_Slack <= cutoff of every row of features"""
+        return self.classifier.predict_proba(np.atleast_2d(features))[:, 1]
+
+    def threshold(self, recall):
+        """Highest score that passes at least recall of the positives"""
+        assert 0 < recall <= 1, 'recall must be in (0, 1]'
+        n_dropped = int(np.floor((1 - recall) * len(self.positive_scores)))
+        return self.positive_scores[n_dropped]
+
+    def select(self, cif_paths, recall=0.95):
+        """
+        Returns
+        -------
+
+        passed: np.ndarray shape (N, ) of bool
+          Whether every CIF of cif_paths goes on to the full prediction
+        """
+        if not len(cif_paths):
+            return np.zeros(0, dtype=bool)
+        features = np.stack([header_features(path) for path in cif_paths])
+        return self.score(features) >= self.threshold(recall)
+
+    def save(self, path):
+        # the attributes rather than the object, so that a prefilter trained
+        # by python -m cgcnn.prefilter loads from cgcnn.prefilter
+        with open(path, 'wb') as f:
+            pickle.dump(self.__dict__, f)
+
+
+def load_prefilter(path):
+    """Load a KappaPrefilter written by KappaPrefilter.save"""
+    with open(path, 'rb') as f:
+        state = pickle.load(f)
+    prefilter = KappaPrefilter()
+    prefilter.__dict__.update(state)
+    return prefilter
+
+
+def reference_features(csv_path=REFERENCE_CSV):
+    """
+    Composition features, Kappa_Slack and training split of the reference
+    dataset, whose first column is the cell formula.
+
+    Returns
+    -------
+
+    features: np.ndarray shape (N, n_features)
+    kappa: np.ndarray shape (N, )
+    is_train: np.ndarray shape (N, ) of bool
+    """
+    import pandas as pd
+    df = pd.read_csv(csv_path, index_col=0)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        features = np.stack([composition_features(formula, volume)
+                             for formula, volume in zip(df.index,
+                                                        df['Volume (Å3)'])])
+    return (features, df[KAPPA].to_numpy(dtype=float),
+            df['Is Train'].to_numpy(dtype=bool))
+
+
+def recall_table(prefilter, features, kappa, recalls):
+    """
+    Measured recall and pass fraction of the thresholds of recalls.
+
+    Returns
+    -------
+
+    rows: list of (target recall, threshold, recall, pass fraction)
+    """
+    labels = np.asarray(kappa) <= prefilter.cutoff
+    scores = prefilter.score(features)
+    rows = []
+    for recall in recalls:
+        passed = scores >= prefilter.threshold(recall)
+        rows.append((recall, prefilter.threshold(recall),
+                     passed[labels].mean(), passed.mean()))
+    return rows
+
+
+if __name__ == '__main__':
+    import glob
+
+    parser = argparse.ArgumentParser(
+        description='Train the composition prefilter on the reference '
+        'dataset and report its recall and throughput on the held-out rows')
+    parser.add_argument('output', help='file the trained prefilter is '
+                        'written to')
+    parser.add_argument('--csv', default=REFERENCE_CSV,
+                        help='reference dataset (default: the KappaP one)')
+    parser.add_argument('--cutoff', default=0.3, type=float,
+                        help='Kappa_Slack of the positives in W/(m K) '
+                        '(default: 0.3)')
+    parser.add_argument('--recalls', default=[0.8, 0.9, 0.95, 0.99],
+                        type=float, nargs='+',
+                        help='recall targets to report')
+    parser.add_argument('--cif-glob', default=None,
+                        help='CIF files to time the header features on, '
+                        'e.g. "root_dir/*.cif"')
+    args = parser.parse_args()
+
+    features, kappa, is_train = reference_features(args.csv)
+    start = time.perf_counter()
+    prefilter = KappaPrefilter(args.cutoff).fit(features[is_train],
+                                                kappa[is_train])
+    print('trained on {} rows in {:.1f} s, {:.1%} positives'.format(
+        is_train.sum(), time.perf_counter() - start,
+        (kappa[is_train] <= args.cutoff).mean()))
+    print('held-out rows: {}'.format((~is_train).sum()))
+    print('target recall  threshold  recall  pass fraction')
+    for row in recall_table(prefilter, features[~is_train],
+                            kappa[~is_train], args.recalls):
+        print('{:13.2f}  {:9.3f}  {:6.3f}  {:13.3f}'.format(*row))
+    if args.cif_glob:
+        cif_paths = sorted(glob.glob(args.cif_glob))
+        start = time.perf_counter()
+        prefilter.select(cif_paths)
+        print('{} CIFs scored at {:.0f} per second'.format(
+            len(cif_paths), len(cif_paths) / (time.perf_counter() - start)))
+    prefilter.save(args.output)
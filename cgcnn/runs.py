@@ -0,0 +1,116 @@
+from __future__ import print_function, division
+
+import csv
+import json
+import os
+
+
+class ResumableRun(object):
+    """
+    Crash-safe record of a screening run. Results are appended and synced to
+    disk after every batch, so an interrupted run can be restarted and only
+    predicts the structures that are not done yet.
+
+    run_dir
+    ├── run.json       settings the run was started with
+    ├── results.csv    cif_id, target, prediction rows, as completed
+    ├── completed.txt  ids whose rows in results.csv are on disk
+
+    An id is written to completed.txt only after its row is synced, so rows
+    of a batch interrupted half way are dropped when the run is reopened.
+
+    Parameters
+    ----------
+
+    run_dir: str
+        Directory holding the run files, created if needed
+    config: dict
+        JSON serializable settings of the run (model digest, data, seed).
+        Reopening a run with different settings raises ValueError.
+    """
+    def __init__(self, run_dir, config):
+        self.run_dir = run_dir
+        self.results_file = os.path.join(run_dir, 'results.csv')
+        self.completed_file = os.path.join(run_dir, 'completed.txt')
+        if not os.path.exists(run_dir):
+            os.makedirs(run_dir)
+        config_file = os.path.join(run_dir, 'run.json')
+        if os.path.exists(config_file):
+            with open(config_file) as f:
+                saved_config = json.load(f)
+            if saved_config != json.loads(json.dumps(config)):
+                raise ValueError('{} was started with different settings: {}'
+                                 .format(run_dir, saved_config))
+        else:
+            with open(config_file, 'w') as f:
+                json.dump(config, f)
+        self.rows = self._recover()
+
+    def _recover(self):
+        """Read the completed rows and drop everything else from disk"""
+        completed = set()
+        if os.path.exists(self.completed_file):
+            with open(self.completed_file) as f:
+                # a line without newline was cut by a crash
+                completed = set(line[:-1] for line in f
+                                if line.endswith('\n'))
+        rows = {}
+        if os.path.exists(self.results_file):
+            with open(self.results_file, newline='') as f:
+                for row in csv.reader(f):
+                    if row and row[0] in completed and row[0] not in rows:
+                        rows[row[0]] = row
+        # rewrite both files with the completed rows only
+        for path, lines in [(self.results_file, list(rows.values())),
+                            (self.completed_file, [[i] for i in rows])]:
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w', newline='') as f:
+                if path == self.results_file:
+                    csv.writer(f).writerows(lines)
+                else:
+                    f.writelines(line[0] + '\n' for line in lines)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        return rows
+
+    def __contains__(self, cif_id):
+        return cif_id in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def append(self, rows):
+        """Durably append the (cif_id, target, prediction) rows of a batch"""
+        lines = []
+        with open(self.results_file, 'a', newline='') as f:
+            writer = csv.writer(f)
+            for row in rows:
+                if row[0] in self.rows:
+                    continue
+                writer.writerow(row)
+                lines.append([str(x) for x in row])
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.completed_file, 'a') as f:
+            f.writelines(line[0] + '\n' for line in lines)
+            f.flush()
+            os.fsync(f.fileno())
+        for line in lines:
+            self.rows[line[0]] = line
+
+    def finalize(self, cif_ids, out_file):
+        """
+        Write the rows of cif_ids in the given order to out_file, so the
+        output does not depend on where the run was interrupted.
+
+        Returns
+        -------
+
+        missing: list of ids that have no result yet
+        """
+        missing = [cif_id for cif_id in cif_ids if cif_id not in self.rows]
+        with open(out_file, 'w', newline='') as f:
+            csv.writer(f).writerows(self.rows[cif_id] for cif_id in cif_ids
+                                    if cif_id in self.rows)
+        return missing
@@ -0,0 +1,285 @@
+from __future__ import print_function, division
+
+import argparse
+import glob
+import os
+
+import numpy as np
+import torch
+from pymatgen.core.periodic_table import Element
+from pymatgen.core.structure import Structure
+from torch.utils.data import Dataset, DataLoader
+
+from .data import (AtomCustomJSONInitializer, GaussianDistance, collate_pool,
+                   pad_neighbors, truncate_neighbors)
+from .neighbors import NBR_SEARCHES
+
+
+class VariantEngine(object):
+    """
+    Crystal graphs of element-substituted and isotropically strained variants
+    of one parent structure, derived from the parent graph without writing,
+    parsing or searching the neighbors of every variant.
+
+    A substitution keeps the positions, so only the atom features of the
+    substituted sites change. An isotropic strain scales every distance by
+    the same factor, so the distance order of the neighbors is kept and a
+    variant graph is the parent graph with scaled distances, cut at radius.
+    The parent is searched with radius / min_scale so that compressed
+    variants see the neighbors that move inside the cutoff. The graphs are
+    the same as CIFData gives for the written variant CIFs, up to the choice
+    among neighbors tied in distance at the max_num_nbr cutoff.
+
+    Parameters
+    ----------
+
+    parent: pymatgen Structure or str
+        The parent structure or the path to its CIF
+    atom_init_file: str
+        The atom_init.json of the model
+    max_num_nbr, radius, dmin, step, nbr_search:
+        As in CIFData, they must match the training of the model
+    min_scale: float
+        Smallest linear lattice scale factor that will be requested
+    """
+    def __init__(self, parent, atom_init_file, max_num_nbr=12, radius=8,
+                 dmin=0, step=0.2, min_scale=1., nbr_search='radius'):
+        if not isinstance(parent, Structure):
+            parent = Structure.from_file(parent)
+        assert 0 < min_scale <= 1, 'min_scale must be in (0, 1]'
+        assert nbr_search in NBR_SEARCHES, \
+            'nbr_search must be one of {}'.format(sorted(NBR_SEARCHES))
+        self.parent = parent
+        self.max_num_nbr, self.radius = max_num_nbr, radius
+        self.min_scale = min_scale
+        self.ari = AtomCustomJSONInitializer(atom_init_file)
+        self.gdf = GaussianDistance(dmin=dmin, dmax=radius, step=step)
+        self.numbers = np.array([site.specie.number for site in parent])
+        self.atom_fea = self.ari.get_atom_feas(self.numbers)
+        nbr_idx, nbr_dist = NBR_SEARCHES[nbr_search](
+            parent, radius / min_scale, max_num_nbr)
+        # the neighbors are sorted by distance, so only the first
+        # max_num_nbr of every atom can be in any variant graph
+        self.nbr_fea_idx, self.nbr_dist, self.nbr_count = pad_neighbors(
+            nbr_idx, nbr_dist, max_num_nbr, radius / min_scale)
+
+    def site_numbers(self, substitutions=None):
+        """
+        Atomic numbers of the sites after a substitution.
+
+        substitutions: dict
+          Element symbol to element symbol (every site of that element) or
+          site index to element symbol
+        """
+        numbers = self.numbers.copy()
+        for key, new in (substitutions or {}).items():
+            if isinstance(key, str):
+                numbers[self.numbers == Element(key).Z] = Element(new).Z
+            else:
+                numbers[key] = Element(new).Z
+        return numbers
+
+    def graph(self, substitutions=None, scale=1.):
+        """
+        Returns
+        -------
+
+        atom_fea: torch.Tensor shape (n_i, atom_fea_len)
+        nbr_fea: torch.Tensor shape (n_i, M, nbr_fea_len)
+        nbr_fea_idx: torch.LongTensor shape (n_i, M)
+        """
+        assert scale >= self.min_scale, \
+            'scale {} is below min_scale {}'.format(scale, self.min_scale)
+        atom_fea = self.atom_fea
+        if substitutions:
+            numbers = self.site_numbers(substitutions)
+            changed = np.flatnonzero(numbers != self.numbers)
+            atom_fea = atom_fea.copy()
+            atom_fea[changed] = self.ari.get_atom_feas(numbers[changed])
+        nbr_dist = self.nbr_dist * scale
+        real = (np.arange(self.max_num_nbr) < self.nbr_count[:, None]) & \
+            (nbr_dist <= self.radius)
+        nbr_dist = np.where(real, nbr_dist, self.radius + 1.)
+        nbr_fea_idx = np.where(real, self.nbr_fea_idx, 0)
+        return (torch.Tensor(atom_fea),
+                torch.Tensor(self.gdf.expand(nbr_dist)),
+                torch.LongTensor(nbr_fea_idx))
+
+    def crystal_data(self, substitutions=None, scale=1.):
+        """
+        Crystal data of a variant with the keys of
+        streamlit_scripts.file_op.get_crystalline_data
+        """
+        numbers = self.site_numbers(substitutions)
+        mass = float(sum(float(Element.from_Z(z).atomic_mass)
+                         for z in numbers))
+        volume = self.parent.volume * scale ** 3
+        return {'Number of Atoms': len(numbers),
+                # amu / Å3 to g cm-3
+                'Density (g cm-3)': mass / volume * 1.66053906660,
+                'Volume (Å3)': volume,
+                'the total atomic mass (amu)': mass}
+
+    def formula(self, substitutions=None):
+        species = [Element.from_Z(z) for z in self.site_numbers(substitutions)]
+        return Structure(self.parent.lattice, species,
+                         self.parent.frac_coords).composition.reduced_formula
+
+
+class VariantData(Dataset):
+    """
+    Dataset of the variants of a VariantEngine, to be batched with
+    collate_pool like CIFData.
+
+    Parameters
+    ----------
+
+    engine: VariantEngine
+    variants: list of (variant_id, substitutions, scale)
+    """
+    def __init__(self, engine, variants):
+        self.engine = engine
+        self.variants = list(variants)
+
+    def __len__(self):
+        return len(self.variants)
+
+    def __getitem__(self, idx):
+        variant_id, substitutions, scale = self.variants[idx]
+        return self.engine.graph(substitutions, scale), \
+            torch.Tensor([0.]), variant_id
+
+
+def predict_variants(engine, variants, checkpoint_path, batch_size=256):
+    """
+    Predict the property of every variant with a checkpoint of train.py.
+
+    Returns
+    -------
+
+    prediction: np.ndarray shape (len(variants), )
+      Denormalized property for regression, probability of the positive
+      class for classification
+    """
+    from .onnx_export import load_model
+
+    model, normalizer, model_args = load_model(checkpoint_path)
+    max_num_nbr = getattr(model_args, 'max_num_nbr', 12)
+    assert max_num_nbr <= engine.max_num_nbr, \
+        'the model uses {} neighbors, the engine has {}'.format(
+            max_num_nbr, engine.max_num_nbr)
+    loader = DataLoader(VariantData(engine, variants), batch_size=batch_size,
+                        shuffle=False, collate_fn=collate_pool)
+    predictions = []
+    with torch.no_grad():
+        for input, _, _ in loader:
+            output = model(*truncate_neighbors(input, max_num_nbr))
+            if model_args.task == 'classification':
+                predictions.append(torch.exp(output[:, 1]).numpy())
+            else:
+                predictions.append(normalizer.denorm(output[:, 0]).numpy())
+    return np.concatenate(predictions)
+
+
+def screen_variants(engine, variants, model_dir):
+    """
+    Predict every *-pre-trained.pth.tar property of model_dir for the
+    variants and add their crystal data, giving the table of
+    streamlit_scripts.calculate_K. The shipped models predict log10 of the
+    property, so 10 ** prediction is stored as the APP does.
+
+    Returns
+    -------
+
+    pandas.DataFrame indexed by variant id
+    """
+    import pandas as pd
+
+    variant_ids = [variant[0] for variant in variants]
+    df = pd.DataFrame([engine.crystal_data(substitutions, scale)
+                       for _, substitutions, scale in variants],
+                      index=variant_ids)
+    df.insert(0, 'Formula', [engine.formula(substitutions)
+                             for _, substitutions, _ in variants])
+    df.insert(1, 'Scale', [scale for _, _, scale in variants])
+    for checkpoint_path in sorted(glob.glob(
+            os.path.join(model_dir, '*-pre-trained.pth.tar'))):
+        name = os.path.basename(checkpoint_path)[:-len('-pre-trained.pth.tar')]
+        df[name] = np.power(10, predict_variants(engine, variants,
+                                                 checkpoint_path))
+    return df
+
+
+def check_variant_parity(engine, substitutions=None, scale=1.,
+                         nbr_search='radius', atol=1e-6):
+    """
+    Compare a variant graph with the graph featurized from the variant
+    structure itself, as check_neighbor_parity does: the atom features and
+    the neighbor distances must agree, the neighbor indices too except for
+    the neighbors tied in distance with the last kept one.
+
+    Returns
+    -------
+
+    passed: bool
+    """
+    numbers = engine.site_numbers(substitutions)
+    crystal = Structure(engine.parent.lattice.matrix * scale,
+                        [Element.from_Z(z) for z in numbers],
+                        engine.parent.frac_coords)
+    ref_idx, ref_dist = NBR_SEARCHES[nbr_search](
+        crystal, engine.radius, engine.max_num_nbr)
+    ref_atom_fea = engine.ari.get_atom_feas(numbers)
+    atom_fea, _, _ = engine.graph(substitutions, scale)
+    if not np.allclose(atom_fea.numpy(), ref_atom_fea):
+        return False
+    nbr_dist = engine.nbr_dist * scale
+    for i, (ref_i, ref_d) in enumerate(zip(ref_idx, ref_dist)):
+        ref_d = ref_d[:engine.max_num_nbr]
+        count = min(engine.nbr_count[i],
+                    np.sum(nbr_dist[i] <= engine.radius))
+        idx, dist = engine.nbr_fea_idx[i, :count], nbr_dist[i, :count]
+        if len(ref_d) != len(dist) or \
+                not np.allclose(ref_d, dist, rtol=0, atol=atol):
+            return False
+        if len(dist) == 0:
+            continue
+        inner = ref_d < ref_d[-1] - atol
+        if sorted(ref_i[:len(ref_d)][inner]) != \
+                sorted(idx[dist < dist[-1] - atol]):
+            return False
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Screen substituted and strained variants of a crystal')
+    parser.add_argument('parent', help='CIF of the parent structure')
+    parser.add_argument('--substitute', nargs='*', default=[],
+                        metavar='OLD:NEW[,OLD:NEW]',
+                        help='substitutions, e.g. Pb:Sn Pb:Ge,Te:Se')
+    parser.add_argument('--scales', nargs='*', type=float, default=[1.],
+                        help='linear lattice scale factors')
+    parser.add_argument('--model-dir', default='model')
+    parser.add_argument('--atom-init', default=os.path.join('root_dir',
+                                                            'atom_init.json'))
+    parser.add_argument('--out', default='variants.csv')
+    args = parser.parse_args()
+
+    substitutions = [{}] + [dict(pair.split(':') for pair in spec.split(','))
+                            for spec in args.substitute]
+    variants = [('{}_{}'.format('-'.join('{}{}'.format(old, new)
+                                         for old, new in sub.items())
+                                or 'parent', scale), sub, scale)
+                for sub in substitutions for scale in args.scales]
+    engine = VariantEngine(args.parent, args.atom_init,
+                           min_scale=min(args.scales + [1.]))
+    df = screen_variants(engine, variants, args.model_dir)
+    try:
+        import streamlit_scripts.calculate_K as calk
+    except ImportError:
+        pass
+    else:
+        df = calk.cal_custom_table(df)
+    df.to_csv(args.out)
+    print('Wrote {} variants to {}'.format(len(df), args.out))
@@ -2,21 +2,28 @@
 # Author: Zhibin Gao
 # Email: zhibin.gao@xjtu.edu.cn
 import argparse
+import csv
 import os
-import shutil
 import sys
 import time
 
-import numpy as np
 import torch
 import torch.nn as nn
-from sklearn import metrics
 from torch.autograd import Variable
 from torch.utils.data import DataLoader
+from torch.utils.data import Subset
 
+from cgcnn.cache import PredictionCache
 from cgcnn.data import CIFData
+from cgcnn.data import MemoryBudgetBatches
+from cgcnn.data import ShardData
 from cgcnn.data import collate_pool
+from cgcnn.data import collate_sparse_pool
 from cgcnn.model import CrystalGraphConvNet
+from cgcnn.prefilter import load_prefilter
+from cgcnn.runs import ResumableRun
+from cgcnn.utils import AverageMeter, Normalizer, class_eval, mae
+from cgcnn.utils import file_digest, is_out_of_memory, save_checkpoint
 
 # Initialize global variables
 source_path = os.path.abspath(".")
@@ -25,6 +32,11 @@ model_args = None  # Initialize global variable
 best_mae_error = None  # Initialize global variable
 
 parser = argparse.ArgumentParser(description='Crystal gated neural networks')
+# optional so that the APP can import this module with its own command line
+parser.add_argument('root_dir', nargs='?', default=None, metavar='ROOT_DIR',
+                    help='dataset to predict, with id_prop.csv, '
+                    'atom_init.json and the CIFs; the model is read from '
+                    'pre-trained.pth.tar in the working directory')
 parser.add_argument('-b', '--batch-size', default=256, type=int,
                     metavar='N', help='mini-batch size (default: 256)')
 parser.add_argument('-j', '--workers', default=0, type=int, metavar='N',
@@ -33,6 +45,45 @@ parser.add_argument('--disable-cuda', action='store_true',
                     help='Disable CUDA')
 parser.add_argument('--print-freq', '-p', default=10, type=int,
                     metavar='N', help='print frequency (default: 10)')
+parser.add_argument('--sparse-graph', action='store_true',
+                    help='Use edge-list crystal graphs without padded neighbors')
+parser.add_argument('--run-dir', default=None, type=str, metavar='DIR',
+                    help='resumable run: append results per batch to DIR and '
+                    'skip structures finished by an earlier, interrupted run')
+parser.add_argument('--seed', default=123, type=int,
+                    help='random seed for the dataset order (default: 123)')
+parser.add_argument('--backend', default='torch', choices=['torch', 'onnx'],
+                    help='inference runtime; onnx exports the model once and '
+                    'runs it with ONNX Runtime on CPU (default: torch)')
+parser.add_argument('--embedding-lookup', action='store_true',
+                    help='precompute the atom embedding of every element and '
+                    'feed atomic numbers instead of atom features')
+parser.add_argument('--max-conv-memory', default=None, type=float,
+                    metavar='MB', help='convolve the atoms in chunks so that '
+                    'the neighbor tensors of a layer stay below MB megabytes')
+parser.add_argument('--max-batch-memory', default=None, type=float,
+                    metavar='MB', help='fill each batch with crystals up to an '
+                    'estimated MB megabytes instead of --batch-size crystals, '
+                    'and retry batches that fail to allocate at half size')
+parser.add_argument('--factorized-conv', action='store_true',
+                    help='apply the self and neighbor blocks of the '
+                    'convolution weights per atom instead of per edge')
+parser.add_argument('--cache-db', default=None, type=str, metavar='FILE',
+                    help='SQLite prediction cache: structures predicted before '
+                    'with the same checkpoint are read from FILE, new '
+                    'predictions are added to it')
+parser.add_argument('--nbr-search', default='radius',
+                    choices=['radius', 'knn', 'cell_list'],
+                    help='neighbor search backend (default: radius)')
+parser.add_argument('--symmetry-reduce', action='store_true',
+                    help='convolve one atom per class of equivalent atoms '
+                    'and pool with their multiplicities')
+parser.add_argument('--prefilter', default=None, type=str, metavar='FILE',
+                    help='composition prefilter written by cgcnn.prefilter: '
+                    'only the structures it passes are predicted')
+parser.add_argument('--prefilter-recall', default=0.95, type=float,
+                    help='fraction of the low-kappa structures the '
+                    'prefilter keeps (default: 0.95)')
 
 args = parser.parse_args(sys.argv[1:])
 args.cuda = not args.disable_cuda and torch.cuda.is_available()
@@ -58,22 +109,113 @@ def initialize_model_args():
 def main(root_dir_path):
     global args, model_args, best_mae_error
     
-    # Ensure model parameters are initialized
-    if not model_args:
-        if not initialize_model_args():
-            return
+    # Read the model parameters of the current checkpoint, which can be
+    # replaced between calls
+    if not initialize_model_args():
+        return
+    # distilled checkpoints can use fewer neighbors than the default 12
+    max_num_nbr = getattr(model_args, 'max_num_nbr', 12)
     
     # load data
     cif_path = root_dir_path
-    dataset = CIFData(cif_path)
-    collate_fn = collate_pool
-    test_loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True,
-                           num_workers=args.workers, collate_fn=collate_fn,
-                           pin_memory=args.cuda)
+    torch.manual_seed(args.seed)
+    if os.path.exists(os.path.join(cif_path, 'shards.json')):
+        # pre-featurized dataset written by cgcnn.data.pack_dataset
+        assert not args.embedding_lookup, \
+            'shards store atom features, not atomic numbers'
+        assert not args.symmetry_reduce, \
+            'shards store the full graphs'
+        # in the order of the CIFData the shards were packed from
+        dataset = ShardData(cif_path, sparse=args.sparse_graph)
+        assert dataset.max_num_nbr == max_num_nbr, \
+            'the shards have {} neighbors, the model uses {}'.format(
+                dataset.max_num_nbr, max_num_nbr)
+    else:
+        dataset = CIFData(cif_path, max_num_nbr=max_num_nbr,
+                          random_seed=args.seed,
+                          sparse=args.sparse_graph,
+                          nbr_search=args.nbr_search,
+                          atom_numbers=args.embedding_lookup,
+                          symmetry_reduce=args.symmetry_reduce)
+    collate_fn = collate_sparse_pool if args.sparse_graph else collate_pool
+    cache, cached_rows = None, []
+    if args.cache_db and isinstance(dataset, CIFData):
+        # the cached structures are not featurized nor predicted again
+        cache = PredictionCache(args.cache_db)
+        model_key = cache.model_key(
+            model_path, os.path.join(cif_path, 'atom_init.json'),
+            dataset.max_num_nbr, dataset.radius, dataset.dmin, dataset.step,
+            dataset.nbr_search)
+        hashes = {cif_id: cache.file_hash(os.path.join(cif_path, cif_id))
+                  for cif_id, _ in dataset.id_prop_data}
+        cached = cache.get(model_key, hashes.values())
+        cached_rows = [(cif_id, target, cached[hashes[cif_id]])
+                       for cif_id, target in dataset.id_prop_data
+                       if hashes[cif_id] in cached]
+        print("=> cache '{}': {} of {} structures cached".format(
+            args.cache_db, len(cached_rows), len(dataset)))
+    cached_ids = set(row[0] for row in cached_rows)
+    if args.prefilter and isinstance(dataset, CIFData):
+        # the rejected structures get no result, like the cached ones they
+        # are not featurized
+        prefilter = load_prefilter(args.prefilter)
+        candidates = [cif_id for cif_id, _ in dataset.id_prop_data
+                      if cif_id not in cached_ids]
+        passed = prefilter.select([os.path.join(cif_path, cif_id)
+                                   for cif_id in candidates],
+                                  args.prefilter_recall)
+        rejected_ids = set(cif_id for cif_id, keep in zip(candidates, passed)
+                           if not keep)
+        print("=> prefilter '{}': {} of {} structures passed".format(
+            args.prefilter, len(candidates) - len(rejected_ids),
+            len(candidates)))
+    else:
+        rejected_ids = set()
+    skipped_ids = cached_ids | rejected_ids
+    run = None
+    if args.run_dir:
+        # predict in dataset order and skip the finished structures
+        run = ResumableRun(args.run_dir, {
+            'model': file_digest(model_path),
+            'root_dir': os.path.abspath(cif_path),
+            'seed': args.seed,
+            'sparse_graph': args.sparse_graph,
+            'nbr_search': args.nbr_search})
+    if run is not None or cache is not None or rejected_ids:
+        pending = [i for i, data in enumerate(dataset.id_prop_data)
+                   if data[0] not in skipped_ids and
+                   (run is None or data[0] not in run)]
+        if run is not None:
+            print("=> run '{}': {} structures done, {} to predict"
+                  .format(args.run_dir, len(run), len(pending)))
+        shuffle = False
+        test_loader = DataLoader(Subset(dataset, pending),
+                               batch_size=args.batch_size, shuffle=shuffle,
+                               num_workers=args.workers, collate_fn=collate_fn,
+                               pin_memory=args.cuda)
+    else:
+        pending = range(len(dataset))
+        shuffle = True
+        test_loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=shuffle,
+                               num_workers=args.workers, collate_fn=collate_fn,
+                               pin_memory=args.cuda)
+    if not pending:
+        # everything is done, cached or rejected, the model is not even built
+        if run is not None:
+            run.finalize([data[0] for data in dataset.id_prop_data
+                          if data[0] not in skipped_ids], 'test_results.csv')
+        else:
+            open('test_results.csv', 'w').close()
+        if cache is not None:
+            finish_cache(cache, model_key, hashes, cached_rows)
+        return
 
     # build model
-    structures, _, _ = dataset[0]
-    orig_atom_fea_len = structures[0].shape[-1]
+    structures, _, _ = dataset[pending[0]]
+    if args.embedding_lookup:
+        orig_atom_fea_len = dataset.ari.table.shape[-1]
+    else:
+        orig_atom_fea_len = structures[0].shape[-1]
     nbr_fea_len = structures[1].shape[-1]
     model = CrystalGraphConvNet(orig_atom_fea_len, nbr_fea_len,
                                atom_fea_len=model_args.atom_fea_len,
@@ -103,10 +245,80 @@ def main(root_dir_path):
         print("=> no model found at '{}'".format(model_path))
         return
 
-    validate(test_loader, model, criterion, normalizer, test=True)
-
-
-def validate(val_loader, model, criterion, normalizer, test=False):
+    if args.backend == 'onnx':
+        model = load_onnx_model(model_path)
+    elif args.embedding_lookup:
+        model.precompute_embedding(dataset.ari.table)
+    if args.max_conv_memory and args.backend == 'torch':
+        model.set_max_conv_memory(int(args.max_conv_memory * 2 ** 20))
+    if args.factorized_conv and args.backend == 'torch':
+        model.factorize_convs()
+
+    if args.max_batch_memory:
+        assert args.backend == 'torch', \
+            'the memory budget needs the torch backend'
+        # the crystals are featurized before the model is called, so the
+        # batches are built here from the same dataset and order
+        test_loader = MemoryBudgetBatches(
+            test_loader.dataset, collate_fn, model.memory_footprint,
+            int(args.max_batch_memory * 2 ** 20),
+            shuffle=shuffle, num_workers=args.workers)
+
+    validate(test_loader, model, criterion, normalizer, test=True, run=run)
+    if args.max_batch_memory and test_loader.history:
+        n_crystals, _, peaks = zip(*test_loader.history)
+        print("=> {} batches of {:.1f} crystals on average, peak RSS growth "
+              "{:.1f} MB, footprint scale {:.2f}".format(
+                  len(n_crystals), sum(n_crystals) / len(n_crystals),
+                  max(peaks) / 2 ** 20, test_loader.scale))
+    if run is not None:
+        missing = run.finalize([data[0] for data in dataset.id_prop_data
+                                if data[0] not in skipped_ids],
+                               'test_results.csv')
+        if missing:
+            print("=> {} structures have no result".format(len(missing)))
+    if cache is not None:
+        finish_cache(cache, model_key, hashes, cached_rows)
+
+
+def finish_cache(cache, model_key, hashes, cached_rows,
+                 results_file='test_results.csv'):
+    """Store the new predictions of results_file and add the cached ones"""
+    with open(results_file) as f:
+        new_rows = list(csv.reader(f))
+    cache.put(model_key, [(hashes.get(cif_id), float(pred))
+                          for cif_id, _, pred in new_rows])
+    with open(results_file, 'a', newline='') as f:
+        csv.writer(f).writerows(cached_rows)
+
+
+def load_onnx_model(checkpoint_path):
+    """Load the ONNX export of a checkpoint, re-exporting it when stale"""
+    from cgcnn.onnx_export import export_onnx
+    from cgcnn.onnx_runtime import OnnxCrystalGraphConvNet
+
+    assert not args.sparse_graph, 'the onnx backend needs the padded graph'
+    assert not args.embedding_lookup, \
+        'the onnx backend takes atom features'
+    assert not args.symmetry_reduce, \
+        'the onnx backend pools with a plain mean'
+    # one export per checkpoint content, so that the models the APP copies
+    # in turn to the same checkpoint path are exported once each
+    digest = file_digest(checkpoint_path)
+    onnx_path = '{}.{}.onnx'.format(
+        os.path.splitext(os.path.splitext(checkpoint_path)[0])[0],
+        digest[:16])
+    onnx_model = None
+    if os.path.isfile(onnx_path):
+        onnx_model = OnnxCrystalGraphConvNet(onnx_path)
+    if onnx_model is None or onnx_model.checkpoint_sha256 != digest:
+        print("=> exporting '{}' to '{}'".format(checkpoint_path, onnx_path))
+        export_onnx(checkpoint_path, onnx_path)
+        onnx_model = OnnxCrystalGraphConvNet(onnx_path)
+    return onnx_model
+
+
+def validate(val_loader, model, criterion, normalizer, test=False, run=None):
     batch_time = AverageMeter()
     losses = AverageMeter()
     if model_args.task == 'regression':
@@ -125,6 +337,8 @@ def validate(val_loader, model, criterion, normalizer, test=False):
     # switch to evaluate mode
     model.eval()
 
+    # the number of memory-budgeted batches is only known at the end
+    n_batches = len(val_loader) if hasattr(val_loader, '__len__') else '?'
     end = time.time()
     for i, (input, target, batch_cif_ids) in enumerate(val_loader):
         with torch.no_grad():
@@ -132,12 +346,13 @@ def validate(val_loader, model, criterion, normalizer, test=False):
                 input_var = (Variable(input[0].cuda(non_blocking=True)),
                              Variable(input[1].cuda(non_blocking=True)),
                              input[2].cuda(non_blocking=True),
-                             [crys_idx.cuda(non_blocking=True) for crys_idx in input[3]])
+                             [crys_idx.cuda(non_blocking=True) for crys_idx in input[3]]) + \
+                    tuple(weights.cuda(non_blocking=True) for weights in input[4:])
             else:
                 input_var = (Variable(input[0]),
                              Variable(input[1]),
                              input[2],
-                             input[3])
+                             input[3]) + tuple(input[4:])
         if model_args.task == 'regression':
             target_normed = normalizer.norm(target)
         else:
@@ -149,7 +364,21 @@ def validate(val_loader, model, criterion, normalizer, test=False):
                 target_var = Variable(target_normed)
 
         # compute output
-        output = model(*input_var)
+        try:
+            output = model(*input_var)
+        except (MemoryError, RuntimeError) as error:
+            if not isinstance(val_loader, MemoryBudgetBatches) or \
+                    not is_out_of_memory(error):
+                raise
+            if val_loader.retry_smaller():
+                print("=> batch of {} crystals failed to allocate, retrying "
+                      "at half size".format(len(batch_cif_ids)))
+            else:
+                print("=> '{}' does not fit in memory, skipped".format(
+                    batch_cif_ids[0]))
+            continue
+        if not torch.is_tensor(output):
+            output = torch.from_numpy(output)
         loss = criterion(output, target_var)
 
         # measure accuracy and record loss
@@ -163,6 +392,10 @@ def validate(val_loader, model, criterion, normalizer, test=False):
                 test_preds += test_pred.view(-1).tolist()
                 test_targets += test_target.view(-1).tolist()
                 test_cif_ids += batch_cif_ids
+                if run is not None:
+                    run.append(zip(batch_cif_ids,
+                                   test_target.view(-1).tolist(),
+                                   test_pred.view(-1).tolist()))
         else:
             accuracy, precision, recall, fscore, auc_score =\
                 class_eval(output.data.cpu(), target)
@@ -179,6 +412,10 @@ def validate(val_loader, model, criterion, normalizer, test=False):
                 test_preds += test_pred[:, 1].tolist()
                 test_targets += test_target.view(-1).tolist()
                 test_cif_ids += batch_cif_ids
+                if run is not None:
+                    run.append(zip(batch_cif_ids,
+                                   test_target.view(-1).tolist(),
+                                   test_pred[:, 1].tolist()))
 
         # measure elapsed time
         batch_time.update(time.time() - end)
@@ -190,7 +427,7 @@ def validate(val_loader, model, criterion, normalizer, test=False):
                       'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
                       'Loss {loss.val:.4f} ({loss.avg:.4f})\t'
                       'MAE {mae_errors.val:.3f} ({mae_errors.avg:.3f})'.format(
-                       i, len(val_loader), batch_time=batch_time, loss=losses,
+                       i, n_batches, batch_time=batch_time, loss=losses,
                        mae_errors=mae_errors))
             else:
                 print('Test: [{0}/{1}]\t'
@@ -201,13 +438,15 @@ def validate(val_loader, model, criterion, normalizer, test=False):
                       'Recall {recall.val:.3f} ({recall.avg:.3f})\t'
                       'F1 {f1.val:.3f} ({f1.avg:.3f})\t'
                       'AUC {auc.val:.3f} ({auc.avg:.3f})'.format(
-                       i, len(val_loader), batch_time=batch_time, loss=losses,
+                       i, n_batches, batch_time=batch_time, loss=losses,
                        accu=accuracies, prec=precisions, recall=recalls,
                        f1=fscores, auc=auc_scores))
 
-    if test:
+    if test and run is not None:
+        # the run directory holds the results, main writes them in order
+        star_label = '**'
+    elif test:
         star_label = '**'
-        import csv
         with open('test_results.csv', 'w') as f:
             writer = csv.writer(f)
             for cif_id, target, pred in zip(test_cif_ids, test_targets,
@@ -225,79 +464,7 @@ def validate(val_loader, model, criterion, normalizer, test=False):
         return auc_scores.avg
 
 
-class Normalizer(object):
-    """Normalize a Tensor and restore it later. """
-    def __init__(self, tensor):
-        """tensor is taken as a sample to calculate the mean and std"""
-        self.mean = torch.mean(tensor)
-        self.std = torch.std(tensor)
-
-    def norm(self, tensor):
-        return (tensor - self.mean) / self.std
-
-    def denorm(self, normed_tensor):
-        return normed_tensor * self.std + self.mean
-
-    def state_dict(self):
-        return {'mean': self.mean,
-                'std': self.std}
-
-    def load_state_dict(self, state_dict):
-        self.mean = state_dict['mean']
-        self.std = state_dict['std']
-
-
-def mae(prediction, target):
-    """
-    Computes the mean absolute error between prediction and target
-
-    Parameters
-    ----------
-
-    prediction: torch.Tensor (N, 1)
-    target: torch.Tensor (N, 1)
-    """
-    return torch.mean(torch.abs(target - prediction))
-
-
-def class_eval(prediction, target):
-    prediction = np.exp(prediction.numpy())
-    target = target.numpy()
-    pred_label = np.argmax(prediction, axis=1)
-    target_label = np.squeeze(target)
-    if prediction.shape[1] == 2:
-        precision, recall, fscore, _ = metrics.precision_recall_fscore_support(
-            target_label, pred_label, average='binary')
-        auc_score = metrics.roc_auc_score(target_label, prediction[:, 1])
-        accuracy = metrics.accuracy_score(target_label, pred_label)
-    else:
-        raise NotImplementedError
-    return accuracy, precision, recall, fscore, auc_score
-
-
-class AverageMeter(object):
-    """Computes and stores the average and current value"""
-    def __init__(self):
-        self.reset()
-
-    def reset(self):
-        self.val = 0
-        self.avg = 0
-        self.sum = 0
-        self.count = 0
-
-    def update(self, val, n=1):
-        self.val = val
-        self.sum += val * n
-        self.count += n
-        self.avg = self.sum / self.count
-
-
-def save_checkpoint(state, is_best, filename='checkpoint.pth.tar'):
-    torch.save(state, filename)
-    if is_best:
-        shutil.copyfile(filename, 'model_best.pth.tar')
-
-
 if __name__ == '__main__':
-    main()
+    if args.root_dir is None:
+        parser.error('the following arguments are required: ROOT_DIR')
+    main(args.root_dir)
@@ -68,6 +68,43 @@ def cal_A(df, n, custom_gamma=None):
         df[A] = 1 / (1 +1 / gamma_value + 8.3e5 / pow(gamma_value, 2.4))
     return df
 
+def slack_kappa(A, M, V, debye, gamma, N, T=300):
+    """
+    Slack lattice thermal conductivity in W/(m·K), element-wise over scalars,
+    Series or arrays
+
+    :param M: Total atomic mass of the cell (amu)
+    :param V: Cell volume (Å3)
+    :param debye: Acoustic Debye temperature (K)
+    :param N: Number of atoms of the cell
+    """
+    return A * M * np.cbrt(V) * debye ** 3 / (gamma ** 2 * T * N) * 100
+
+def pink_kappa(G, vs, V, N, gamma, T=300):
+    """
+    PINK (MTP) lattice thermal conductivity in W/(m·K), element-wise over
+    scalars, Series or arrays
+
+    :param G: Shear modulus (GPa)
+    :param vs: Speed of sound (m/s)
+    :param V: Cell volume (Å3)
+    :param N: Number of atoms of the cell
+    """
+    return G * 1e9 * vs * np.cbrt(V * 1e-30) / (N * T) * np.exp(-gamma)
+
+def valid_kappa(B, G, gamma, default_gamma, slack, pink):
+    """
+    Whether the inputs give physical kappa values: positive B and G, a
+    positive γ that is also below 10 where it is the default derived from the
+    Poisson ratio, and finite Slack and PINK values. The same rule for the
+    rows of cal_custom_table and the samples of mc_kappa.
+
+    :param default_gamma: Whether γ is the default rather than user-supplied
+    """
+    with np.errstate(invalid="ignore"):
+        return ((B > 0) & (G > 0) & (gamma > 0) & ~(default_gamma & ~(gamma < 10)) &
+                np.isfinite(slack) & np.isfinite(pink))
+
 def cal_K_Slack(df):
     A="A"
     M="the total atomic mass (amu)"
@@ -77,7 +114,7 @@ def cal_K_Slack(df):
     gamma = "Grüneisen parameter"
     T=300
     K_Slack="Kappa_Slack (W m-1 K-1)"
-    df[K_Slack]=df[A]*df[M]*pow(df[V],1/3)*pow(df[Debye],3)/(pow(df[gamma],2)*T*df[N])*100
+    df[K_Slack]=slack_kappa(df[A], df[M], df[V], df[Debye], df[gamma], df[N], T)
     print(df)
     return(df)
 
@@ -97,16 +134,14 @@ def by_MTP(df):
     
     # Get required values and convert to numpy arrays
     gamma = K_df['Grüneisen parameter'].astype(float).values
-    G = K_df['Shear modulus (GPa)'].astype(float).values * 1e9  # Convert to Pa
-    V = K_df['Volume (Å3)'].astype(float).values * 1e-30  # Convert to m³
+    G = K_df['Shear modulus (GPa)'].astype(float).values
+    V = K_df['Volume (Å3)'].astype(float).values
     N = K_df['Number of Atoms'].astype(float).values
     vs = K_df['Speed of sound (m s-1)'].astype(float).values
     T = 300  # Temperature set to 300K
     
     # Calculate thermal conductivity (W/mK)
-    V_term = np.power(V, 1/3)
-    exp_term = np.exp(-gamma)
-    kappa = G * vs * V_term / (N * T) * exp_term
+    kappa = pink_kappa(G, vs, V, N, gamma, T)
     
     # Ensure results are finite values
     kappa = np.where(np.isfinite(kappa), kappa, 0)
@@ -114,5 +149,215 @@ def by_MTP(df):
     
     return K_df
 
+def cal_custom_table(df):
+    """
+    Validate user-supplied elastic parameters and calculate both the Slack
+    (KappaP) and PINK thermal conductivities for a whole table at once
+
+    df holds the crystal columns of get_crystalline_data plus
+    'Bulk modulus (GPa)', 'Shear modulus (GPa)' and, optionally,
+    'Grüneisen parameter' (NaN means use the default derived from B and G).
+    Rows that fail validation keep NaN kappa values and a message in 'Status'.
+    """
+    B = "Bulk modulus (GPa)"
+    G = "Shear modulus (GPa)"
+    gamma = "Grüneisen parameter"
+    table_df = df.copy()
+    if gamma not in table_df.columns:
+        table_df[gamma] = np.nan
+    for col in [B, G, gamma]:
+        table_df[col] = pd.to_numeric(table_df[col], errors="coerce")
+    user_gamma = table_df[gamma]
+
+    status = pd.Series("", index=table_df.index, dtype=object)
+    def flag(mask, message):
+        status[mask] = status[mask] + message + "; "
+
+    flag(table_df[B].isna(), "Missing Bulk modulus")
+    flag(table_df[B] <= 0, "Bulk modulus must be positive")
+    flag(table_df[G].isna(), "Missing Shear modulus")
+    flag(table_df[G] <= 0, "Shear modulus must be positive")
+    flag(user_gamma <= 0, "Grüneisen parameter must be positive")
+
+    with np.errstate(all="ignore"):
+        table_df = cal_Debye_T(table_df)
+        a = (table_df["Sound velocity of the longitude wave (m s-1)"] /
+             table_df["Sound velocity of the transverse wave (m s-1)"])
+        poisson = (a ** 2 - 2) / (2 * a ** 2 - 2)
+        singular = (2 - 3 * poisson).abs() < 1e-10
+        default_gamma = 3 * (1 + poisson) / (2 * (2 - 3 * poisson))
+        default_gamma = default_gamma.where(~singular)
+        use_default = user_gamma.isna() & (table_df[B] > 0) & (table_df[G] > 0)
+        flag(use_default & singular,
+             "Cannot calculate Grüneisen parameter - Invalid Poisson ratio")
+        flag(use_default & ~singular & ~((default_gamma > 0) & (default_gamma < 10)),
+             "Calculated Grüneisen parameter is out of reasonable range (0-10)")
+        table_df = cal_gamma(table_df, user_gamma.fillna(default_gamma))
+        table_df = cal_A(table_df, 1)
+        table_df = cal_K_Slack(table_df)
+        # by_MTP writes 0 for non-finite values, the check needs them as they are
+        pink = pink_kappa(table_df[G], table_df["Speed of sound (m s-1)"], table_df["Volume (Å3)"],
+                          table_df["Number of Atoms"], table_df[gamma])
+        table_df = by_MTP(table_df)
+        valid = valid_kappa(table_df[B], table_df[G], table_df[gamma], user_gamma.isna(),
+                            table_df["Kappa_Slack (W m-1 K-1)"], pink)
+    flag(~valid & (status == ""), "Calculated thermal conductivity is not finite")
+
+    invalid = ~valid
+    table_df.loc[invalid, ["Kappa_Slack (W m-1 K-1)", "Kappa_cal (W m-1 K-1)"]] = np.nan
+    table_df["Status"] = status.str.rstrip("; ").where(invalid, "OK")
+    return table_df
+
+CUSTOM_INPUT_COLUMNS = ["Number of Atoms", "Density (g cm-3)", "Volume (Å3)",
+                        "the total atomic mass (amu)", "Bulk modulus (GPa)",
+                        "Shear modulus (GPa)", "Grüneisen parameter"]
+CUSTOM_OUTPUT_COLUMNS = ["Sound velocity of the longitude wave (m s-1)",
+                         "Sound velocity of the transverse wave (m s-1)",
+                         "Speed of sound (m s-1)", "Acoustic Debye Temperature (K)",
+                         "Poisson ratio", "A", "Kappa_Slack (W m-1 K-1)",
+                         "Kappa_cal (W m-1 K-1)", "Status"]
+
+def update_custom_table(df, cache):
+    """
+    cal_custom_table that only recomputes the rows whose inputs changed
+
+    Every derived quantity of a row (sound velocities, Debye temperature,
+    Poisson ratio, default γ, A and both kappa values) depends only on the
+    CUSTOM_INPUT_COLUMNS of that row, so rows with unchanged inputs are taken
+    from the previous result; the other columns of df are passed through as
+    they are now. cache is a dict kept by the caller (e.g. in
+    st.session_state) and is updated in place.
+    """
+    inputs = df.reindex(columns=CUSTOM_INPUT_COLUMNS).apply(pd.to_numeric, errors="coerce")
+    prev_inputs = cache.get("inputs")
+    prev_table = cache.get("table")
+    if prev_inputs is None:
+        stale = inputs.index
+    else:
+        prev_inputs = prev_inputs.reindex(inputs.index)
+        same = ((inputs == prev_inputs) | (inputs.isna() & prev_inputs.isna())).all(axis=1)
+        same &= inputs.index.isin(prev_table.index)
+        stale = inputs.index[~same]
+
+    if len(stale) == len(inputs):
+        table_df = cal_custom_table(df)
+    else:
+        # the column order of cal_custom_table(df)
+        columns = list(df.columns) + [col for col in ["Grüneisen parameter"] + CUSTOM_OUTPUT_COLUMNS
+                                      if col not in df.columns]
+        kept = inputs.index.difference(stale)
+        passthrough = df.columns.difference(CUSTOM_INPUT_COLUMNS + CUSTOM_OUTPUT_COLUMNS)
+        reused = prev_table.loc[kept].drop(columns=passthrough, errors="ignore").join(
+            df.loc[kept, passthrough])
+        parts = [reused] + ([cal_custom_table(df.loc[stale])] if len(stale) else [])
+        table_df = pd.concat(parts).loc[inputs.index, columns]
+    cache["inputs"] = inputs
+    cache["table"] = table_df
+    cache["n_updated"] = len(stale)
+    return table_df
+
+def _sample(rng, mean, std, n_samples, distribution):
+    """Draw (materials, n_samples) samples with the given per-material mean and std"""
+    mean = mean[:, None].astype(np.float32)
+    std = np.nan_to_num(std)[:, None].astype(np.float32)
+    if not std.any():
+        return mean
+    z = rng.standard_normal((mean.shape[0], n_samples), dtype=np.float32)
+    if distribution == "lognormal":
+        # moment-matched, keeps the samples positive
+        sigma2 = np.log1p((std / mean) ** 2)
+        return mean * np.exp(np.sqrt(sigma2) * z - sigma2 / 2)
+    return mean + std * z
+
+def _valid_percentile(values, valid, percentiles):
+    """
+    Row-wise np.percentile (linear method) over the valid entries only, in one
+    sort instead of the per-row loop of np.nanpercentile. Rows without valid
+    entries give NaN.
+    """
+    values = np.sort(np.where(valid, values, np.inf), axis=1)
+    n_valid = valid.sum(axis=1)
+    pos = (n_valid[:, None] - 1) * (np.asarray(percentiles, dtype=float) / 100)
+    lower = np.clip(np.floor(pos).astype(int), 0, None)
+    upper = np.clip(np.minimum(lower + 1, n_valid[:, None] - 1), 0, None)
+    lower_values = np.take_along_axis(values, lower, axis=1)
+    upper_values = np.take_along_axis(values, upper, axis=1)
+    with np.errstate(invalid="ignore"):
+        result = lower_values + (upper_values - lower_values) * (pos - lower)
+    result[n_valid == 0] = np.nan
+    return result
+
+def mc_kappa(df, n_samples=10000, percentiles=(5, 50, 95), distribution="normal",
+             seed=0, max_chunk_elements=2 ** 18):
+    """
+    Monte Carlo propagation of the uncertainty of B, G and γ to both kappa values
+
+    df holds the crystal columns of get_crystalline_data, the means
+    'Bulk modulus (GPa)', 'Shear modulus (GPa)', optionally
+    'Grüneisen parameter' (NaN means the default derived from the sampled B
+    and G) and the standard deviations 'Bulk modulus std (GPa)',
+    'Shear modulus std (GPa)' and 'Grüneisen parameter std' (missing or NaN
+    means exact). The samples of all materials go through cal_Debye_T,
+    cal_gamma and cal_A as (materials, samples) arrays, in chunks of at most
+    max_chunk_elements values so the memory does not grow with the table.
+    Samples that fail valid_kappa, the rule of cal_custom_table (e.g.
+    negative normal draws), are dropped and counted in 'Valid samples'.
+
+    Returns a DataFrame with one 'Kappa_Slack (W m-1 K-1) P<q>' and
+    'Kappa_cal (W m-1 K-1) P<q>' column per percentile q.
+    """
+    B = "Bulk modulus (GPa)"
+    G = "Shear modulus (GPa)"
+    gamma = "Grüneisen parameter"
+    def column(name):
+        if name not in df.columns:
+            return np.full(len(df), np.nan)
+        return pd.to_numeric(df[name], errors="coerce").to_numpy(dtype=float)
+
+    crystal = {col: column(col) for col in ["Number of Atoms", "Density (g cm-3)",
+                                            "Volume (Å3)", "the total atomic mass (amu)"]}
+    means = {B: column(B), G: column(G), gamma: column(gamma)}
+    stds = {B: column("Bulk modulus std (GPa)"), G: column("Shear modulus std (GPa)"),
+            gamma: column("Grüneisen parameter std")}
+
+    rng = np.random.default_rng(seed)
+    chunk = max(1, max_chunk_elements // n_samples)
+    kappas = {"Kappa_Slack (W m-1 K-1)": [], "Kappa_cal (W m-1 K-1)": []}
+    n_valid = []
+    for start in range(0, len(df), chunk):
+        rows = slice(start, start + chunk)
+        samples = {col: crystal[col][rows, None].astype(np.float32) for col in crystal}
+        with np.errstate(all="ignore"):
+            for col in [B, G]:
+                samples[col] = _sample(rng, means[col][rows], stds[col][rows], n_samples, distribution)
+            user_gamma = _sample(rng, means[gamma][rows], stds[gamma][rows], n_samples, distribution)
+            samples = cal_Debye_T(samples)
+            # default γ from the sampled Poisson ratio where no γ is given
+            samples = cal_gamma(samples)
+            samples[gamma] = np.where(np.isnan(user_gamma), samples[gamma], user_gamma)
+            samples = cal_A(samples, 1)
+            slack = slack_kappa(samples["A"], samples["the total atomic mass (amu)"], samples["Volume (Å3)"],
+                                samples["Acoustic Debye Temperature (K)"], samples[gamma], samples["Number of Atoms"])
+            pink = pink_kappa(samples[G], samples["Speed of sound (m s-1)"], samples["Volume (Å3)"],
+                              samples["Number of Atoms"], samples[gamma])
+            valid = valid_kappa(samples[B], samples[G], samples[gamma], np.isnan(user_gamma), slack, pink)
+        # exact inputs broadcast to a single sample per material
+        valid = np.broadcast_to(valid, (len(means[B][rows]), n_samples))
+        n_valid.append(valid.sum(axis=1))
+        for name, values in [("Kappa_Slack (W m-1 K-1)", slack), ("Kappa_cal (W m-1 K-1)", pink)]:
+            values = np.broadcast_to(values, valid.shape)
+            if valid.all():
+                kappas[name].append(np.percentile(values, percentiles, axis=1).T)
+            else:
+                kappas[name].append(_valid_percentile(values, valid, percentiles))
+
+    result = pd.DataFrame(index=df.index)
+    for name, values in kappas.items():
+        values = np.concatenate(values) if values else np.empty((0, len(percentiles)))
+        for i, q in enumerate(percentiles):
+            result[f"{name} P{q:g}"] = values[:, i]
+    result["Valid samples"] = np.concatenate(n_valid) if n_valid else np.empty(0, dtype=int)
+    return result
+
 if __name__=="__main__":
     pass
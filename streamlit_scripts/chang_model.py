@@ -9,6 +9,9 @@ import pandas as pd
 import streamlit as st
 import numpy as np
 
+# Predictions shared by all pages and sessions (see predict_models)
+CACHE_DB = os.path.join(os.path.abspath('.'), "cache", "predictions.sqlite")
+
 def copy_model(model_path, sour_path):
     """
     Copy model file to target path
@@ -92,6 +95,71 @@ def get_pre_dataframe(results_csv_path, model_name):
         print(f"Error in get_pre_dataframe: {str(e)}")
         return pd.DataFrame()
 
+def predict_models(root_dir_path, model_dir, sour_path, cache_db=CACHE_DB):
+    """
+    Predict the CIFs of root_dir_path with every model of model_dir and merge
+    the results. Predictions are read from and added to the persistent cache
+    at cache_db, shared by all pages and sessions; the predictions of
+    checkpoints that are no longer in model_dir are dropped from it.
+
+    :return: (prediction dataframe, dict with the cache hits and misses of this call and the cache statistics)
+    """
+    import predict
+    from cgcnn.cache import PredictionCache
+
+    model_path_list, model_name_list = get_model_path(model_dir)
+    results_csv_path = os.path.join(sour_path, "test_results.csv")
+    cache = PredictionCache(cache_db)
+    # keeps the predictions of these checkpoints with any graph settings, e.g. from predict.py
+    cache.prune_checkpoints(model_path_list)
+    before = cache.stats()
+
+    predict.args.cache_db = cache_db
+    pre_df = None
+    for model_path, model_name in zip(model_path_list, model_name_list):
+        try:
+            copy_model(model_path, sour_path)
+            predict.main(root_dir_path)
+            pre_df1 = get_pre_dataframe(results_csv_path, model_name)
+            pre_df = pre_df1 if pre_df is None else pd.merge(pre_df, pre_df1, left_index=True, right_index=True)
+        finally:
+            clean_model(sour_path)
+
+    stats = cache.stats()
+    stats["run_hits"] = stats["hits"] - before["hits"]
+    stats["run_misses"] = stats["misses"] - before["misses"]
+    return pre_df, stats
+
+@st.cache_resource(show_spinner="Training the composition prefilter...")
+def load_prefilter(cutoff=0.3):
+    """Composition prefilter trained on the reference dataset, shared by all sessions"""
+    from cgcnn.prefilter import KappaPrefilter, reference_features
+    features, kappa, _ = reference_features()
+    return KappaPrefilter(cutoff).fit(features, kappa)
+
+def prefilter_id_prop(root_dir_path, recall, cutoff=0.3):
+    """
+    Keep in id_prop.csv only the CIFs that pass the composition prefilter, so
+    that predict_models does not featurize nor predict the others.
+
+    :param recall: Fraction of the structures with Kappa_Slack <= cutoff the prefilter keeps
+    :return: (names of the CIFs passed, names of the CIFs rejected)
+    """
+    csv_path = os.path.join(root_dir_path, 'id_prop.csv')
+    df = pd.read_csv(csv_path)
+    passed = load_prefilter(cutoff).select(
+        [os.path.join(root_dir_path, name) for name in df['name']], recall)
+    df[passed].to_csv(csv_path, index=False)
+    return df['name'][passed].tolist(), df['name'][~passed].tolist()
+
+def cache_summary(stats):
+    """One line description of the prediction cache statistics"""
+    summary = (f"Prediction cache: {stats['run_hits']} of {stats['run_hits'] + stats['run_misses']} "
+               f"predictions reused, {stats['entries']} stored")
+    if stats["hit_rate"] is not None:
+        summary += f", {stats['hit_rate']:.1%} hit rate overall"
+    return summary
+
 if __name__=="__main__":
     path=r"D:\pycharm\Thermo_Conductivity_APP\model"
     new_path=r"D:\pycharm\Thermo_Conductivity_APP"
@@ -6,65 +6,349 @@
 import os
 import io
 import glob
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import tarfile
+import zipfile
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
 import pandas as pd
 import streamlit as st
 from pymatgen.core import Structure
 from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
 from pymatgen.io.cif import CifWriter
 
-def process_and_save_uploaded_files(uploaded_files, root_dir_path):
+_INGEST_POOL = None
+
+# Upload types accepted by the sidebar, archives are read member by member
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+UPLOAD_TYPES = ["cif", "CIF", "zip", "tar", "gz", "tgz", "bz2", "xz"]
+# Converted archive members, one directory per archive content
+UPLOAD_SPOOL = os.path.join(os.path.abspath('.'), "cache", "uploads")
+
+def _get_ingest_pool(max_workers):
+    """Worker processes shared by all sessions, started once"""
+    global _INGEST_POOL
+    if _INGEST_POOL is None:
+        # spawn: forking the threaded Streamlit server is not safe
+        _INGEST_POOL = ProcessPoolExecutor(max_workers=max_workers,
+                                           mp_context=multiprocessing.get_context("spawn"))
+    return _INGEST_POOL
+
+def _reset_ingest_pool():
+    """
+    Drop a pool broken by a dead worker (e.g. killed for memory), the next
+    _get_ingest_pool starts a new one. The caller converts what is left of
+    its files in this process.
+    """
+    global _INGEST_POOL
+    if _INGEST_POOL is not None:
+        _INGEST_POOL.shutdown(wait=False, cancel_futures=True)
+        _INGEST_POOL = None
+
+def convert_cif(data, keep_structure=True):
+    """
+    Parse CIF bytes, reduce the structure to the primitive cell and write it
+    back as CIF text. Runs in the ingestion worker processes.
+
+    :param keep_structure: Return the primitive structure too, archives only need the text
+    :return: (cif_text, primitive_structure, None) or (None, None, error message)
+    """
+    try:
+        structure = Structure.from_str(data.decode("utf-8"), fmt="cif")
+        primitive_structure = structure.get_primitive_structure()
+        cif_text = str(CifWriter(primitive_structure, symprec=0.1))
+        return cif_text, primitive_structure if keep_structure else None, None
+    except Exception as e:
+        return None, None, str(e)
+
+def is_archive(file_name):
+    return file_name.lower().endswith(ARCHIVE_SUFFIXES)
+
+def iter_archive_cifs(fileobj, file_name):
+    """
+    Yield (member name, CIF bytes) of the CIF members of a zip or tar archive,
+    reading one member at a time. Tar archives are read as a stream, zip
+    archives through their central directory.
+    """
+    def is_cif(name):
+        base_name = os.path.basename(name)
+        # skip the resource forks of macOS archives
+        return base_name.lower().endswith(".cif") and not base_name.startswith(".")
+
+    if file_name.lower().endswith(".zip"):
+        with zipfile.ZipFile(fileobj) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and is_cif(info.filename):
+                    with archive.open(info) as member:
+                        yield info.filename, member.read()
+    else:
+        with tarfile.open(fileobj=fileobj, mode="r|*") as archive:
+            for info in archive:
+                if info.isfile() and is_cif(info.name):
+                    yield info.name, archive.extractfile(info).read()
+
+def file_sha1(fileobj, chunk_size=1 << 20):
+    """SHA-1 of a file object read in chunks, leaving it at the start"""
+    digest = hashlib.sha1()
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(chunk_size), b""):
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+def _prune_spool(keep, max_spools=8, min_age=3600):
+    """
+    Remove the oldest archive spools beyond max_spools. Spools used within
+    min_age seconds are kept, another session may be linking them, and so
+    are the temporary directories of conversions still running.
+    """
+    spools = sorted(glob.glob(os.path.join(UPLOAD_SPOOL, "*")), key=os.path.getmtime, reverse=True)
+    for spool_dir in spools[max_spools:]:
+        if os.path.basename(spool_dir) not in keep and time.time() - os.path.getmtime(spool_dir) > min_age:
+            shutil.rmtree(spool_dir, ignore_errors=True)
+    # conversions interrupted for a day are not coming back
+    for temp_dir in glob.glob(os.path.join(UPLOAD_SPOOL, ".tmp-*")):
+        if time.time() - os.path.getmtime(temp_dir) > 86400:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+def spool_names(member_names):
+    """
+    File names of archive members in root_dir: the base name of the member,
+    or its whole path joined by "__" when members of different directories
+    share the base name, e.g. a/x.cif and b/x.cif give a__x.cif and b__x.cif.
+    """
+    base_names = [os.path.basename(name) for name in member_names]
+    counts = {}
+    for base_name in base_names:
+        counts[base_name] = counts.get(base_name, 0) + 1
+    return {name: base_name if counts[base_name] == 1 else
+            "__".join(part for part in name.split("/") if part not in ("", "."))
+            for name, base_name in zip(member_names, base_names)}
+
+def _convert_archive(uploaded_file, spool_dir, max_workers, max_pending):
+    """
+    Convert the CIF members of an archive into spool_dir, each one as
+    <index>.cif. index.json maps these files to the member names and holds
+    the conversion errors, it is written last and marks the spool complete.
+    """
+    members = {}
+    errors = {}
+    seen = set()
+    # the number of members of a streamed tar is not known in advance
+    status = st.sidebar.empty()
+    status.caption(f"Processing {uploaded_file.name}...")
+
+    def done(member_name, index, result):
+        cif_text, _, error = result
+        if member_name in seen:
+            # a zip can hold the same path twice
+            errors[member_name] = "duplicate member, only the first one is used"
+            return
+        seen.add(member_name)
+        if error is None:
+            spool_name = f"{index:06d}.cif"
+            with open(os.path.join(spool_dir, spool_name), "w") as f:
+                f.write(cif_text)
+            members[spool_name] = member_name
+        else:
+            errors[member_name] = error
+        status.caption(f"{uploaded_file.name}: processed {len(seen)} files")
+
+    archive_members = enumerate(iter_archive_cifs(uploaded_file, uploaded_file.name))
+    if max_workers > 1:
+        max_pending = max_pending or 4 * max_workers
+        # member name, index and data of the members in the workers
+        futures = {}
+        item = None
+        try:
+            pool = _get_ingest_pool(max_workers)
+            for index, (member_name, data) in archive_members:
+                item = member_name, index, data
+                futures[pool.submit(convert_cif, data, False)] = item
+                item = None
+                if len(futures) >= max_pending:
+                    finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        done(*futures[future][:2], future.result())
+                        del futures[future]
+            for future in as_completed(futures):
+                done(*futures[future][:2], future.result())
+                del futures[future]
+        except BrokenProcessPool:
+            _reset_ingest_pool()
+            for member_name, index, data in list(futures.values()) + ([item] if item else []):
+                done(member_name, index, convert_cif(data, False))
+    # the members left when the pool broke, or all of them without a pool
+    for index, (member_name, data) in archive_members:
+        done(member_name, index, convert_cif(data, False))
+    status.empty()
+    with open(os.path.join(spool_dir, "index.json"), "w") as f:
+        json.dump({"members": members, "errors": errors}, f)
+
+def process_archive(uploaded_file, root_dir_path, max_workers=1, max_pending=None, reserved=None):
+    """
+    Convert the CIF members of an uploaded archive and place them in root_dir.
+
+    Members are read one at a time and at most max_pending of them are being
+    converted at once, each converted CIF is written to the spool directory
+    of the archive as soon as it is done. Memory therefore does not grow with
+    the archive. The spool is kept by archive content, so reruns and repeated
+    uploads only link the converted files into root_dir. It is converted in
+    a temporary directory and moved into place when complete, so sessions
+    uploading the same archive never see each other's partial spool.
+
+    :param reserved: File names already taken in root_dir, e.g. by loose uploads
+        or other archives. Members with these names are reported as errors, the
+        names of the members placed are added to it.
+    :return: (file names of the converted structures in root_dir, {member name: error message})
+    """
+    reserved = set() if reserved is None else reserved
+    digest = file_sha1(uploaded_file)
+    spool_dir = os.path.join(UPLOAD_SPOOL, digest)
+    index_path = os.path.join(spool_dir, "index.json")
+    if not os.path.exists(index_path):
+        os.makedirs(UPLOAD_SPOOL, exist_ok=True)
+        temp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=UPLOAD_SPOOL)
+        try:
+            _convert_archive(uploaded_file, temp_dir, max_workers, max_pending)
+        except BaseException:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+        try:
+            os.replace(temp_dir, spool_dir)
+        except OSError:
+            if os.path.exists(index_path):
+                # another session finished the same archive first
+                shutil.rmtree(temp_dir, ignore_errors=True)
+            else:
+                # a spool of an older version without index.json
+                shutil.rmtree(spool_dir, ignore_errors=True)
+                os.replace(temp_dir, spool_dir)
+    else:
+        os.utime(spool_dir)
+    with open(index_path) as f:
+        index = json.load(f)
+    _prune_spool(keep={digest})
+
+    errors = dict(index["errors"])
+    names = spool_names(list(index["members"].values()))
+    placed = []
+    for spool_name, member_name in sorted(index["members"].items()):
+        file_name = names[member_name]
+        if file_name in reserved:
+            errors[member_name] = f"not added, {file_name} is already uploaded"
+            continue
+        reserved.add(file_name)
+        spool_path = os.path.join(spool_dir, spool_name)
+        target_path = os.path.join(root_dir_path, file_name)
+        if os.path.exists(target_path):
+            os.remove(target_path)
+        try:
+            os.link(spool_path, target_path)
+        except OSError:
+            shutil.copyfile(spool_path, target_path)
+        placed.append(file_name)
+    return placed, errors
+
+def process_and_save_uploaded_files(uploaded_files, root_dir_path, max_workers=None):
     """
     Process and save uploaded files, converting structures to primitive format.
 
+    New uploads are converted in parallel by a pool of worker processes with
+    per-file progress in the sidebar. Conversions are kept in the session by
+    file name and content, so reruns only rewrite the files. Archives are
+    converted member by member by process_archive, their results are stored
+    in st.session_state.archive_results by archive name and the names of
+    their files in st.session_state.spooled_files.
+
     :param uploaded_files: List of uploaded files
     :param root_dir_path: Root directory path for saving files
+    :param max_workers: Number of worker processes, the number of CPUs by default
     :return: Dictionary with filenames as keys and primitive structure objects as values
     """
     # Ensure directory exists
     if not os.path.exists(root_dir_path):
         os.makedirs(root_dir_path)
-    
+    max_workers = max_workers or os.cpu_count() or 1
+
+    # loose uploads keep their names, archive members cannot overwrite them
+    reserved = {uploaded_file.name for uploaded_file in uploaded_files if not is_archive(uploaded_file.name)}
+    archive_results = {}
+    spooled_files = set()
+    for uploaded_file in uploaded_files:
+        if is_archive(uploaded_file.name):
+            placed, errors = process_archive(uploaded_file, root_dir_path, max_workers, reserved=reserved)
+            archive_results[uploaded_file.name] = len(placed), errors
+            spooled_files.update(placed)
+    st.session_state.archive_results = archive_results
+    st.session_state.spooled_files = spooled_files
+    uploaded_files = [uploaded_file for uploaded_file in uploaded_files if not is_archive(uploaded_file.name)]
+
+    # Conversions of the current uploads, keyed by name and content hash
+    keys = {uploaded_file.name: (uploaded_file.name, file_sha1(uploaded_file))
+            for uploaded_file in uploaded_files}
+    previous = st.session_state.get("converted_uploads", {})
+    converted = {key: previous[key] for key in keys.values() if key in previous}
+    pending = [uploaded_file for uploaded_file in uploaded_files
+               if keys[uploaded_file.name] not in converted]
+
+    if pending:
+        progress = st.sidebar.progress(0., text=f"Processing {len(pending)} files...")
+        status = st.sidebar.container()
+        def done(uploaded_file, result, n_done):
+            converted[keys[uploaded_file.name]] = result
+            progress.progress(n_done / len(pending), text=f"Processed {n_done}/{len(pending)} files")
+            if result[2] is not None:
+                status.write(f"✗ {uploaded_file.name}: {result[2]}")
+
+        n_done = 0
+        if max_workers > 1 and len(pending) > 1:
+            try:
+                pool = _get_ingest_pool(max_workers)
+                futures = {pool.submit(convert_cif, uploaded_file.getvalue()): uploaded_file
+                           for uploaded_file in pending}
+                for future in as_completed(futures):
+                    n_done += 1
+                    done(futures[future], future.result(), n_done)
+            except BrokenProcessPool:
+                _reset_ingest_pool()
+                n_done = sum(keys[uploaded_file.name] in converted for uploaded_file in pending)
+        # the files left when the pool broke, or all of them without a pool
+        for uploaded_file in pending:
+            if keys[uploaded_file.name] not in converted:
+                n_done += 1
+                done(uploaded_file, convert_cif(uploaded_file.getvalue()), n_done)
+        progress.empty()
+    st.session_state.converted_uploads = converted
+
     # Store converted structures
     primitive_structures = {}
-        
-    # Save uploaded files and convert to primitive format
+
+    # Save the converted files, or the original file if conversion failed
     for uploaded_file in uploaded_files:
-        try:
-            # Get file content as string
-            string_data = uploaded_file.getvalue().decode("utf-8")
-            
-            # Create a StringIO object
-            from io import StringIO
-            structure_string = StringIO(string_data)
-            
-            # Parse structure using pymatgen
-            structure = Structure.from_str(string_data, fmt="cif")
-            
-            # Get primitive structure
-            primitive_structure = structure.get_primitive_structure()
-            
-            # Save structure object to dictionary
-            file_name = os.path.splitext(uploaded_file.name)[0]  # Remove extension
+        cif_text, primitive_structure, error = converted[keys[uploaded_file.name]]
+        file_name = os.path.splitext(uploaded_file.name)[0]  # Remove extension
+        save_path = os.path.join(root_dir_path, uploaded_file.name)
+        if error is None:
             primitive_structures[file_name] = primitive_structure
-            
-            # Create CIF writer and save file
-            writer = CifWriter(primitive_structure, symprec=0.1)
-            save_path = os.path.join(root_dir_path, uploaded_file.name)
-            writer.write_file(save_path)
-            
-            print(f"Successfully processed {file_name}")
-            
-        except Exception as e:
-            print(f"Error processing {uploaded_file.name}: {str(e)}")
-            try:
-                # If conversion fails, try to save original file
-                save_path = os.path.join(root_dir_path, uploaded_file.name)
-                with open(save_path, "wb") as f:
-                    f.write(uploaded_file.getvalue())
-                print(f"Saved original file {uploaded_file.name}")
-            except Exception as save_error:
-                print(f"Error saving original file {uploaded_file.name}: {str(save_error)}")
-    
+            with open(save_path, "w") as f:
+                f.write(cif_text)
+            continue
+
+        print(f"Error processing {uploaded_file.name}: {error}")
+        try:
+            # If conversion fails, try to save original file
+            with open(save_path, "wb") as f:
+                f.write(uploaded_file.getvalue())
+            print(f"Saved original file {uploaded_file.name}")
+        except Exception as save_error:
+            print(f"Error saving original file {uploaded_file.name}: {str(save_error)}")
+
     # Save structure dictionary to session state
     st.session_state.primitive_structures = primitive_structures
     return primitive_structures
@@ -92,6 +376,12 @@ def get_crystalline_data(structure):
         print(f"Error in get_crystalline_data: {str(e)}")
         return None
 
+@st.cache_data(show_spinner=False, max_entries=4096)
+def get_cif_crystalline_data(cif_text):
+    """Crystal data of the primitive cell of a CIF, cached by the CIF text"""
+    structure = Structure.from_str(cif_text, fmt="cif")
+    return get_crystalline_data(structure.get_primitive_structure())
+
 def get_dir_crystalline_data(root_dir_path):
     """Get crystal data for all structures in directory (primitive structures)"""
     try:
@@ -114,13 +404,13 @@ def get_dir_crystalline_data(root_dir_path):
                 
                 # First try to get primitive structure from session state
                 if hasattr(st.session_state, 'primitive_structures') and file_name in st.session_state.primitive_structures:
-                    primitive_structure = st.session_state.primitive_structures[file_name]
+                    data = get_crystalline_data(st.session_state.primitive_structures[file_name])
                 else:
-                    # If not in session state, read and convert
-                    structure = Structure.from_file(cif_path)
-                    primitive_structure = structure.get_primitive_structure()
-                
-                data = get_crystalline_data(primitive_structure)
+                    # Cached by the CIF text, so reruns (e.g. every table edit) do not parse it again.
+                    # Spooled CIFs are reduced again: the symmetrized CIF of a primitive cell
+                    # can read back as the conventional cell (e.g. MgAl2O4)
+                    with open(cif_path) as f:
+                        data = get_cif_crystalline_data(f.read())
                 
                 if data is not None:
                     data_list.append(data)
@@ -148,43 +438,46 @@ def get_dir_crystalline_data(root_dir_path):
         print(f"Error in get_dir_crystalline_data: {str(e)}")
         return pd.DataFrame()
 
+@st.cache_data(show_spinner=False, max_entries=4096)
+def analyze_symmetry(cif_text, symprec=0.01):
+    """
+    Space group and standardized primitive lattice of a structure.
+
+    Streamlit caches the result by the hash of the CIF text, so every
+    structure is analyzed once and shared across reruns, pages and sessions.
+    """
+    structure = Structure.from_str(cif_text, fmt="cif")
+    analyzer = SpacegroupAnalyzer(structure, symprec=symprec)
+    primitive_structure = analyzer.get_primitive_standard_structure()
+    lattice = primitive_structure.lattice
+    return {
+        'formula': primitive_structure.composition.formula,
+        'spacegroup_symbol': analyzer.get_space_group_symbol(),
+        'spacegroup_number': analyzer.get_space_group_number(),
+        '_cell_length_a': lattice.a,
+        '_cell_length_b': lattice.b,
+        '_cell_length_c': lattice.c,
+        '_cell_angle_alpha': lattice.alpha,
+        '_cell_angle_beta': lattice.beta,
+        '_cell_angle_gamma': lattice.gamma
+    }
+
 def get_crystalline_content(cif_path):
     """Get crystal structure content"""
     try:
-        # Get primitive structure from filename
-        file_name = os.path.basename(cif_path)
-        if hasattr(st.session_state, 'primitive_structures') and file_name in st.session_state.primitive_structures:
-            primitive_structure = st.session_state.primitive_structures[file_name]
-        else:
-            # If not in session state, read and convert
-            structure = Structure.from_file(cif_path)
-            analyzer = SpacegroupAnalyzer(structure)
-            primitive_structure = analyzer.get_primitive_standard_structure()
-        
-        # Get lattice parameters
-        lattice = primitive_structure.lattice
-        cell_params = {
-            '_cell_length_a': lattice.a,
-            '_cell_length_b': lattice.b,
-            '_cell_length_c': lattice.c,
-            '_cell_angle_alpha': lattice.alpha,
-            '_cell_angle_beta': lattice.beta,
-            '_cell_angle_gamma': lattice.gamma
-        }
-        
-        # Get space group info
-        spacegroup_info = primitive_structure.get_space_group_info()
-        
+        with open(cif_path) as f:
+            info = analyze_symmetry(f.read())
+
         content = f"""
         <p style='font-size: 18px;'>
-        Formula: {primitive_structure.composition.formula}<br>
-        Space group: {spacegroup_info[0]} ({spacegroup_info[1]})<br>
-        _cell_length_a     {cell_params['_cell_length_a']:.8f}<br>
-        _cell_length_b     {cell_params['_cell_length_b']:.8f}<br>
-        _cell_length_c     {cell_params['_cell_length_c']:.8f}<br>
-        _cell_angle_alpha  {cell_params['_cell_angle_alpha']:.8f}<br>
-        _cell_angle_beta   {cell_params['_cell_angle_beta']:.8f}<br>
-        _cell_angle_gamma  {cell_params['_cell_angle_gamma']:.8f}<br>
+        Formula: {info['formula']}<br>
+        Space group: {info['spacegroup_symbol']} ({info['spacegroup_number']})<br>
+        _cell_length_a     {info['_cell_length_a']:.8f}<br>
+        _cell_length_b     {info['_cell_length_b']:.8f}<br>
+        _cell_length_c     {info['_cell_length_c']:.8f}<br>
+        _cell_angle_alpha  {info['_cell_angle_alpha']:.8f}<br>
+        _cell_angle_beta   {info['_cell_angle_beta']:.8f}<br>
+        _cell_angle_gamma  {info['_cell_angle_gamma']:.8f}<br>
         </p>
         """
         return content
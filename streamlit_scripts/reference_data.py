@@ -0,0 +1,130 @@
+#!/user/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024 Zhibin Gao's Group. All rights reserved.
+# Author: Zhibin Gao
+# Email: zhibin.gao@xjtu.edu.cn
+import os
+import ast
+import itertools
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+REFERENCE_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             "KappaP_Supporting_Information", "Nature-filtered-low-kappa.csv")
+
+def chemical_system(elements):
+    """Chemical system of a list of element symbols, e.g. Pb-Te"""
+    return "-".join(sorted(set(elements)))
+
+def enumerate_keys(keys):
+    return ((key, row) for row, key in enumerate(keys))
+
+def inverted_index(pairs):
+    """Dictionary of key to the array of its rows, from (key, row) pairs"""
+    index = {}
+    for key, row in pairs:
+        index.setdefault(key, []).append(row)
+    return {key: np.array(rows, dtype=np.int64) for key, rows in index.items()}
+
+class ReferenceData:
+    """
+    The reference low-kappa dataset in columnar form with inverted indexes.
+
+    The table is read once: numeric columns become float arrays and the
+    Elements lists are parsed into tuples. Rows are found through inverted
+    indexes (element, chemical system, space group number and crystal
+    system to row numbers) and through the sorted order of the numeric
+    columns for ranges, so a query does not scan the table.
+    """
+    def __init__(self, csv_path=REFERENCE_CSV):
+        df = pd.read_csv(csv_path, index_col=0)
+        df.index.name = "ID"
+        df["Elements"] = [tuple(ast.literal_eval(elements)) for elements in df["Elements"]]
+        df["Chemical System"] = [chemical_system(elements) for elements in df["Elements"]]
+        df["Space Group Number"] = df["Space Group Number"].astype("Int64")
+        self.df = df
+        self.n_rows = len(df)
+        self.numeric_columns = [column for column in df.columns
+                                if pd.api.types.is_float_dtype(df[column])]
+        # numeric columns sorted once for the range queries, NaN sorts last and is left out
+        self.sorted_columns = {}
+        for column in self.numeric_columns:
+            values = df[column].to_numpy(dtype=float)
+            order = np.argsort(values, kind="stable")[:np.count_nonzero(~np.isnan(values))]
+            self.sorted_columns[column] = (order, values[order])
+
+        self.by_element = inverted_index((element, row) for row, elements in enumerate(df["Elements"])
+                                         for element in elements)
+        self.by_chemsys = inverted_index(enumerate_keys(df["Chemical System"]))
+        self.by_spacegroup = inverted_index(enumerate_keys(df["Space Group Number"].fillna(0).astype(int)))
+        self.by_crystal_system = inverted_index(enumerate_keys(df["Crystal System"].fillna("")))
+
+    @property
+    def elements(self):
+        return sorted(self.by_element)
+
+    @property
+    def crystal_systems(self):
+        return sorted(key for key in self.by_crystal_system if key)
+
+    def _range_rows(self, column, low=None, high=None):
+        """Rows with low <= column <= high, NaN never matches"""
+        order, values = self.sorted_columns[column]
+        start = 0 if low is None else np.searchsorted(values, low, side="left")
+        end = len(values) if high is None else np.searchsorted(values, high, side="right")
+        return order[start:end]
+
+    def _mask(self, rows):
+        mask = np.zeros(self.n_rows, dtype=bool)
+        mask[rows] = True
+        return mask
+
+    def query(self, include_elements=(), exclude_elements=(), chemsys=None, subsystems=False,
+              spacegroups=(), crystal_systems=(), ranges=None):
+        """
+        Rows matching every given condition.
+
+        :param include_elements: Elements that must all be present
+        :param exclude_elements: Elements that must all be absent
+        :param chemsys: Chemical system such as "Pb-Te", in any element order
+        :param subsystems: Also match the systems made of a part of chemsys, e.g. Pb, Te and Pb-Te
+        :param spacegroups: Space group numbers, any of them
+        :param crystal_systems: Crystal systems, any of them
+        :param ranges: Dictionary of numeric column to (low, high), inclusive, None for no bound
+        :return: Array of the matching row numbers in table order
+        """
+        mask = np.ones(self.n_rows, dtype=bool)
+        empty = np.array([], dtype=int)
+        for element in include_elements:
+            mask &= self._mask(self.by_element.get(element, empty))
+        for element in exclude_elements:
+            mask[self.by_element.get(element, empty)] = False
+        if chemsys:
+            elements = sorted(set(element.strip().capitalize() for element in chemsys.split("-")
+                                  if element.strip()))
+            if subsystems:
+                systems = ["-".join(combination) for n in range(1, len(elements) + 1)
+                           for combination in itertools.combinations(elements, n)]
+            else:
+                systems = ["-".join(elements)]
+            mask &= self._mask(np.concatenate([empty] + [self.by_chemsys.get(system, empty)
+                                                         for system in systems]))
+        if len(spacegroups):
+            mask &= self._mask(np.concatenate([empty] + [self.by_spacegroup.get(int(number), empty)
+                                                         for number in spacegroups]))
+        if len(crystal_systems):
+            mask &= self._mask(np.concatenate([empty] + [self.by_crystal_system.get(system, empty)
+                                                         for system in crystal_systems]))
+        for column, (low, high) in (ranges or {}).items():
+            mask &= self._mask(self._range_rows(column, low, high))
+        return np.flatnonzero(mask)
+
+    def frame(self, rows):
+        """Table of the given rows"""
+        return self.df.iloc[rows]
+
+@st.cache_resource(show_spinner="Loading the reference dataset...")
+def load_reference_data(csv_path=REFERENCE_CSV):
+    """The reference dataset, loaded once and shared by all sessions"""
+    return ReferenceData(csv_path)
@@ -0,0 +1,93 @@
+#!/user/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024 Zhibin Gao's Group. All rights reserved.
+# Author: Zhibin Gao
+# Email: zhibin.gao@xjtu.edu.cn
+import io
+import gzip
+import pandas as pd
+import streamlit as st
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+EXPORT_FORMATS = {"CSV (gzip)": ".csv.gz", "Parquet": ".parquet"}
+
+def filter_sort(df, query="", sort_by=None, ascending=True):
+    """
+    Rows whose ID (index) contains query, case-insensitive, sorted by a
+    column or by the ID if sort_by is None
+    """
+    if query:
+        df = df[df.index.astype(str).str.contains(query, case=False, regex=False)]
+    if sort_by is None:
+        return df.sort_index(ascending=ascending, kind="stable")
+    return df.sort_values(sort_by, ascending=ascending, kind="stable", na_position="last")
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def export_bytes(df, fmt, chunk_rows=5000):
+    """
+    Compressed export of df, encoded chunk_rows rows at a time so that only
+    the compressed output and one chunk of text are held in memory. Cached by
+    the rows, so reruns with the download open do not encode them again.
+
+    :param fmt: One of EXPORT_FORMATS
+    """
+    buffer = io.BytesIO()
+    if fmt == "Parquet":
+        writer = None
+        schema = None
+        for start in range(0, max(len(df), 1), chunk_rows):
+            table = pa.Table.from_pandas(df.iloc[start:start + chunk_rows], schema=schema, preserve_index=True)
+            if writer is None:
+                schema = table.schema
+                writer = pq.ParquetWriter(buffer, schema, compression="zstd")
+            writer.write_table(table)
+        writer.close()
+    else:
+        with gzip.GzipFile(fileobj=buffer, mode="wb") as f:
+            for start in range(0, max(len(df), 1), chunk_rows):
+                f.write(df.iloc[start:start + chunk_rows].to_csv(header=start == 0).encode("utf-8"))
+    return buffer.getvalue()
+
+def display_table(df, key, page_size=50, file_name="results"):
+    """
+    Display a result table one page at a time, with filtering by ID, sorting
+    and a compressed download. Only the rows of the current page are sent to
+    the browser.
+    """
+    col1, col2, col3 = st.columns([2, 2, 1])
+    with col1:
+        query = st.text_input("Filter by ID", key=f"{key}_query", placeholder="Part of the file name")
+    with col2:
+        sort_by = st.selectbox("Sort by", ["ID"] + list(df.columns), key=f"{key}_sort")
+    with col3:
+        ascending = st.toggle("Ascending", value=True, key=f"{key}_ascending")
+    view = filter_sort(df, query, None if sort_by == "ID" else sort_by, ascending)
+
+    n_pages = max(1, -(-len(view) // page_size))
+    # the page is kept in session state only; the filter may leave fewer
+    # pages than the one selected before
+    if st.session_state.get(f"{key}_page", 1) > n_pages:
+        st.session_state[f"{key}_page"] = 1
+    page = st.number_input(f"Page (1-{n_pages})", min_value=1, max_value=n_pages,
+                           step=1, key=f"{key}_page")
+    st.dataframe(view.iloc[(page - 1) * page_size:page * page_size])
+    if len(view):
+        st.write(f"Showing rows {(page - 1) * page_size + 1}-{min(page * page_size, len(view))} "
+                 f"of {len(view)} ({len(df)} in total)")
+    else:
+        st.write(f"No rows match the filter ({len(df)} in total)")
+
+    # The export is only built on request, for the filtered and sorted rows
+    formats = [fmt for fmt in EXPORT_FORMATS if fmt != "Parquet" or pa is not None]
+    col1, col2 = st.columns([2, 3])
+    with col1:
+        fmt = st.selectbox("Export format", formats, key=f"{key}_format")
+    with col2:
+        if st.toggle("Prepare download", key=f"{key}_export"):
+            st.download_button(f"Download {len(view)} rows", data=export_bytes(view, fmt),
+                               file_name=file_name + EXPORT_FORMATS[fmt], key=f"{key}_download")
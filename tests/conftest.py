@@ -0,0 +1,32 @@
+import glob
+import os
+import shutil
+import sys
+
+import pytest
+
+# the tests import cgcnn, predict and train from the repository root
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+DATA_DIR = os.path.join(ROOT_DIR, 'tests', 'data')
+
+
+@pytest.fixture
+def cif_root(tmp_path):
+    """
+    A CIFData root_dir with the sample CIFs of tests/data and the shipped
+    atom_init.json. The targets are arbitrary.
+    """
+    # CIFData skips the first line, as in the id_prop.csv of the app
+    rows = ['name,target\n']
+    for i, cif_path in enumerate(sorted(glob.glob(
+            os.path.join(DATA_DIR, '*.cif')))):
+        shutil.copy(cif_path, tmp_path)
+        rows.append('{},{}\n'.format(os.path.basename(cif_path), 1. + i / 10))
+    with open(tmp_path / 'id_prop.csv', 'w') as f:
+        f.writelines(rows)
+    shutil.copy(os.path.join(ROOT_DIR, 'root_dir', 'atom_init.json'),
+                tmp_path)
+    return str(tmp_path)
@@ -0,0 +1,47 @@
+import os
+
+from cgcnn.cache import PredictionCache
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHECKPOINT = os.path.join(ROOT_DIR, 'model',
+                          'Bulk modulus (GPa)-pre-trained.pth.tar')
+SHEAR_CHECKPOINT = os.path.join(ROOT_DIR, 'model',
+                                'Shear modulus (GPa)-pre-trained.pth.tar')
+ATOM_INIT = os.path.join(ROOT_DIR, 'root_dir', 'atom_init.json')
+
+
+def test_model_key_covers_the_graph():
+    key = PredictionCache.model_key(CHECKPOINT, ATOM_INIT)
+    assert key == PredictionCache.model_key(CHECKPOINT, ATOM_INIT, 12, 8,
+                                            0, 0.2, 'radius')
+    assert key != PredictionCache.model_key(CHECKPOINT, ATOM_INIT,
+                                            nbr_search='knn')
+    assert key != PredictionCache.model_key(CHECKPOINT, ATOM_INIT,
+                                            max_num_nbr=8)
+
+
+def test_put_get(tmp_path):
+    cache = PredictionCache(str(tmp_path / 'cache.sqlite'))
+    radius_key = PredictionCache.model_key(CHECKPOINT, ATOM_INIT)
+    knn_key = PredictionCache.model_key(CHECKPOINT, ATOM_INIT,
+                                        nbr_search='knn')
+    cache.put(knn_key, [('a', 1.5)])
+    assert cache.get(radius_key, ['a']) == {}
+    assert cache.get(knn_key, ['a', None]) == {'a': 1.5}
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses']) == (1, 1)
+
+
+def test_prune_checkpoints(tmp_path):
+    cache = PredictionCache(str(tmp_path / 'cache.sqlite'))
+    # the keys of the app and of predict.py with other graph settings
+    kept = [PredictionCache.model_key(CHECKPOINT, ATOM_INIT),
+            PredictionCache.model_key(CHECKPOINT, ATOM_INIT, max_num_nbr=8,
+                                      nbr_search='knn')]
+    gone = [PredictionCache.model_key(SHEAR_CHECKPOINT, ATOM_INIT),
+            'a key of an older form']
+    for model_key in kept + gone:
+        cache.put(model_key, [('a', 1.5)])
+    assert cache.prune_checkpoints([CHECKPOINT]) == 2
+    assert all(cache.get(model_key, ['a']) for model_key in kept)
+    assert not any(cache.get(model_key, ['a']) for model_key in gone)
@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('streamlit')
+
+from streamlit_scripts import calculate_K as calk  # noqa: E402
+
+B = 'Bulk modulus (GPa)'
+G = 'Shear modulus (GPa)'
+GAMMA = 'Grüneisen parameter'
+# the primitive cells of the sample CIFs, as get_crystalline_data gives them
+CRYSTALS = pd.DataFrame(
+    [[2, 8.2489, 67.3965, 334.8], [5, 5.1364, 59.319, 183.4852],
+     [14, 3.4893, 132.8603, 279.1783], [5, 7.8722, 168.9108, 800.7608]],
+    index=['PbTe', 'SrTiO3', 'MgAl2O4', 'Bi2Te3'],
+    columns=['Number of Atoms', 'Density (g cm-3)', 'Volume (Å3)',
+             'the total atomic mass (amu)'])
+
+
+def custom_table():
+    df = CRYSTALS.copy()
+    df[B] = [40., 180., 200., 35.]
+    # a negative shear modulus fails validation
+    df[G] = [20., 110., -1., 20.]
+    df[GAMMA] = [np.nan, 1.5, np.nan, np.nan]
+    df['Bulk modulus std (GPa)'] = 1.
+    return df
+
+
+def test_update_matches_full_table():
+    df = custom_table()
+    cache = {}
+    pd.testing.assert_frame_equal(calk.update_custom_table(df, cache),
+                                  calk.cal_custom_table(df))
+    assert cache['n_updated'] == 4
+    # one edited input, a changed column that is not an input and a
+    # dropped row
+    df.loc['SrTiO3', G] = 100.
+    df['Bulk modulus std (GPa)'] = 2.
+    df = df.drop('Bi2Te3')
+    table_df = calk.update_custom_table(df, cache)
+    assert cache['n_updated'] == 1
+    pd.testing.assert_frame_equal(table_df, calk.cal_custom_table(df))
+    assert list(table_df['Status'] == 'OK') == [True, True, False]
+    # nothing changed
+    pd.testing.assert_frame_equal(calk.update_custom_table(df, cache),
+                                  table_df)
+    assert cache['n_updated'] == 0
+
+
+def test_kappa_matches_inline_formulas():
+    df = calk.cal_custom_table(custom_table())
+    ok = df[df['Status'] == 'OK']
+    gamma, V, N = ok[GAMMA], ok['Volume (Å3)'], ok['Number of Atoms']
+    # the formulas cal_K_Slack and by_MTP had inline before slack_kappa and
+    # pink_kappa
+    slack = (ok['A'] * ok['the total atomic mass (amu)'] * pow(V, 1 / 3) *
+             pow(ok['Acoustic Debye Temperature (K)'], 3) /
+             (pow(gamma, 2) * 300 * N) * 100)
+    pink = (ok[G] * 1e9 * ok['Speed of sound (m s-1)'] *
+            np.power(V * 1e-30, 1 / 3) / (N * 300) * np.exp(-gamma))
+    np.testing.assert_allclose(ok['Kappa_Slack (W m-1 K-1)'], slack,
+                               rtol=1e-12)
+    np.testing.assert_allclose(ok['Kappa_cal (W m-1 K-1)'], pink,
+                               rtol=1e-12)
+
+
+def test_valid_kappa():
+    bulk = np.array([40., -1., 40., 40., 40.])
+    shear = np.array([20., 20., 0., 20., 20.])
+    gamma = np.array([1.5, 1.5, 1.5, -0.5, 12.])
+    finite = np.ones(5)
+    user = calk.valid_kappa(bulk, shear, gamma, np.zeros(5, bool), finite,
+                            finite)
+    default = calk.valid_kappa(bulk, shear, gamma, np.ones(5, bool), finite,
+                               finite)
+    # γ at or above 10 only fails where it is the default
+    assert list(user) == [True, False, False, False, True]
+    assert list(default) == [True, False, False, False, False]
+    assert not calk.valid_kappa(40., 20., 1.5, False, np.nan, 1.)
+    assert not calk.valid_kappa(40., 20., 1.5, False, 1., np.inf)
+
+
+def test_mc_without_std_gives_point_values():
+    df = custom_table().drop('MgAl2O4').drop(
+        columns='Bulk modulus std (GPa)')
+    point = calk.cal_custom_table(df)
+    mc_df = calk.mc_kappa(df, n_samples=1000)
+    assert list(mc_df['Valid samples']) == [1000] * 3
+    for name in ['Kappa_Slack (W m-1 K-1)', 'Kappa_cal (W m-1 K-1)']:
+        # the samples are float32
+        np.testing.assert_allclose(mc_df[name + ' P50'], point[name],
+                                   rtol=1e-5)
+
+
+def test_mc_counts_dropped_samples():
+    df = custom_table().loc[['PbTe']]
+    # about 1 in 6 draws of B are negative
+    df[B], df['Bulk modulus std (GPa)'], df[GAMMA] = 10., 10., 1.5
+    n_samples = 5000
+    mc_df = calk.mc_kappa(df, n_samples=n_samples, seed=1)
+    # the B draws of mc_kappa, the first of the generator; G and γ are
+    # exact, so the negative B are the only invalid samples
+    z = np.random.default_rng(1).standard_normal((1, n_samples),
+                                                 dtype=np.float32)
+    n_valid = int((np.float32(10.) + np.float32(10.) * z > 0).sum())
+    assert 0 < n_valid < n_samples
+    assert mc_df['Valid samples'].iloc[0] == n_valid
+    assert (mc_df.filter(like=' P') > 0).all(axis=None)
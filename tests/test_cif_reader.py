@@ -0,0 +1,66 @@
+import glob
+import os
+import warnings
+
+import numpy as np
+import pytest
+from pymatgen.core.structure import Structure
+
+from cgcnn.cif_reader import (UnsupportedCIF, check_cif_parity, load_crystal,
+                              read_cif)
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+# the sample CIFs and hand written ones with uncertainties, comments, 0.3333
+# coordinates and element symbols as labels
+FAST_CIFS = sorted(glob.glob(os.path.join(DATA_DIR, '*.cif'))) + [
+    os.path.join(DATA_DIR, 'cif_reader', name)
+    for name in ('ZnO_uncertainties.cif', 'ZnO_element_labels.cif')]
+UNSUPPORTED_CIFS = {
+    'partial_occupancy.cif': 'partial occupancy',
+    'oxidation_states.cif': 'oxidation',
+    'overlapping_sites.cif': 'overlapping sites',
+    'not_a_group.cif': 'group',
+}
+
+
+def reference(cif_path):
+    with open(cif_path) as f:
+        text = f.read()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return Structure.from_str(text, fmt='cif')
+
+
+@pytest.mark.parametrize('cif_path', FAST_CIFS, ids=os.path.basename)
+def test_matches_pymatgen(cif_path):
+    with open(cif_path) as f:
+        lattice_matrix, atomic_numbers, frac_coords = read_cif(f.read())
+    structure = reference(cif_path)
+    np.testing.assert_allclose(lattice_matrix, structure.lattice.matrix,
+                               rtol=0, atol=1e-8)
+    # same sites in the same order, so the graphs are the same
+    assert list(atomic_numbers) == list(structure.atomic_numbers)
+    diff = frac_coords - structure.frac_coords
+    np.testing.assert_allclose(diff - np.round(diff), 0, atol=1e-8)
+    assert check_cif_parity(cif_path) == 'fast'
+
+
+@pytest.mark.parametrize('name', sorted(UNSUPPORTED_CIFS))
+def test_unsupported(name):
+    cif_path = os.path.join(DATA_DIR, 'cif_reader', name)
+    with open(cif_path) as f:
+        text = f.read()
+    with pytest.raises(UnsupportedCIF, match=UNSUPPORTED_CIFS[name]):
+        read_cif(text)
+    assert check_cif_parity(cif_path) == 'fallback'
+
+
+@pytest.mark.parametrize('name', ['oxidation_states.cif',
+                                  'not_a_group.cif'])
+def test_load_crystal_falls_back(name):
+    cif_path = os.path.join(DATA_DIR, 'cif_reader', name)
+    crystal = load_crystal(cif_path)
+    structure = reference(cif_path)
+    assert crystal.structure is not None
+    assert list(crystal.atomic_numbers) == list(structure.atomic_numbers)
+    np.testing.assert_allclose(crystal.frac_coords, structure.frac_coords)
@@ -0,0 +1,34 @@
+import os
+
+import pytest
+import torch
+
+from cgcnn.distill import (distill_student, featurize, predict_graphs,
+                           save_student)
+from cgcnn.onnx_export import load_model
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEACHER = os.path.join(ROOT_DIR, 'model',
+                       'Bulk modulus (GPa)-pre-trained.pth.tar')
+
+
+def test_student_checkpoint_is_drop_in(cif_root, tmp_path):
+    teacher, _, teacher_args = load_model(TEACHER)
+    graphs = featurize(cif_root)
+    teacher_outputs, _ = predict_graphs(teacher, graphs)
+    size = {'atom_fea_len': 8, 'n_conv': 1, 'h_fea_len': 16,
+            'max_num_nbr': 8}
+    with pytest.raises(AssertionError):
+        distill_student(teacher_args, graphs, teacher_outputs, [0, 1], [2],
+                        epochs=0, **size)
+    student, error, epoch = distill_student(
+        teacher_args, graphs, teacher_outputs, list(range(2, len(graphs))),
+        [0, 1], epochs=2, **size)
+    assert 1 <= epoch <= 2 and error >= 0
+    path = str(tmp_path / 'student.pth.tar')
+    save_student(path, student, TEACHER, size, error, epoch)
+    loaded, _, model_args = load_model(path)
+    assert model_args.max_num_nbr == 8 and model_args.n_conv == 1
+    expected, _ = predict_graphs(student, graphs, 8)
+    output, _ = predict_graphs(loaded, graphs, 8)
+    torch.testing.assert_close(output, expected)
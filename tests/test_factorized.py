@@ -0,0 +1,68 @@
+import os
+
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+from cgcnn.data import CIFData, collate_pool, collate_sparse_pool
+from cgcnn.model import check_factorized_parity
+from cgcnn.onnx_export import load_model
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL = os.path.join(ROOT_DIR, 'model',
+                     'Bulk modulus (GPa)-pre-trained.pth.tar')
+
+
+def batches(cif_root, sparse):
+    dataset = CIFData(cif_root, sparse=sparse)
+    return DataLoader(dataset, batch_size=4, collate_fn=collate_sparse_pool
+                      if sparse else collate_pool)
+
+
+@pytest.mark.parametrize('max_conv_memory', [None, 1 << 12])
+@pytest.mark.parametrize('sparse', [False, True])
+def test_factorized_matches_plain(cif_root, sparse, max_conv_memory):
+    model, _, _ = load_model(MODEL)
+    # a few hundred bytes per atom, so the chunks are a few atoms or edges
+    model.set_max_conv_memory(max_conv_memory)
+    max_error, passed = check_factorized_parity(
+        model, batches(cif_root, sparse))
+    assert passed, max_error
+
+
+def factorized_and_plain(model, input):
+    # the factorized output with whatever blocks the layers hold
+    with torch.no_grad():
+        output = model.eval()(*input)
+        expected = model.factorize_convs(False)(*input)
+    return output, expected
+
+
+def test_split_weights_follow_training(cif_root):
+    model, _, _ = load_model(MODEL)
+    input, target, _ = next(iter(batches(cif_root, False)))
+    model.eval()
+    model.factorize_convs()
+    cached = [conv_func._split for conv_func in model.convs]
+    assert all(split is not None for split in cached)
+    # the forward passes reuse the blocks of factorize_convs
+    with torch.no_grad():
+        model(*input)
+    assert all(conv_func._split is split
+               for conv_func, split in zip(model.convs, cached))
+    # a training step changes fc_full and bn1, the blocks must follow;
+    # stale blocks are off by far more than the rounding of the larger
+    # outputs after the step
+    model.train()
+    optimizer = torch.optim.SGD(model.parameters(), 0.1)
+    torch.mean((model(*input) - target) ** 2).backward()
+    optimizer.step()
+    torch.testing.assert_close(*factorized_and_plain(model, input),
+                               rtol=1e-5, atol=1e-5)
+    # and so must new parameters loaded into a factorized model
+    state = {name: value + 0.01 for name, value in
+             model.state_dict().items() if value.is_floating_point()}
+    model.factorize_convs().eval()
+    model.load_state_dict(state, strict=False)
+    torch.testing.assert_close(*factorized_and_plain(model, input),
+                               rtol=1e-5, atol=1e-5)
@@ -0,0 +1,115 @@
+import glob
+import os
+
+import numpy as np
+import pytest
+import torch
+from pymatgen.core.lattice import Lattice
+from pymatgen.core.structure import Structure
+
+from cgcnn.cif_reader import load_crystal
+from cgcnn.data import CIFData
+from cgcnn.neighbors import (cell_list_neighbors, check_neighbor_parity,
+                             knn_neighbors, radius_neighbors)
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def perovskite():
+    return Structure.from_spacegroup(
+        'Pm-3m', Lattice.cubic(3.9), ['Sr', 'Ti', 'O'],
+        [[0, 0, 0], [.5, .5, .5], [.5, .5, 0]])
+
+
+def rocksalt():
+    return Structure.from_spacegroup(
+        'Fm-3m', Lattice.cubic(6.46), ['Pb', 'Te'],
+        [[0, 0, 0], [.5, .5, .5]])
+
+
+def slab():
+    # a dense layer and vacuum, the atoms need several expansions of the
+    # cutoff estimated from the average density
+    return Structure(Lattice.orthorhombic(4., 4., 20.), ['Si', 'Si', 'O'],
+                     [[0, 0, 0], [.5, .5, .05], [0, .5, .1]])
+
+
+def distorted():
+    crystal = rocksalt() * (2, 1, 1)
+    crystal.perturb(0.1, min_distance=0.05)
+    return crystal
+
+
+STRUCTURES = {
+    'perovskite': perovskite,
+    'perovskite_supercell': lambda: perovskite() * (2, 2, 1),
+    'rocksalt_supercell': lambda: rocksalt() * (1, 2, 2),
+    'slab': slab,
+    'slab_supercell': lambda: slab() * (2, 1, 1),
+    'distorted': distorted,
+}
+
+
+@pytest.mark.parametrize('name', sorted(STRUCTURES))
+@pytest.mark.parametrize('nbr_search', [knn_neighbors, cell_list_neighbors])
+def test_matches_radius_neighbors(name, nbr_search):
+    np.random.seed(0)
+    crystal = STRUCTURES[name]()
+    assert check_neighbor_parity(crystal, nbr_search=nbr_search)
+    ref_idx, ref_dist = radius_neighbors(crystal, 8, 12)
+    nbr_idx, nbr_dist = nbr_search(crystal, 8, 12)
+    for i, (ref, dist) in enumerate(zip(ref_dist, nbr_dist)):
+        np.testing.assert_allclose(dist, ref, atol=1e-6)
+        # an atom is never its own neighbor at zero distance
+        assert not np.any((nbr_idx[i] == i) & (dist < 1e-6))
+
+
+def test_knn_expands_for_sparse_atoms():
+    crystal = perovskite()
+    _, nbr_dist = knn_neighbors(crystal, 8, 12)
+    # Ti: 6 O at a / 2 and the first 6 of its 8 Sr at a * sqrt(3) / 2
+    np.testing.assert_allclose(nbr_dist[1][:6], 1.95)
+    np.testing.assert_allclose(nbr_dist[1][6:], 3.9 * np.sqrt(3) / 2)
+
+
+def sample_cifs():
+    return sorted(glob.glob(os.path.join(ROOT_DIR, 'tests', 'data', '*.cif')))
+
+
+@pytest.mark.parametrize('cif_path', sample_cifs(), ids=os.path.basename)
+def test_cell_list_on_read_cif_arrays(cif_path):
+    # CIFData runs the cell list search on the arrays of read_cif, without
+    # a Structure; the equidistant neighbors kept at the cutoff may differ
+    # from get_all_neighbors, e.g. 6 of the 12 next Pb in PbTe
+    crystal = load_crystal(cif_path)
+    assert crystal.structure is None
+    assert check_neighbor_parity(
+        Structure.from_file(cif_path),
+        nbr_search=lambda _, radius, max_num_nbr: cell_list_neighbors(
+            crystal, radius, max_num_nbr))
+
+
+def baseline_graph(cif_path, radius=8, max_num_nbr=12):
+    """The dense neighbor indices and distances of the original CIFData"""
+    crystal = Structure.from_file(cif_path)
+    all_nbrs = [sorted(nbrs, key=lambda x: x[1]) for nbrs in
+                crystal.get_all_neighbors(radius, include_index=True)]
+    nbr_fea_idx = [[x[2] for x in nbrs[:max_num_nbr]] +
+                   [0] * (max_num_nbr - len(nbrs)) for nbrs in all_nbrs]
+    nbr_fea = [[x[1] for x in nbrs[:max_num_nbr]] +
+               [radius + 1.] * (max_num_nbr - len(nbrs)) for nbrs in all_nbrs]
+    return np.array(nbr_fea_idx), np.array(nbr_fea)
+
+
+def test_default_graph_is_baseline(cif_root):
+    # the shipped models were trained on these graphs, ties at the cutoff
+    # included (the O of SrTiO3 have 4 Sr and 8 O at a / sqrt(2))
+    dataset = CIFData(cif_root)
+    for i in range(len(dataset)):
+        (_, nbr_fea, nbr_fea_idx), _, cif_id = dataset[i]
+        ref_idx, ref_dist = baseline_graph(os.path.join(cif_root, cif_id))
+        np.testing.assert_array_equal(nbr_fea_idx.numpy(), ref_idx,
+                                      err_msg=cif_id)
+        torch.testing.assert_close(
+            nbr_fea, torch.Tensor(dataset.gdf.expand(ref_dist)),
+            rtol=0, atol=1e-5)
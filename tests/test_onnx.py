@@ -0,0 +1,36 @@
+import os
+
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+from cgcnn.data import CIFData, collate_pool
+from cgcnn.onnx_export import check_onnx_parity, export_onnx, load_model
+
+pytest.importorskip('onnx')
+pytest.importorskip('onnxruntime')
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHECKPOINTS = ['Bulk modulus (GPa)-pre-trained.pth.tar',
+               'Shear modulus (GPa)-pre-trained.pth.tar']
+
+
+@pytest.mark.parametrize('name', CHECKPOINTS)
+def test_onnx_matches_torch(cif_root, tmp_path, name):
+    from cgcnn.onnx_runtime import OnnxCrystalGraphConvNet
+
+    checkpoint_path = os.path.join(ROOT_DIR, 'model', name)
+    onnx_path = str(tmp_path / 'model.onnx')
+    export_onnx(checkpoint_path, onnx_path)
+    loader = DataLoader(CIFData(cif_root), batch_size=4,
+                        collate_fn=collate_pool)
+    max_error, passed = check_onnx_parity(checkpoint_path, onnx_path, loader)
+    assert passed, max_error
+
+    # the denormalized predictions of the runtime wrapper as well
+    model, normalizer, _ = load_model(checkpoint_path)
+    onnx_model = OnnxCrystalGraphConvNet(onnx_path)
+    for input, _, _ in loader:
+        with torch.no_grad():
+            expected = normalizer.denorm(model(*input))[:, 0].numpy()
+        assert abs(onnx_model.predict(*input) - expected).max() < 1e-4
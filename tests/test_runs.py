@@ -0,0 +1,63 @@
+import csv
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from cgcnn.runs import ResumableRun
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL = os.path.join(ROOT_DIR, 'model',
+                     'Bulk modulus (GPa)-pre-trained.pth.tar')
+
+
+def test_recover_drops_unfinished_rows(tmp_path):
+    run_dir = str(tmp_path / 'run')
+    run = ResumableRun(run_dir, {'model': 'abc'})
+    run.append([('a', 1., 1.5), ('b', 2., 2.5)])
+    # a crash half way through the next batch: a row without its id in
+    # completed.txt and an id cut before its newline
+    with open(run.results_file, 'a') as f:
+        f.write('c,3.0,3.5\nd,4.0,4')
+    with open(run.completed_file, 'a') as f:
+        f.write('c')
+    run = ResumableRun(run_dir, {'model': 'abc'})
+    assert len(run) == 2 and 'a' in run and 'c' not in run
+    run.append([('b', 2., 9.9), ('c', 3., 3.5)])
+    out_file = str(tmp_path / 'out.csv')
+    assert run.finalize(['c', 'a', 'b', 'd'], out_file) == ['d']
+    with open(out_file) as f:
+        # the first result of b is kept
+        assert list(csv.reader(f)) == [['c', '3.0', '3.5'],
+                                       ['a', '1.0', '1.5'],
+                                       ['b', '2.0', '2.5']]
+    with pytest.raises(ValueError):
+        ResumableRun(run_dir, {'model': 'def'})
+
+
+def run_predict(cif_root, cwd):
+    subprocess.run([sys.executable, '-W', 'ignore',
+                    os.path.join(ROOT_DIR, 'predict.py'), cif_root,
+                    '--run-dir', 'run', '-b', '3'],
+                   cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+    with open(os.path.join(cwd, 'test_results.csv')) as f:
+        return list(csv.reader(f))
+
+
+def test_predict_resumes_after_crash(cif_root, tmp_path):
+    cwd = str(tmp_path / 'screen')
+    os.makedirs(cwd)
+    shutil.copy(MODEL, os.path.join(cwd, 'pre-trained.pth.tar'))
+    expected = run_predict(cif_root, cwd)
+    assert len(expected) == 10
+    # rerunning a finished run predicts nothing and gives the same output
+    assert run_predict(cif_root, cwd) == expected
+    # keep the first batch, as if the run was killed in the second one
+    completed_file = os.path.join(cwd, 'run', 'completed.txt')
+    with open(completed_file) as f:
+        ids = f.read().split()
+    with open(completed_file, 'w') as f:
+        f.write('\n'.join(ids[:3]) + '\n' + ids[3][:2])
+    assert run_predict(cif_root, cwd) == expected
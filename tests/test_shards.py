@@ -0,0 +1,24 @@
+import pytest
+import torch
+
+from cgcnn.data import CIFData, ShardData, pack_dataset
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_pack_round_trip(cif_root, tmp_path, sparse):
+    shard_dir = str(tmp_path / 'shards')
+    pack_dataset(CIFData(cif_root), shard_dir, shard_size=4)
+    dataset = CIFData(cif_root, sparse=sparse)
+    shards = ShardData(shard_dir, sparse=sparse)
+    # same order, so train.py splits both the same way
+    assert [data[0] for data in shards.id_prop_data] == \
+        [data[0] for data in dataset.id_prop_data]
+    for i in range(len(dataset)):
+        (ref_input, ref_target, ref_id) = dataset[i]
+        (input, target, cif_id) = shards[i]
+        assert cif_id == ref_id
+        assert torch.equal(target, ref_target)
+        torch.testing.assert_close(input[0], ref_input[0])
+        torch.testing.assert_close(input[1], ref_input[1], rtol=0,
+                                   atol=1e-5)
+        assert torch.equal(input[2], ref_input[2])
@@ -0,0 +1,53 @@
+import os
+
+import numpy as np
+import pytest
+from pymatgen.core.lattice import Lattice
+from pymatgen.core.structure import Structure
+from torch.utils.data import DataLoader
+
+from cgcnn.data import (CIFData, collate_pool, collate_sparse_pool,
+                        equivalent_atoms)
+from cgcnn.model import check_symmetry_parity
+from cgcnn.neighbors import radius_neighbors
+from cgcnn.onnx_export import load_model
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL = os.path.join(ROOT_DIR, 'model',
+                     'Bulk modulus (GPa)-pre-trained.pth.tar')
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_matches_full_graph(cif_root, sparse):
+    model, _, _ = load_model(MODEL)
+    full = CIFData(cif_root, sparse=sparse)
+    reduced = CIFData(cif_root, sparse=sparse, symmetry_reduce=True)
+    collate_fn = collate_sparse_pool if sparse else collate_pool
+    max_error, passed = check_symmetry_parity(
+        model, DataLoader(full, batch_size=4, collate_fn=collate_fn),
+        DataLoader(reduced, batch_size=4, collate_fn=collate_fn))
+    assert passed, max_error
+    n_atoms = {}
+    for i in range(len(full)):
+        (atom_fea, *_), _, cif_id = full[i]
+        (reduced_fea, *_, multiplicity), _, _ = reduced[i]
+        # every atom is counted once
+        assert multiplicity.sum() == len(atom_fea)
+        n_atoms[cif_id] = len(atom_fea), len(reduced_fea)
+    # the supercells of the 2 atom rock salt cell
+    assert n_atoms['PbTe_supercell.cif'] == (54, 2)
+    assert n_atoms['PbTe_P1.cif'][1] == 2
+
+
+def test_distorted_atoms_stay_apart():
+    np.random.seed(0)
+    crystal = Structure.from_spacegroup(
+        'Fm-3m', Lattice.cubic(6.46), ['Pb', 'Te'],
+        [[0, 0, 0], [.5, .5, .5]]) * (2, 1, 1)
+    assert len(set(equivalent_atoms(
+        np.array(crystal.atomic_numbers),
+        *radius_neighbors(crystal, 8, 12)))) == 2
+    crystal.perturb(0.1, min_distance=0.05)
+    orbit = equivalent_atoms(np.array(crystal.atomic_numbers),
+                             *radius_neighbors(crystal, 8, 12))
+    assert sorted(orbit) == list(range(len(crystal)))
@@ -0,0 +1,53 @@
+import csv
+import os
+import subprocess
+import sys
+
+import pytest
+import torch
+
+from cgcnn.data import CIFData
+from cgcnn.model import CrystalGraphConvNet
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# a small model on the 10 sample CIFs, one CPU thread and no loader workers
+SMOKE_ARGS = ['--train-size', '6', '--val-size', '2', '--test-size', '2',
+              '-b', '4', '--atom-fea-len', '8', '--h-fea-len', '16',
+              '--n-conv', '1', '--threads', '1', '-j', '0']
+
+
+def run_train(cif_root, run_dir, *args):
+    subprocess.run([sys.executable, '-W', 'ignore',
+                    os.path.join(ROOT_DIR, 'train.py'), cif_root] +
+                   SMOKE_ARGS + list(args), cwd=run_dir, check=True,
+                   stdout=subprocess.DEVNULL)
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_one_epoch(cif_root, tmp_path, sparse):
+    run_train(cif_root, str(tmp_path), '--epochs', '1',
+              *(['--sparse-graph'] if sparse else []))
+    checkpoint = torch.load(str(tmp_path / 'model_best.pth.tar'),
+                            map_location='cpu', weights_only=False)
+    assert checkpoint['epoch'] == 1
+    assert checkpoint['args']['sparse_graph'] == sparse
+    # the checkpoint loads into the model predict.py builds
+    structures, _, _ = CIFData(cif_root)[0]
+    model = CrystalGraphConvNet(structures[0].shape[-1],
+                                structures[1].shape[-1], atom_fea_len=8,
+                                n_conv=1, h_fea_len=16)
+    model.load_state_dict(checkpoint['state_dict'])
+    with open(tmp_path / 'test_results.csv') as f:
+        rows = list(csv.reader(f))
+    assert len(rows) == 2
+    assert all(float(pred) == float(pred) for _, _, pred in rows)
+
+
+def test_resume(cif_root, tmp_path):
+    run_train(cif_root, str(tmp_path), '--epochs', '1')
+    run_train(cif_root, str(tmp_path), '--epochs', '2', '--resume',
+              'checkpoint.pth.tar')
+    checkpoint = torch.load(str(tmp_path / 'checkpoint.pth.tar'),
+                            map_location='cpu', weights_only=False)
+    assert checkpoint['epoch'] == 2
+    assert len(checkpoint['optimizer']['state']) > 0
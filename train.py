@@ -0,0 +1,468 @@
+# Copyright (c) 2024 Zhibin Gao's Group. All rights reserved.
+# Author: Zhibin Gao
+# Email: zhibin.gao@xjtu.edu.cn
+import argparse
+import os
+import sys
+import time
+import warnings
+from random import sample
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel
+from torch.optim.lr_scheduler import MultiStepLR
+
+from cgcnn.data import CIFData
+from cgcnn.data import ShardData
+from cgcnn.data import collate_pool
+from cgcnn.data import collate_sparse_pool
+from cgcnn.data import get_train_val_test_loader
+from cgcnn.model import CrystalGraphConvNet
+from cgcnn.utils import AverageMeter, Normalizer, class_eval, mae
+from cgcnn.utils import save_checkpoint
+
+parser = argparse.ArgumentParser(
+    description='Train crystal gated neural networks on CPU')
+parser.add_argument('root_dir', metavar='ROOT_DIR',
+                    help='dataset directory with id_prop.csv, atom_init.json '
+                    'and the CIF files, or shards written by cgcnn.data')
+parser.add_argument('--task', choices=['regression', 'classification'],
+                    default='regression', help='complete a regression or '
+                    'classification task (default: regression)')
+parser.add_argument('-j', '--workers', default=None, type=int, metavar='N',
+                    help='number of data loading workers per process '
+                    '(default: 2, or 0 with a single CPU per process)')
+parser.add_argument('--epochs', default=30, type=int, metavar='N',
+                    help='number of total epochs to run (default: 30)')
+parser.add_argument('--start-epoch', default=0, type=int, metavar='N',
+                    help='manual epoch number (useful on restarts)')
+parser.add_argument('-b', '--batch-size', default=256, type=int,
+                    metavar='N', help='mini-batch size per process '
+                    '(default: 256)')
+parser.add_argument('--lr', '--learning-rate', default=0.01, type=float,
+                    metavar='LR', help='initial learning rate (default: 0.01)')
+parser.add_argument('--lr-milestones', default=[100], nargs='+', type=int,
+                    metavar='N', help='milestones for scheduler '
+                    '(default: [100])')
+parser.add_argument('--momentum', default=0.9, type=float, metavar='M',
+                    help='momentum')
+parser.add_argument('--weight-decay', '--wd', default=0, type=float,
+                    metavar='W', help='weight decay (default: 0)')
+parser.add_argument('--print-freq', '-p', default=10, type=int,
+                    metavar='N', help='print frequency (default: 10)')
+parser.add_argument('--resume', default='', type=str, metavar='PATH',
+                    help='path to latest checkpoint (default: none)')
+parser.add_argument('--train-ratio', default=None, type=float, metavar='N',
+                    help='ratio of training data to be loaded')
+parser.add_argument('--train-size', default=None, type=int, metavar='N',
+                    help='number of training data to be loaded')
+parser.add_argument('--val-ratio', default=0.1, type=float, metavar='N',
+                    help='percentage of validation data to be loaded '
+                    '(default 0.1)')
+parser.add_argument('--val-size', default=None, type=int, metavar='N',
+                    help='number of validation data to be loaded')
+parser.add_argument('--test-ratio', default=0.1, type=float, metavar='N',
+                    help='percentage of test data to be loaded (default 0.1)')
+parser.add_argument('--test-size', default=None, type=int, metavar='N',
+                    help='number of test data to be loaded')
+parser.add_argument('--optim', default='SGD', type=str, metavar='SGD',
+                    help='choose an optimizer, SGD or Adam, (default: SGD)')
+parser.add_argument('--atom-fea-len', default=64, type=int, metavar='N',
+                    help='number of hidden atom features in conv layers')
+parser.add_argument('--h-fea-len', default=128, type=int, metavar='N',
+                    help='number of hidden features after pooling')
+parser.add_argument('--n-conv', default=3, type=int, metavar='N',
+                    help='number of conv layers')
+parser.add_argument('--n-h', default=1, type=int, metavar='N',
+                    help='number of hidden layers after pooling')
+parser.add_argument('--nbr-search', default='radius',
+                    choices=['radius', 'knn', 'cell_list'],
+                    help='neighbor search backend (default: radius)')
+parser.add_argument('--sparse-graph', action='store_true',
+                    help='Use edge-list crystal graphs without padded neighbors')
+parser.add_argument('--nprocs', default=1, type=int, metavar='N',
+                    help='number of data parallel training processes on this '
+                    'node, using the gloo backend (default: 1)')
+parser.add_argument('--threads', default=None, type=int, metavar='N',
+                    help='torch threads per process '
+                    '(default: CPU count / nprocs)')
+parser.add_argument('--amp', action='store_true',
+                    help='bfloat16 mixed precision, if the CPU supports it')
+parser.add_argument('--port', default=29500, type=int,
+                    help='local port for the process group (default: 29500)')
+
+
+def cpu_supports_bf16():
+    """Check for native bfloat16 instructions (AVX512-BF16 or AMX)"""
+    try:
+        return torch.cpu._is_avx512_bf16_supported() or \
+            torch.cpu._is_amx_tile_supported()
+    except AttributeError:
+        return False
+
+
+def main():
+    args = parser.parse_args(sys.argv[1:])
+    if args.amp and not cpu_supports_bf16():
+        warnings.warn('This CPU has no native bfloat16 support, '
+                      'mixed precision is disabled.')
+        args.amp = False
+    if args.threads is None:
+        args.threads = max(1, (os.cpu_count() or 1) // args.nprocs)
+    if args.workers is None:
+        args.workers = 2 if args.threads > 1 else 0
+    if args.nprocs > 1:
+        mp.spawn(worker, args=(args,), nprocs=args.nprocs)
+    else:
+        worker(0, args)
+
+
+def worker(rank, args):
+    torch.set_num_threads(args.threads)
+    distributed = args.nprocs > 1
+    if distributed:
+        dist.init_process_group(
+            'gloo', init_method=f'tcp://127.0.0.1:{args.port}',
+            rank=rank, world_size=args.nprocs)
+    is_main = rank == 0
+    best_mae_error = 1e10 if args.task == 'regression' else 0.
+
+    # load data
+    if os.path.exists(os.path.join(args.root_dir, 'shards.json')):
+        dataset = ShardData(args.root_dir, sparse=args.sparse_graph)
+    else:
+        dataset = CIFData(args.root_dir, sparse=args.sparse_graph,
+                          nbr_search=args.nbr_search)
+    collate_fn = collate_sparse_pool if args.sparse_graph else collate_pool
+    train_loader, val_loader, test_loader = get_train_val_test_loader(
+        dataset=dataset,
+        collate_fn=collate_fn,
+        batch_size=args.batch_size,
+        train_ratio=args.train_ratio,
+        num_workers=args.workers,
+        val_ratio=args.val_ratio,
+        test_ratio=args.test_ratio,
+        train_size=args.train_size,
+        val_size=args.val_size,
+        test_size=args.test_size,
+        return_test=True,
+        num_replicas=args.nprocs,
+        rank=rank,
+        persistent_workers=True)
+
+    # obtain target value normalizer
+    if args.task == 'classification':
+        normalizer = Normalizer(torch.zeros(2))
+        normalizer.load_state_dict({'mean': 0., 'std': 1.})
+    else:
+        if len(dataset) < 500:
+            warnings.warn('Dataset has less than 500 data points. '
+                          'Lower accuracy is expected. ')
+            sample_data_list = [dataset[i] for i in range(len(dataset))]
+        else:
+            sample_data_list = [dataset[i] for i in
+                                sample(range(len(dataset)), 500)]
+        _, sample_target, _ = collate_fn(sample_data_list)
+        normalizer = Normalizer(sample_target)
+        if distributed:
+            # every rank sampled different data, use the normalizer of rank 0
+            stats = torch.stack([normalizer.mean, normalizer.std])
+            dist.broadcast(stats, src=0)
+            normalizer.load_state_dict({'mean': stats[0], 'std': stats[1]})
+
+    # build model
+    structures, _, _ = dataset[0]
+    orig_atom_fea_len = structures[0].shape[-1]
+    nbr_fea_len = structures[1].shape[-1]
+    model = CrystalGraphConvNet(orig_atom_fea_len, nbr_fea_len,
+                                atom_fea_len=args.atom_fea_len,
+                                n_conv=args.n_conv,
+                                h_fea_len=args.h_fea_len,
+                                n_h=args.n_h,
+                                classification=True if args.task ==
+                                'classification' else False)
+
+    # define loss func and optimizer
+    criterion = nn.NLLLoss() if args.task == 'classification' \
+        else nn.MSELoss()
+    if args.optim == 'SGD':
+        optimizer = optim.SGD(model.parameters(), args.lr,
+                              momentum=args.momentum,
+                              weight_decay=args.weight_decay)
+    elif args.optim == 'Adam':
+        optimizer = optim.Adam(model.parameters(), args.lr,
+                               weight_decay=args.weight_decay)
+    else:
+        raise NameError('Only SGD or Adam is allowed as --optim')
+
+    # optionally resume from a checkpoint
+    if args.resume:
+        if os.path.isfile(args.resume):
+            if is_main:
+                print("=> loading checkpoint '{}'".format(args.resume))
+            checkpoint = torch.load(args.resume,
+                                    map_location=lambda storage, loc: storage)
+            args.start_epoch = checkpoint['epoch']
+            best_mae_error = checkpoint['best_mae_error']
+            model.load_state_dict(checkpoint['state_dict'])
+            optimizer.load_state_dict(checkpoint['optimizer'])
+            normalizer.load_state_dict(checkpoint['normalizer'])
+            if is_main:
+                print("=> loaded checkpoint '{}' (epoch {})"
+                      .format(args.resume, checkpoint['epoch']))
+        elif is_main:
+            print("=> no checkpoint found at '{}'".format(args.resume))
+
+    # the replicas share the initial weights of rank 0
+    ddp_model = DistributedDataParallel(model) if distributed else model
+    scheduler = MultiStepLR(optimizer, milestones=args.lr_milestones,
+                            gamma=0.1)
+
+    for epoch in range(args.start_epoch, args.epochs):
+        # train for one epoch
+        train(train_loader, ddp_model, criterion, optimizer, epoch,
+              normalizer, args, is_main, distributed)
+
+        if is_main:
+            # evaluate on validation set
+            mae_error = validate(val_loader, model, criterion, normalizer,
+                                 args)
+            if mae_error != mae_error:
+                print('Exit due to NaN')
+                os._exit(1)
+
+            # remember the best mae_eror and save checkpoint
+            if args.task == 'regression':
+                is_best = mae_error < best_mae_error
+                best_mae_error = min(mae_error, best_mae_error)
+            else:
+                is_best = mae_error > best_mae_error
+                best_mae_error = max(mae_error, best_mae_error)
+            save_checkpoint({
+                'epoch': epoch + 1,
+                'state_dict': model.state_dict(),
+                'best_mae_error': best_mae_error,
+                'optimizer': optimizer.state_dict(),
+                'normalizer': normalizer.state_dict(),
+                'args': vars(args)
+            }, is_best)
+        scheduler.step()
+        if distributed:
+            dist.barrier()
+
+    # test best model
+    if is_main:
+        print('---------Evaluate Model on Test Set---------------')
+        best_checkpoint = torch.load('model_best.pth.tar',
+                                     map_location=lambda storage, loc: storage)
+        model.load_state_dict(best_checkpoint['state_dict'])
+        validate(test_loader, model, criterion, normalizer, args, test=True)
+    if distributed:
+        dist.destroy_process_group()
+
+
+def train(train_loader, model, criterion, optimizer, epoch, normalizer, args,
+          is_main, distributed):
+    batch_time = AverageMeter()
+    data_time = AverageMeter()
+    losses = AverageMeter()
+    if args.task == 'regression':
+        mae_errors = AverageMeter()
+    else:
+        accuracies = AverageMeter()
+        precisions = AverageMeter()
+        recalls = AverageMeter()
+        fscores = AverageMeter()
+        auc_scores = AverageMeter()
+
+    # switch to train mode
+    model.train()
+
+    start = end = time.time()
+    n_structures = 0
+    for i, (input, target, _) in enumerate(train_loader):
+        # measure data loading time
+        data_time.update(time.time() - end)
+
+        if args.task == 'regression':
+            target_normed = normalizer.norm(target)
+        else:
+            target_normed = target.view(-1).long()
+
+        # compute output
+        with torch.autocast('cpu', dtype=torch.bfloat16, enabled=args.amp):
+            output = model(*input)
+        output = output.float()
+        loss = criterion(output, target_normed)
+
+        # measure accuracy and record loss
+        if args.task == 'regression':
+            mae_error = mae(normalizer.denorm(output.data), target)
+            losses.update(loss.data.item(), target.size(0))
+            mae_errors.update(mae_error, target.size(0))
+        else:
+            accuracy, precision, recall, fscore, auc_score = \
+                class_eval(output.data, target)
+            losses.update(loss.data.item(), target.size(0))
+            accuracies.update(accuracy, target.size(0))
+            precisions.update(precision, target.size(0))
+            recalls.update(recall, target.size(0))
+            fscores.update(fscore, target.size(0))
+            auc_scores.update(auc_score, target.size(0))
+
+        # compute gradient and do SGD step
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        n_structures += target.size(0)
+
+        # measure elapsed time
+        batch_time.update(time.time() - end)
+        end = time.time()
+
+        if i % args.print_freq == 0 and is_main:
+            if args.task == 'regression':
+                print('Epoch: [{0}][{1}/{2}]\t'
+                      'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
+                      'Data {data_time.val:.3f} ({data_time.avg:.3f})\t'
+                      'Loss {loss.val:.4f} ({loss.avg:.4f})\t'
+                      'MAE {mae_errors.val:.3f} ({mae_errors.avg:.3f})'.format(
+                       epoch, i, len(train_loader), batch_time=batch_time,
+                       data_time=data_time, loss=losses, mae_errors=mae_errors))
+            else:
+                print('Epoch: [{0}][{1}/{2}]\t'
+                      'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
+                      'Data {data_time.val:.3f} ({data_time.avg:.3f})\t'
+                      'Loss {loss.val:.4f} ({loss.avg:.4f})\t'
+                      'Accu {accu.val:.3f} ({accu.avg:.3f})\t'
+                      'Precision {prec.val:.3f} ({prec.avg:.3f})\t'
+                      'Recall {recall.val:.3f} ({recall.avg:.3f})\t'
+                      'F1 {f1.val:.3f} ({f1.avg:.3f})\t'
+                      'AUC {auc.val:.3f} ({auc.avg:.3f})'.format(
+                       epoch, i, len(train_loader), batch_time=batch_time,
+                       data_time=data_time, loss=losses, accu=accuracies,
+                       prec=precisions, recall=recalls, f1=fscores,
+                       auc=auc_scores))
+
+    # throughput over all processes
+    n_structures = torch.tensor(float(n_structures))
+    if distributed:
+        dist.all_reduce(n_structures)
+    if is_main:
+        elapsed = time.time() - start
+        print('Epoch: [{0}] {1:.0f} structures in {2:.1f} s, '
+              'throughput {3:.1f} structures/s'.format(
+               epoch, n_structures.item(), elapsed,
+               n_structures.item() / elapsed))
+
+
+def validate(val_loader, model, criterion, normalizer, args, test=False):
+    batch_time = AverageMeter()
+    losses = AverageMeter()
+    if args.task == 'regression':
+        mae_errors = AverageMeter()
+    else:
+        accuracies = AverageMeter()
+        precisions = AverageMeter()
+        recalls = AverageMeter()
+        fscores = AverageMeter()
+        auc_scores = AverageMeter()
+    if test:
+        test_targets = []
+        test_preds = []
+        test_cif_ids = []
+
+    # switch to evaluate mode
+    model.eval()
+
+    end = time.time()
+    for i, (input, target, batch_cif_ids) in enumerate(val_loader):
+        if args.task == 'regression':
+            target_normed = normalizer.norm(target)
+        else:
+            target_normed = target.view(-1).long()
+
+        # compute output
+        with torch.no_grad(), torch.autocast('cpu', dtype=torch.bfloat16,
+                                             enabled=args.amp):
+            output = model(*input)
+        output = output.float()
+        loss = criterion(output, target_normed)
+
+        # measure accuracy and record loss
+        if args.task == 'regression':
+            mae_error = mae(normalizer.denorm(output.data), target)
+            losses.update(loss.data.item(), target.size(0))
+            mae_errors.update(mae_error, target.size(0))
+            if test:
+                test_pred = normalizer.denorm(output.data)
+                test_preds += test_pred.view(-1).tolist()
+                test_targets += target.view(-1).tolist()
+                test_cif_ids += batch_cif_ids
+        else:
+            accuracy, precision, recall, fscore, auc_score = \
+                class_eval(output.data, target)
+            losses.update(loss.data.item(), target.size(0))
+            accuracies.update(accuracy, target.size(0))
+            precisions.update(precision, target.size(0))
+            recalls.update(recall, target.size(0))
+            fscores.update(fscore, target.size(0))
+            auc_scores.update(auc_score, target.size(0))
+            if test:
+                test_pred = torch.exp(output.data)
+                assert test_pred.shape[1] == 2
+                test_preds += test_pred[:, 1].tolist()
+                test_targets += target.view(-1).tolist()
+                test_cif_ids += batch_cif_ids
+
+        # measure elapsed time
+        batch_time.update(time.time() - end)
+        end = time.time()
+
+        if i % args.print_freq == 0:
+            if args.task == 'regression':
+                print('Test: [{0}/{1}]\t'
+                      'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
+                      'Loss {loss.val:.4f} ({loss.avg:.4f})\t'
+                      'MAE {mae_errors.val:.3f} ({mae_errors.avg:.3f})'.format(
+                       i, len(val_loader), batch_time=batch_time, loss=losses,
+                       mae_errors=mae_errors))
+            else:
+                print('Test: [{0}/{1}]\t'
+                      'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
+                      'Loss {loss.val:.4f} ({loss.avg:.4f})\t'
+                      'Accu {accu.val:.3f} ({accu.avg:.3f})\t'
+                      'Precision {prec.val:.3f} ({prec.avg:.3f})\t'
+                      'Recall {recall.val:.3f} ({recall.avg:.3f})\t'
+                      'F1 {f1.val:.3f} ({f1.avg:.3f})\t'
+                      'AUC {auc.val:.3f} ({auc.avg:.3f})'.format(
+                       i, len(val_loader), batch_time=batch_time, loss=losses,
+                       accu=accuracies, prec=precisions, recall=recalls,
+                       f1=fscores, auc=auc_scores))
+
+    if test:
+        star_label = '**'
+        import csv
+        with open('test_results.csv', 'w') as f:
+            writer = csv.writer(f)
+            for cif_id, target, pred in zip(test_cif_ids, test_targets,
+                                            test_preds):
+                writer.writerow((cif_id, target, pred))
+    else:
+        star_label = '*'
+    if args.task == 'regression':
+        print(' {star} MAE {mae_errors.avg:.3f}'.format(star=star_label,
+                                                        mae_errors=mae_errors))
+        return mae_errors.avg
+    else:
+        print(' {star} AUC {auc.avg:.3f}'.format(star=star_label,
+                                                 auc=auc_scores))
+        return auc_scores.avg
+
+
+if __name__ == '__main__':
+    main()